@@ -11,16 +11,23 @@ sys.setrecursionlimit(3000)
 
 
 import os
+import re
+import json
+import time
+from contextlib import closing
 import requests
-from flask import Flask, request, jsonify
+from flask import Response, g, request, jsonify, stream_with_context
 from flask_socketio import SocketIO, emit
 from flask_cors import CORS
 import pandas as pd
-import ast
 import config
 import logging
-from xyz.llm import embedding_model
-from xyz.llm.tools.telegram_update import send_telegram_message
+from xyz import create_app
+from xyz.llm import context_packing, embedding_model, metrics, notifications, resilience
+from xyz.llm.conversation_memory import ConversationMemory
+from xyz.llm.response_cache import ResponseCache, kb_version, scope_key
+from xyz.llm.single_flight import SingleFlight, flight_key
+from xyz.llm.tenants import Tenant, load_tenants, valid_conversation_id
 
 
 # Increase recursion limit and configure SSL
@@ -42,21 +49,11 @@ urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 ssl_context = create_ssl_context()
 
 
-# Set up logging
-logging.basicConfig(level=logging.DEBUG)
+# Logging is configured by config (queued, level-gated)
 logger = logging.getLogger(__name__)
+Preview = config.Preview
 
-openai_client = config.openai_client
-
-# Load the system input from the text file
-system_input_path = 'xyz/llm/embeddings/system_input.txt'
-try:
-    with open(system_input_path, 'r', encoding='utf-8') as file:
-        system_input_txt = file.read()
-except FileNotFoundError:
-    raise FileNotFoundError(f"System input file not found at: {system_input_path}")
-
-app = Flask(__name__)
+app = create_app(import_name=__name__)
 # Configure CORS
 CORS(app, resources={
     r"/api/*": {
@@ -68,7 +65,7 @@ CORS(app, resources={
             "https://alexander-e-bauer.github.io"  # Add your frontend domain
         ],
         "methods": ["GET", "POST", "OPTIONS"],
-        "allow_headers": ["Content-Type", "Authorization"]
+        "allow_headers": ["Content-Type", "Authorization", "X-Widget-Id", "X-API-Key"]
     }
 })
 
@@ -79,38 +76,77 @@ socketio = SocketIO(app, cors_allowed_origins=[
     "https://chat-widget-app-8c3cca0ff3c0.herokuapp.com",
     "https://alexander-e-bauer.github.io"], async_mode='eventlet'
 )
-# In-memory storage for conversation history
-conversation_history = {}
+# Token-budgeted conversation memory with idle eviction (raw turns only, no retrieved documents)
+memory = ConversationMemory()
+# Semantic cache of first-turn answers, scoped to knowledge-base version, system prompt and model
+response_cache = ResponseCache()
+# Identical requests arriving together share one completion call
+completion_flight = SingleFlight()
+
+metrics.register_gauges("query_embedding_cache", embedding_model.query_embedding_cache.stats)
+metrics.register_gauges("response_cache", response_cache.stats)
+metrics.register_gauges("completion_single_flight", completion_flight.stats)
+metrics.register_gauges("embedding_single_flight", embedding_model.query_embedding_flight.stats)
+metrics.register_gauges("query_embedding_batcher", lambda: {
+    model: batcher.stats() for model, batcher in embedding_model.query_embedding_batchers.items()}, label="model")
+metrics.register_gauges("upstream", resilience.stats, label="operation")
+metrics.register_gauges("telegram_queue", notifications.queue_stats)
+metrics.register_gauges("conversation_memory", lambda: {"conversations": len(memory)})
+
+
+# Tenants (widgets) by widget ID and API key, each with its persona, model settings, token budget
+# and memory-mapped knowledge base. Knowledge bases are loaded on a tenant's first request (the
+# default tenant's once in the gunicorn master by warm(), so workers share it copy-on-write),
+# unloaded least recently used first above TENANT_MEMORY_MB, and reloaded in the background
+# when a new store version is published.
+tenants = load_tenants(on_swap=lambda new, old: response_cache.invalidate(kb_version(old)))
+metrics.register_gauges("tenants", tenants.stats)
+metrics.register_gauges("tenant", tenants.tenant_stats, label="tenant")
+metrics.register_gauges("knowledge_base", lambda: {
+    tenant_id: tenant.knowledge_base.stats() for tenant_id, tenant in tenants.tenants.items()
+    if tenant.knowledge_base.loaded}, label="tenant")
+
+
+def warm():
+    """Loads the read-only state up front: default knowledge base, retrieval index and token encoders."""
+    started = time.perf_counter()
+    rows = len(tenants.default.knowledge_base.current()) if tenants.default else 0
+    for model in {config.OAI.gpt4o, config.Ingestion.chunk_encoding_model}:
+        context_packing.encoding_for(model)
+    config.log(f"Warmed up {rows} knowledge base rows in {time.perf_counter() - started:.2f}s")
+
+
+def request_tenant(data: dict):
+    """
+    The tenant named by the request: an API key (X-API-Key or Authorization: Bearer), else a
+    widget ID (X-Widget-Id or the body's widgetId), else the default tenant. None if unknown.
+    """
+    authorization = request.headers.get('Authorization', '')
+    api_key = request.headers.get('X-API-Key') or \
+        (authorization[len('Bearer '):] if authorization.startswith('Bearer ') else None)
+    widget_id = request.headers.get('X-Widget-Id') or (data or {}).get('widgetId')
+    return tenants.resolve(widget_id=widget_id, api_key=api_key)
 
 
-def read_embedding(embedding_path):
-    return pd.read_csv(
-        embedding_path,
-        index_col=0,
-        converters={
-            'embedding': lambda x: ast.literal_eval(x)
-        }
-    )
-df = read_embedding('xyz/llm/embeddings/resume_test.csv')
-print(df)
+def request_error(tenant: Tenant, conversation_id):
+    """The (body, status) refusing a request for an unknown or over-budget tenant or a bad conversation ID, or None."""
+    if tenant is None:
+        return {"error": "Unknown widget ID or API key"}, 401
+    if not valid_conversation_id(conversation_id):
+        return {"error": "Invalid conversation ID"}, 400
+    if tenant.budget.exhausted():
+        return {"error": "This chat has used up its token budget, please try again later"}, 429
+    return None
 
 
 def chat_completion(user_input, conversation_id, system_input="You are a helpful assistant",
                     tools=None, streaming=False):
-    if conversation_id not in conversation_history:
-        conversation_history[conversation_id] = []
+    messages = memory.build_messages(conversation_id, system_input, user_input)
 
-    # Append user message to conversation history
-    conversation_history[conversation_id].append({"role": "user", "content": user_input})
-
-    messages = [
-        {"role": "system", "content": system_input},
-    ] + conversation_history[conversation_id]
-
-    logger.debug(f"Messages sent to API: {messages}")
+    logger.debug("Messages sent to API: %s", Preview(messages))
 
     try:
-        completion = openai_client.chat.completions.create(
+        completion = resilience.chat_completion(
             model="gpt-4",
             messages=messages,
             stream=streaming
@@ -122,78 +158,217 @@ def chat_completion(user_input, conversation_id, system_input="You are a helpful
             output = ""
             for chunk in completion:
                 output += str(chunk.choices[0].delta.content or '')
-                print(chunk.choices[0].delta.content)
 
-        # Append assistant's response to conversation history
-        conversation_history[conversation_id].append({"role": "assistant", "content": output})
+        # Record the exchange in conversation memory
+        memory.add_turns(conversation_id, user_input, output)
 
-        logger.debug(f"Updated conversation history: {conversation_history[conversation_id]}")
+        logger.debug("Updated conversation history: %s", Preview(lambda: memory.history(conversation_id)))
         return output
     except Exception as e:
         logger.error(f"Error in chat completion: {str(e)}", exc_info=True)
         raise
 
 
-def chat_completion_with_embeddings(user_input: str, df: pd.DataFrame, conversation_id: str,
-                                    system_input: str = system_input_txt,
-                                    model: str = "gpt-4o", streaming: bool = False,
-                                    print_message: bool = False) -> str:
-    """
-    Performs chat completion using GPT, incorporating conversation history and document embeddings.
-    """
-    if conversation_id not in conversation_history:
-        conversation_history[conversation_id] = []
-
+def build_rag_messages(user_input: str, df: pd.DataFrame, conversation_id: str,
+                       system_input: str, model: str = "gpt-4o",
+                       print_message: bool = False, token_budget: int = 3000) -> list:
+    """Retrieves documents for the input and builds the messages for the completion."""
     # Create the query message using the dataframe
-    query_msg = embedding_model.query_message(user_input, df, model=model)
+    query_msg = embedding_model.query_message(user_input, df, model=model, token_budget=token_budget)
 
     if print_message:
-        print(f"Query message: {query_msg}")
+        logger.info("Query message: %s", query_msg)
+    elif logger.isEnabledFor(logging.DEBUG) and config.sampled("query_message"):
+        logger.debug("Query message (sampled): %s", Preview(query_msg))
 
-    # Append user message to conversation history
-    conversation_history[conversation_id].append({"role": "user", "content": query_msg})
+    # Retrieved documents only go into the current message; memory keeps the raw user input
+    messages = memory.build_messages(conversation_id, system_input, query_msg)
 
-    messages = [
-                   {"role": "system", "content": system_input},
-               ] + conversation_history[conversation_id]
+    logger.debug("Messages sent to API: %s", Preview(messages))
+    return messages
 
-    logger.debug(f"Messages sent to API: {messages}")
 
-    try:
-        completion = openai_client.chat.completions.create(
-            model=model,
-            messages=messages,
-            stream=streaming,
-            temperature=0
-        )
+def cached_answer(user_input: str, df: pd.DataFrame, conversation_id: str, system_input: str, model: str,
+                  tenant: Tenant):
+    """
+    Looks the question up in the response cache. Only first turns are cached, since follow-ups
+    depend on the conversation. Returns (answer or None, scope, query embedding); scope is None
+    when the answer must not be cached. The query embedding is reused by retrieval on a miss.
+    """
+    if not config.Cache.response_enabled or memory.history(conversation_id):
+        return None, None, None
+    with metrics.stage("embedding"):
+        query_embedding = embedding_model.embed_query(user_input)
+    with metrics.stage("response_cache"):
+        scope = scope_key(kb_version(df), system_input, model, tenant.id)
+        return response_cache.lookup(scope, query_embedding), scope, query_embedding
 
-        if not streaming:
-            output = completion.choices[0].message.content
-        else:
-            output = ""
-            for chunk in completion:
-                output += str(chunk.choices[0].delta.content or '')
-                print(chunk.choices[0].delta.content or '', end='', flush=True)
-
-        # Append assistant's response to conversation history
-        conversation_history[conversation_id].append({"role": "assistant", "content": output})
-
-        logger.debug(f"Updated conversation history: {conversation_history[conversation_id]}")
-        # Format the Telegram message
-        truncated_output = output[:150]  # Limit the output to the first 150 characters
-        message = (
-            f"🤖 Chatbot Interaction Log\n\n"
-            f"Conversation ID: `{conversation_id}`\n\n"
-            f"User Input:\n{user_input}\n\n"
-            f"Bot Output :\n{truncated_output}...\n\n"
-        )
 
-        send_telegram_message(message)  # Send the formatted message to Telegram
+def charged_completion(tenant: Tenant, **kwargs):
+    """A chat completion charged to the tenant's token budget; run once per flight, by its leader."""
+    completion = resilience.chat_completion(**kwargs)
+    tenant.budget.charge(getattr(completion, "usage", None))
+    return completion
+
+
+def chat_completion_with_embeddings(user_input: str, df: pd.DataFrame, conversation_id: str,
+                                    system_input: str = None, model: str = None, streaming: bool = False,
+                                    print_message: bool = False, tenant: Tenant = None) -> str:
+    """
+    Performs chat completion using GPT, incorporating conversation history and document embeddings.
+    The tenant (default tenant if None) supplies the persona, model settings and token budget;
+    system_input and model override its own. conversation_id is the tenant's conversation key.
+    """
+    if streaming:
+        return "".join(stream_chat_completion_with_embeddings(user_input, df, conversation_id,
+                                                              system_input=system_input, model=model,
+                                                              print_message=print_message, tenant=tenant))
+
+    tenant = tenant or tenants.default
+    system_input = system_input or tenant.system_prompt
+    model = model or tenant.model
+    cached, scope, query_embedding = cached_answer(user_input, df, conversation_id, system_input, model, tenant)
+    if cached is not None:
+        logger.debug("Response cache hit for conversation %s", conversation_id)
+        memory.add_turns(conversation_id, user_input, cached)
+        notifications.notify_interaction(conversation_id, user_input, cached)
+        return cached
+
+    messages = build_rag_messages(user_input, df, conversation_id, system_input, model, print_message,
+                                  token_budget=tenant.context_tokens)
+    options = tenant.completion_options()
+
+    try:
+        # Keyed on the input plus everything else that shapes the answer: knowledge base, prompt, history and
+        # options; and on the tenant, whose budget the leader charges for every waiter
+        key = flight_key(model, user_input, [tenant.id, kb_version(df), messages[:-1], options])
+        with metrics.stage("completion"):
+            completion = completion_flight.do(key, charged_completion, tenant,
+                                              model=model, messages=messages, **options)
+        output = completion.choices[0].message.content
+        # Answers from the fallback model are not cached under the primary model's scope
+        served_model = getattr(completion, "model", model)
+        if scope is not None and not resilience.served_by_fallback(served_model, requested_model=model):
+            response_cache.store(scope, user_input, query_embedding, output)
+
+        # Record the exchange in conversation memory
+        with metrics.stage("memory"):
+            memory.add_turns(conversation_id, user_input, output)
+
+        logger.debug("Updated conversation history: %s", Preview(lambda: memory.history(conversation_id)))
+        with metrics.stage("notify"):
+            notifications.notify_interaction(conversation_id, user_input, output)
         return output
     except Exception as e:
         logger.error(f"Error in chat completion: {str(e)}", exc_info=True)
         raise
 
+
+def stream_chat_completion_with_embeddings(user_input: str, df: pd.DataFrame, conversation_id: str,
+                                           system_input: str = None, model: str = None,
+                                           print_message: bool = False, is_cancelled=None, tenant: Tenant = None):
+    """
+    Like chat_completion_with_embeddings, but yields the answer as text deltas as they arrive.
+    Stops early when is_cancelled() returns True or the consumer closes the generator (client
+    disconnect); the upstream stream is closed and whatever was generated is still saved to
+    conversation memory. Cached answers are streamed word by word without calling the model.
+    """
+    tenant = tenant or tenants.default
+    system_input = system_input or tenant.system_prompt
+    model = model or tenant.model
+    cached, scope, query_embedding = cached_answer(user_input, df, conversation_id, system_input, model, tenant)
+    if cached is not None:
+        logger.debug("Response cache hit for conversation %s", conversation_id)
+        memory.add_turns(conversation_id, user_input, cached)
+        notifications.notify_interaction(conversation_id, user_input, cached)
+        yield from re.findall(r'\s*\S+\s*', cached) or [cached]
+        return
+
+    messages = build_rag_messages(user_input, df, conversation_id, system_input, model, print_message,
+                                  token_budget=tenant.context_tokens)
+    started = time.perf_counter()
+    completion = resilience.chat_completion(
+        model=model,
+        messages=messages,
+        stream=True,
+        stream_options={"include_usage": True},  # token usage arrives in a final chunk without choices
+        **tenant.completion_options()
+    )
+    output = ""
+    served_model = model
+    try:
+        for chunk in completion:
+            if is_cancelled is not None and is_cancelled():
+                logger.debug("Stream cancelled for conversation %s", conversation_id)
+                break
+            served_model = getattr(chunk, "model", served_model)
+            if getattr(chunk, "usage", None) is not None:
+                metrics.record_usage(served_model, chunk.usage)
+                tenant.budget.charge(chunk.usage)
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta.content
+            if delta:
+                if not output:
+                    metrics.observe_stage("first_token", time.perf_counter() - started)
+                output += delta
+                yield delta
+        else:
+            # Only complete answers are cached, never ones cut short by a cancel
+            if scope is not None and output and not resilience.served_by_fallback(served_model, requested_model=model):
+                response_cache.store(scope, user_input, query_embedding, output)
+    except Exception as e:
+        logger.error(f"Error in streaming chat completion: {str(e)}", exc_info=True)
+        raise
+    finally:
+        completion.close()  # stops the upstream generation if we stopped reading early
+        metrics.observe_stage("completion", time.perf_counter() - started)
+        if output:
+            memory.add_turns(conversation_id, user_input, output)
+            notifications.notify_interaction(conversation_id, user_input, output)
+
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+    # Started from the first request so it runs in each worker, not in a preloading master
+    tenants.watch()
+
+
+@app.after_request
+def record_request_timing(response):
+    if "request_started" in g:
+        elapsed = time.perf_counter() - g.request_started
+        metrics.request_seconds.observe(elapsed, endpoint=request.endpoint or "unknown")
+        if config.Metrics.server_timing:
+            timings = metrics.server_timing_header()
+            response.headers["Server-Timing"] = f"{timings + ', ' if timings else ''}total;dur={elapsed * 1000:.1f}"
+    return response
+
+
+@app.route('/admin/reload-knowledge-base', methods=['POST'])
+def reload_knowledge_base():
+    """
+    Makes this worker load a newly published store now instead of at its next poll; the
+    other workers pick it up within KB_RELOAD_INTERVAL. ?tenant=<id> picks the tenant (default
+    tenant otherwise), ?force=1 reloads an unchanged store.
+    """
+    token = config.Config.admin_token
+    if not token or request.headers.get('Authorization') != f"Bearer {token}":
+        return jsonify({"error": "Forbidden"}), 403
+    tenant = tenants.get(request.args['tenant']) if 'tenant' in request.args else tenants.default
+    if tenant is None:
+        return jsonify({"error": "Unknown tenant"}), 404
+    reloaded = tenant.knowledge_base.reload(force=request.args.get('force') == '1')
+    return jsonify({"tenant": tenant.id, "reloaded": reloaded, "version": tenant.knowledge_base.source_version})
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    """Prometheus text exposition of this worker's metrics."""
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
 @socketio.on('typing')
 def handle_typing(data):
     emit('typing', data, broadcast=True, include_self=False)
@@ -202,20 +377,126 @@ def handle_typing(data):
 def handle_stop_typing(data):
     emit('stop_typing', data, broadcast=True, include_self=False)
 
+# Socket.IO session id -> {stream token: conversation ID} of its running streams; a stream whose
+# token is gone stops (cancelled or disconnected). A socket may stream several answers at once.
+active_streams = {}
+
+
+def cancel_streams(sid, conversation_id=None):
+    """Stops the session's streams, or only those of one conversation."""
+    streams = active_streams.get(sid, {})
+    for token, stream_conversation_id in list(streams.items()):
+        if conversation_id is None or stream_conversation_id == conversation_id:
+            del streams[token]
+
+
+@socketio.on('chat')
+def handle_chat(data):
+    """Streams an answer to the sender as 'chat_delta' events, then 'chat_done' (or 'chat_error')."""
+    sid = request.sid
+    message = data.get('message', '')
+    conversation_id = data.get('conversationId', 'default')
+    tenant = request_tenant(data)
+    error = request_error(tenant, conversation_id)
+    if error is not None:
+        emit('chat_error', dict(error[0], conversationId=conversation_id))
+        return
+    token = object()
+    active_streams.setdefault(sid, {})[token] = conversation_id
+    try:
+        output = ""
+        with tenants.acquire(tenant) as df:
+            stream = stream_chat_completion_with_embeddings(user_input=message,
+                                                            conversation_id=tenant.conversation_key(conversation_id),
+                                                            df=df,
+                                                            is_cancelled=lambda: token not in active_streams.get(sid, {}),
+                                                            tenant=tenant)
+            with closing(stream):
+                for delta in stream:
+                    output += delta
+                    emit('chat_delta', {"conversationId": conversation_id, "delta": delta})
+        emit('chat_done', {"conversationId": conversation_id, "response": output})
+    except Exception as e:
+        logger.error(f"Error in chat stream: {str(e)}", exc_info=True)
+        emit('chat_error', {"conversationId": conversation_id,
+                            "error": f"An error occurred while processing your request: {str(e)}"})
+    finally:
+        streams = active_streams.get(sid, {})
+        streams.pop(token, None)
+        if not streams:
+            active_streams.pop(sid, None)
+
+
+@socketio.on('cancel_chat')
+def handle_cancel_chat(data=None):
+    """Cancels the sender's streams of data['conversationId'], or all of them without one."""
+    conversation_id = data.get('conversationId') if isinstance(data, dict) else None
+    cancel_streams(request.sid, conversation_id)
+
+
+@socketio.on('disconnect')
+def handle_disconnect(*args):
+    cancel_streams(request.sid)
+
+
+def sse_event(data: dict, event: str = None) -> str:
+    prefix = f"event: {event}\n" if event else ""
+    return f"{prefix}data: {json.dumps(data)}\n\n"
+
+
+@app.route('/api/chat/stream', methods=['POST'])
+def chat_stream():
+    """
+    Server-Sent Events variant of /api/chat: one 'data' event per delta, then a 'done' event
+    with the full response. A client disconnect closes the generator and cancels the upstream call.
+    """
+    data = request.json
+    message = data.get('message', '')
+    conversation_id = data.get('conversationId', 'default')
+    tenant = request_tenant(data)
+    error = request_error(tenant, conversation_id)
+    if error is not None:
+        return jsonify(error[0]), error[1]
+
+    def generate():
+        output = ""
+        try:
+            with tenants.acquire(tenant) as df:
+                stream = stream_chat_completion_with_embeddings(user_input=message, df=df, tenant=tenant,
+                                                                conversation_id=tenant.conversation_key(conversation_id))
+                # Closing the stream on client disconnect stops the upstream call and saves the partial answer
+                with closing(stream):
+                    for delta in stream:
+                        output += delta
+                        yield sse_event({"delta": delta})
+            yield sse_event({"response": output}, event="done")
+        except Exception as e:
+            logger.error(f"Error in chat stream: {str(e)}", exc_info=True)
+            yield sse_event({"error": f"An error occurred while processing your request: {str(e)}"}, event="error")
+
+    return Response(stream_with_context(generate()), mimetype='text/event-stream',
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
 @app.route('/api/chat', methods=['POST'])
 def chat():
     data = request.json
     message = data.get('message', '')
-    conversation_id = data.get('conversationId', 'default')
-    logger.debug(f"Received chat request. Message: {message}, Conversation ID: {conversation_id}")
-    logger.debug(f"Current conversation history: {conversation_history.get(conversation_id, [])}")
+    tenant = request_tenant(data)
+    error = request_error(tenant, data.get('conversationId', 'default'))
+    if error is not None:
+        return jsonify(error[0]), error[1]
+    conversation_id = tenant.conversation_key(data.get('conversationId', 'default'))
+    logger.debug("Received chat request. Message: %s, Conversation ID: %s", Preview(message), conversation_id)
+    logger.debug("Current conversation history: %s", Preview(lambda: memory.history(conversation_id)))
 
 
     try:
-        completion = chat_completion_with_embeddings(user_input=message, conversation_id=conversation_id, df=df)
+        with tenants.acquire(tenant) as df:
+            completion = chat_completion_with_embeddings(user_input=message, conversation_id=conversation_id,
+                                                         df=df, tenant=tenant)
         response = f"{completion}"
-        logger.debug(f"Sending response: {response}")
-        logger.debug(f"Updated conversation history: {conversation_history[conversation_id]}")
+        logger.debug("Sending response: %s", Preview(response))
         return jsonify({"response": response})
     except Exception as e:
         logger.error(f"Error in chat completion: {str(e)}", exc_info=True)
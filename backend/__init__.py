@@ -1,9 +1,14 @@
 from flask import Flask
-from config import Config
+from config import Config, configure_logging
 
 
-def create_app(config_class=Config):
-    app = Flask(__name__)
+def create_app(config_class=Config, import_name=__name__):
+    """
+    Builds the Flask app. Nothing expensive happens here: clients, the knowledge base and
+    encoders are created on first use, or up front by the caller's warm-up (gunicorn preload).
+    """
+    configure_logging()
+    app = Flask(import_name)
     app.config.from_object(config_class)
 
-    return app
\ No newline at end of file
+    return app
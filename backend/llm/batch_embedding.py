@@ -0,0 +1,96 @@
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import tiktoken
+
+import config
+from xyz.llm import clients, resilience
+from xyz.llm.embedding_model import embedding_model, remove_stuff
+
+log = config.log
+OAI = config.OAI
+Ingestion = config.Ingestion
+
+
+def pack_batches(token_counts, max_inputs: int = Ingestion.embedding_batch_inputs,
+                 max_tokens: int = Ingestion.embedding_batch_tokens) -> list[list[int]]:
+    """Greedily groups text positions into batches under the per-request input and token limits."""
+    batches = []
+    batch, batch_tokens = [], 0
+    for i, tokens in enumerate(token_counts):
+        if batch and (len(batch) >= max_inputs or batch_tokens + tokens > max_tokens):
+            batches.append(batch)
+            batch, batch_tokens = [], 0
+        batch.append(i)
+        batch_tokens += tokens
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def _embed_batch(inputs, model, max_retries):
+    """
+    Embeds one batch, retrying transient failures with jittered exponential backoff. Other
+    errors (bad input, auth, context length) would fail again, so they are raised at once.
+    """
+    for attempt in range(max_retries + 1):
+        try:
+            response = clients.get_client().embeddings.create(model=model, input=inputs)
+            return [item.embedding for item in sorted(response.data, key=lambda item: item.index)]
+        except resilience.RETRYABLE_ERRORS as e:
+            if attempt == max_retries:
+                raise
+            delay = min(30.0, 2 ** attempt) * (0.5 + random.random() / 2)
+            log(f"Embedding batch of {len(inputs)} failed ({e}), retrying in {delay:.1f}s")
+            time.sleep(delay)
+
+
+def embed_texts(texts, model: str = embedding_model,
+                max_inputs: int = Ingestion.embedding_batch_inputs,
+                max_tokens: int = Ingestion.embedding_batch_tokens,
+                max_text_tokens: int = Ingestion.embedding_max_text_tokens,
+                concurrency: int = Ingestion.embedding_concurrency,
+                max_retries: int = Ingestion.embedding_max_retries) -> list:
+    """
+    Embeds many texts with as few embeddings requests as possible. Texts are packed into
+    batches under the API's input-count and token limits and up to `concurrency` batches
+    are in flight at once. A batch that still fails after its retries only leaves its own
+    texts without an embedding; results are returned in input order, None where skipped.
+    """
+    cleaned = [remove_stuff(str(text)) for text in texts]
+    try:
+        encoding = tiktoken.encoding_for_model(model)
+    except KeyError:
+        encoding = tiktoken.get_encoding("cl100k_base")  # used by every text-embedding-3 model
+    token_counts = [len(tokens) for tokens in encoding.encode_ordinary_batch(cleaned)]
+
+    embeddings = [None] * len(cleaned)
+    positions = []
+    for i, (text, tokens) in enumerate(zip(cleaned, token_counts)):
+        if not text.strip():
+            continue
+        if tokens > max_text_tokens:
+            log(f"Text {i} exceeds the token limit ({tokens} > {max_text_tokens} tokens). Skipping embedding.")
+            continue
+        positions.append(i)
+
+    batches = [[positions[j] for j in batch]
+               for batch in pack_batches([token_counts[i] for i in positions], max_inputs, max_tokens)]
+    if not batches:
+        return embeddings
+
+    log(f"Embedding {len(positions)} texts in {len(batches)} batches ({concurrency} concurrent)")
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = {
+            executor.submit(_embed_batch, [cleaned[i] for i in batch], model, max_retries): batch
+            for batch in batches
+        }
+        for future in as_completed(futures):
+            batch = futures[future]
+            try:
+                for i, embedding in zip(batch, future.result()):
+                    embeddings[i] = embedding
+            except Exception as e:
+                log(f"Giving up on a batch of {len(batch)} texts: {e}")
+    return embeddings
@@ -0,0 +1,157 @@
+import math
+import re
+
+import tiktoken
+
+import config
+
+Ingestion = config.Ingestion
+
+# Paragraphs are separated by blank lines (or, in text with known headings, are single lines);
+# sentences end with terminal punctuation or a line break.
+_PARAGRAPH_PATTERN = re.compile(r'\S(?:.*?\S)?(?=\n\s*\n|\s*\Z)', re.DOTALL)
+_LINE_PATTERN = re.compile(r'\S(?:[^\n]*\S)?')
+_SENTENCE_PATTERN = re.compile(r'\S.*?(?:[.!?](?=\s)|\n|$)', re.DOTALL)
+
+
+def is_heading(paragraph: str) -> bool:
+    """A paragraph made of one short line without terminal punctuation, e.g. 'Professional Summary'."""
+    paragraph = paragraph.strip()
+    return (
+        0 < len(paragraph) <= 80
+        and '\n' not in paragraph
+        and paragraph[-1] not in '.!?:;,'
+        and not paragraph.startswith(('-', '*', '•'))
+    )
+
+
+class Chunker:
+    """
+    Splits document text into overlapping chunks of at most max_tokens tokens. Text is broken
+    into sentences (and oversized sentences into word runs), which are packed greedily; a
+    heading starts a new chunk once the current one is reasonably full, and each new chunk
+    repeats up to overlap_tokens tokens of trailing sentences from the previous one.
+    """
+
+    def __init__(self, max_tokens: int = Ingestion.chunk_tokens, overlap_tokens: int = Ingestion.chunk_overlap_tokens,
+                 model: str = Ingestion.chunk_encoding_model):
+        if overlap_tokens >= max_tokens:
+            raise ValueError("overlap_tokens must be smaller than max_tokens")
+        self.max_tokens = max_tokens
+        self.overlap_tokens = overlap_tokens
+        self.encoding = tiktoken.encoding_for_model(model)
+
+    def count(self, text: str) -> int:
+        return len(self.encoding.encode(text, disallowed_special=()))
+
+    @staticmethod
+    def _paragraphs(text: str, headings=None):
+        """
+        Yields (start, end, is heading) paragraphs. With the (start, end) spans of the text's
+        headings known, every heading and every other line is a paragraph; without them
+        paragraphs are separated by blank lines and headings are guessed with is_heading().
+        """
+        if headings is None:
+            for paragraph in _PARAGRAPH_PATTERN.finditer(text):
+                yield paragraph.start(), paragraph.end(), is_heading(paragraph.group())
+            return
+        position = 0
+        for start, end in sorted(headings) + [(len(text), len(text))]:
+            for line in _LINE_PATTERN.finditer(text, position, start):
+                yield line.start(), line.end(), False
+            heading = text[start:end]
+            if heading.strip():
+                # The span without surrounding whitespace
+                yield start + len(heading) - len(heading.lstrip()), end - len(heading) + len(heading.rstrip()), True
+            position = max(position, end)
+
+    def _units(self, text: str, headings=None):
+        """Yields (start, end, tokens, heading) for every sentence-sized unit of the text."""
+        for paragraph_start, paragraph_end, marked in self._paragraphs(text, headings):
+            paragraph = text[paragraph_start:paragraph_end]
+            heading = ' '.join(paragraph.split()) if marked else None
+            for sentence in _SENTENCE_PATTERN.finditer(paragraph):
+                start = paragraph_start + sentence.start()
+                end = paragraph_start + sentence.end()
+                yield from self._split_oversized(text, start, end, heading)
+                heading = None
+
+    def _split_oversized(self, text, start, end, heading):
+        tokens = self.count(text[start:end])
+        if tokens <= self.max_tokens:
+            yield start, end, tokens, heading
+            return
+        words = [(start + m.start(), start + m.end()) for m in re.finditer(r'\S+', text[start:end])]
+        pieces = math.ceil(tokens / self.max_tokens) * 2  # aim for half-size pieces to absorb uneven words
+        size = math.ceil(len(words) / pieces)
+        if size >= len(words):
+            # A single enormous "word" (e.g. base64 blob); cut it by characters instead
+            step = max(1, (end - start) // pieces)
+            words = [(i, min(i + step, end)) for i in range(start, end, step)]
+            size = 1
+        for i in range(0, len(words), size):
+            group = words[i:i + size]
+            yield from self._split_oversized(text, group[0][0], group[-1][1], heading if i == 0 else None)
+
+    def chunk_text(self, text: str, filepath: str = None, page: int = None, offset: int = 0,
+                   section: str = None, headings=None) -> list[dict]:
+        """
+        Chunks one text. Offsets are character positions in the source document (offset is the
+        position of this text within it); section is the heading in effect when the text starts,
+        headings the (start, end) spans of the headings in text if known.
+        """
+        return self._chunk(text, filepath, page, offset, section, headings)[0]
+
+    def _chunk(self, text, filepath, page, offset, section, headings=None):
+        chunks = []
+        current = []  # (start, end, tokens, section) units of the chunk being built
+        current_tokens = 0
+
+        def flush():
+            start, end = current[0][0], current[-1][1]
+            chunk = text[start:end]
+            chunks.append({
+                'filepath': filepath,
+                'section': current[0][3],
+                'page': page,
+                'start': offset + start,
+                'end': offset + end,
+                'token_count': self.count(chunk),
+                'text': chunk,
+            })
+
+        for start, end, tokens, heading in self._units(text, headings):
+            starts_section = heading is not None and current_tokens >= self.max_tokens // 4
+            if current and (current_tokens + tokens > self.max_tokens or starts_section):
+                flush()
+                overlap, overlap_tokens = [], 0
+                if not starts_section:
+                    # Carry trailing units over as overlap, never the whole previous chunk
+                    for unit in reversed(current[1:]):
+                        if (overlap_tokens + unit[2] > self.overlap_tokens
+                                or overlap_tokens + unit[2] + tokens > self.max_tokens):
+                            break
+                        overlap.insert(0, unit)
+                        overlap_tokens += unit[2]
+                current, current_tokens = overlap, overlap_tokens
+            if heading is not None:
+                section = heading
+            current.append((start, end, tokens, section))
+            current_tokens += tokens
+        if current:
+            flush()
+        return chunks, section
+
+    def chunk_document(self, pages, filepath: str = None) -> list[dict]:
+        """
+        Chunks a document given as an iterable of (page number or None, text) or, as yielded by
+        document_loaders.iter_pages, (page number or None, text, heading spans). Chunks never span
+        pages; character offsets assume the pages are joined with a newline, like the readers do.
+        """
+        chunks, offset, section = [], 0, None
+        for page, text, *headings in pages:
+            page_chunks, section = self._chunk(text, filepath, page, offset, section,
+                                               headings[0] if headings else None)
+            chunks.extend(page_chunks)
+            offset += len(text) + 1
+        return chunks
@@ -0,0 +1,83 @@
+import importlib.util
+import os
+import threading
+
+import httpx
+from openai import AsyncOpenAI, OpenAI
+
+import config
+from xyz.llm import green
+
+log = config.log
+HTTP = config.HTTP
+OAI = config.OAI
+
+
+def http2_enabled(requested: bool = HTTP.http2) -> bool:
+    if requested and importlib.util.find_spec('h2') is None:
+        log("OPENAI_HTTP2 is set but the h2 package is not installed, using HTTP/1.1")
+        return False
+    return requested
+
+
+def limits() -> httpx.Limits:
+    return httpx.Limits(max_connections=HTTP.max_connections,
+                        max_keepalive_connections=HTTP.max_keepalive_connections,
+                        keepalive_expiry=HTTP.keepalive_expiry)
+
+
+def timeout(read: float = HTTP.read_timeout) -> httpx.Timeout:
+    return httpx.Timeout(connect=HTTP.connect_timeout, read=read, write=HTTP.write_timeout, pool=HTTP.pool_timeout)
+
+
+def stream_timeout() -> httpx.Timeout:
+    """For streamed responses the read timeout bounds the gap between chunks, not the whole answer."""
+    return timeout(read=HTTP.stream_read_timeout)
+
+
+def create_client(api_key: str = HTTP.api_key, base_url: str = HTTP.base_url) -> OpenAI:
+    """Synchronous client over one explicitly sized, keep-alive httpx connection pool."""
+    green.patch_httpcore()
+    http_client = httpx.Client(limits=limits(), timeout=timeout(), http2=http2_enabled(), verify=HTTP.verify_ssl)
+    return OpenAI(api_key=api_key, base_url=base_url, http_client=http_client,
+                  timeout=timeout(), max_retries=HTTP.max_retries)
+
+
+def create_async_client(api_key: str = HTTP.api_key, base_url: str = HTTP.base_url) -> AsyncOpenAI:
+    """asyncio variant with the same pool settings, for scripts and benchmarks running an event loop."""
+    http_client = httpx.AsyncClient(limits=limits(), timeout=timeout(), http2=http2_enabled(),
+                                    verify=HTTP.verify_ssl)
+    return AsyncOpenAI(api_key=api_key, base_url=base_url, http_client=http_client,
+                       timeout=timeout(), max_retries=HTTP.max_retries)
+
+
+_clients = {}
+_lock = threading.Lock()
+
+
+def _per_process(kind: str, factory):
+    # Pools must not cross a fork (gunicorn preload), so every worker builds its own
+    key = (kind, os.getpid())
+    client = _clients.get(key)
+    if client is None:
+        with _lock:
+            client = _clients.get(key)
+            if client is None:
+                client = _clients[key] = factory()
+    return client
+
+
+def get_client() -> OpenAI:
+    """The process-wide OpenAI client; OAI.client overrides it when set."""
+    if OAI.client is not None:
+        return OAI.client
+    return _per_process('sync', create_client)
+
+
+def get_streaming_client() -> OpenAI:
+    """get_client() with stream timeouts, sharing the same connection pool."""
+    return get_client().with_options(timeout=stream_timeout())
+
+
+def get_async_client() -> AsyncOpenAI:
+    return _per_process('async', create_async_client)
@@ -0,0 +1,96 @@
+import functools
+import math
+
+import numpy as np
+import tiktoken
+
+import config
+
+Ingestion = config.Ingestion
+Retrieval = config.Retrieval
+
+
+@functools.lru_cache(maxsize=None)
+def encoding_for(model: str):
+    """Returns the tiktoken encoder for a model, created once per process."""
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        return tiktoken.get_encoding("o200k_base")
+
+
+@functools.lru_cache(maxsize=Retrieval.token_count_cache_size)
+def count_tokens(text: str, model: str) -> int:
+    """Token count of a text, cached so documents without a stored count are only encoded once."""
+    return len(encoding_for(model).encode(text, disallowed_special=()))
+
+
+def stored_counts_usable(model: str) -> bool:
+    """Token counts stored at ingest are only valid for models sharing the ingest encoder."""
+    return encoding_for(model).name == encoding_for(Ingestion.chunk_encoding_model).name
+
+
+def pack_greedy(costs, capacity: int) -> list[int]:
+    """Takes documents in rank order until the next one no longer fits."""
+    selected = []
+    for i, cost in enumerate(costs):
+        if cost > capacity:
+            break
+        selected.append(i)
+        capacity -= cost
+    return selected
+
+
+def pack_knapsack(costs, values, capacity: int, granularity: int = 8) -> list[int]:
+    """
+    0/1 knapsack maximizing total relatedness within the token capacity. Costs are rounded up
+    to `granularity` tokens to keep the table small, so the result never exceeds the budget.
+    Returns the chosen indices in rank order.
+    """
+    weights = [math.ceil(cost / granularity) for cost in costs]
+    slots = capacity // granularity
+    if slots <= 0 or not weights:
+        return []
+    best = np.zeros(slots + 1)
+    taken = np.zeros((len(weights), slots + 1), dtype=bool)
+    for i, (weight, value) in enumerate(zip(weights, values)):
+        if weight > slots:
+            continue
+        candidate = best[:slots + 1 - weight] + value
+        improves = candidate > best[weight:]
+        taken[i, weight:] = improves
+        best[weight:] = np.where(improves, candidate, best[weight:])
+
+    selected, slot = [], slots
+    for i in range(len(weights) - 1, -1, -1):
+        if taken[i, slot]:
+            selected.append(i)
+            slot -= weights[i]
+    return selected[::-1]
+
+
+PACKING_STRATEGIES = ('greedy', 'knapsack')
+
+
+def pack_context(strings, relatednesses, token_counts, token_budget: int, model: str,
+                 fixed_text: str = "", wrapper: tuple[str, str] = ("", ""),
+                 strategy: str = Retrieval.packing_strategy) -> list[int]:
+    """
+    Chooses which ranked documents fit in a prompt of token_budget tokens. fixed_text is the part
+    of the prompt that is always present (introduction and question) and each document is
+    wrapped as wrapper[0] + document + wrapper[1]. Budgeting is done on per-part counts, which
+    in practice are never smaller than the count of the joined prompt, so the budget is respected without
+    re-encoding the growing message. token_counts may contain None for unknown counts.
+    """
+    if strategy not in PACKING_STRATEGIES:
+        raise ValueError(f"Unknown packing strategy {strategy!r}, expected one of {PACKING_STRATEGIES}")
+    use_stored = stored_counts_usable(model)
+    per_document = count_tokens(wrapper[0], model) + count_tokens(wrapper[1], model)
+    costs = [
+        per_document + (stored if use_stored and stored is not None else count_tokens(string, model))
+        for string, stored in zip(strings, token_counts)
+    ]
+    capacity = token_budget - count_tokens(fixed_text, model)
+    if strategy == 'knapsack':
+        return pack_knapsack(costs, relatednesses, capacity)
+    return pack_greedy(costs, capacity)
@@ -0,0 +1,156 @@
+import threading
+
+from cachetools import TTLCache
+
+import config
+from xyz.llm import context_packing, conversation_store, green, resilience
+
+log = config.log
+OAI = config.OAI
+Memory = config.Memory
+
+
+class Conversation:
+    """Raw turns of one conversation plus a running summary of turns that fell out of the window."""
+
+    def __init__(self, turns=None, summary=None, version=0):
+        self.turns = turns or []  # {"seq", "role", "content", "tokens"}
+        self.summary = summary
+        self.version = version  # highest turn sequence number known to this worker
+        self.summarizing = False
+
+
+class ConversationMemory:
+    """
+    Bounded conversation memory. Only raw user and assistant turns are stored: retrieved
+    documents are attached to the current user message when the prompt is built and never
+    saved. History sent to the model is trimmed to token_budget tokens, newest turns first;
+    older turns are dropped or, when summarize is on, folded into a summary in the background.
+    Idle conversations are evicted after idle_ttl seconds, and the least recently used ones
+    once max_conversations is reached.
+
+    The cache reads through to a ConversationStore and appends every exchange to it. With a
+    shared store (SQL, Redis) the cached copy is revalidated against the store's version on
+    each access, so a follow-up that lands on another worker still sees the whole conversation.
+    """
+
+    def __init__(self, token_budget: int = Memory.history_token_budget,
+                 max_conversations: int = Memory.max_conversations, idle_ttl: int = Memory.idle_ttl,
+                 summarize: bool = Memory.summarize, summary_model: str = Memory.summary_model,
+                 model: str = OAI.gpt4o, store: conversation_store.ConversationStore = None):
+        self.store = store or conversation_store.create_store()
+        self.token_budget = token_budget
+        self.summarize = summarize
+        self.summary_model = summary_model
+        self.model = model
+        self._conversations = TTLCache(maxsize=max_conversations, ttl=idle_ttl)
+        self._lock = threading.Lock()
+
+    def _get(self, conversation_id, create=True):
+        with self._lock:
+            conversation = self._conversations.get(conversation_id)
+        if conversation is None or self.store.shared:
+            version = self.store.version(conversation_id) if conversation is not None else None
+            if conversation is None or conversation.version != version:
+                turns, summary, version = self.store.load(conversation_id)
+                if not turns and summary is None and not create:
+                    return None
+                conversation = Conversation(turns, summary, version)
+        with self._lock:
+            # Re-inserting refreshes the idle TTL and the LRU position
+            self._conversations[conversation_id] = conversation
+        return conversation
+
+    def __len__(self):
+        return len(self._conversations)
+
+    def _window(self, conversation):
+        """Index of the oldest turn that still fits in the token budget."""
+        used = 0
+        start = len(conversation.turns)
+        for i in range(len(conversation.turns) - 1, -1, -1):
+            used += conversation.turns[i]["tokens"]
+            if used > self.token_budget:
+                break
+            start = i
+        # Never open the history with an assistant reply to a question that was cut off
+        while start < len(conversation.turns) and conversation.turns[start]["role"] == "assistant":
+            start += 1
+        return start
+
+    def _history(self, conversation):
+        return [{"role": turn["role"], "content": turn["content"]}
+                for turn in conversation.turns[self._window(conversation):]]
+
+    def history(self, conversation_id) -> list[dict]:
+        """Messages of the conversation that fit in the history budget, oldest first."""
+        conversation = self._get(conversation_id, create=False)
+        return self._history(conversation) if conversation is not None else []
+
+    def build_messages(self, conversation_id, system_input: str, user_message: str) -> list[dict]:
+        """System prompt, optional summary, trimmed history and the current user message."""
+        messages = [{"role": "system", "content": system_input}]
+        conversation = self._get(conversation_id, create=False)
+        if conversation is not None:
+            if conversation.summary:
+                messages.append({"role": "system",
+                                 "content": f"Summary of the earlier conversation:\n{conversation.summary}"})
+            messages += self._history(conversation)
+        messages.append({"role": "user", "content": user_message})
+        return messages
+
+    def add_turns(self, conversation_id, user_input: str, assistant_output: str):
+        """Records a completed exchange, appends it to the store and trims the cached history."""
+        conversation = self._get(conversation_id)
+        turns = [
+            {"role": role, "content": content, "tokens": context_packing.count_tokens(content, self.model)}
+            for role, content in (("user", user_input), ("assistant", assistant_output))
+        ]
+        self.store.append(conversation_id, turns)
+        for turn in turns:
+            conversation.version += 1
+            conversation.turns.append(dict(turn, seq=conversation.version))
+        self._trim(conversation_id, conversation)
+
+    def _trim(self, conversation_id, conversation):
+        start = self._window(conversation)
+        if start == 0:
+            return
+        if not self.summarize:
+            # The store keeps the full transcript; only the cached copy is trimmed
+            del conversation.turns[:start]
+        elif not conversation.summarizing:
+            conversation.summarizing = True
+            green.spawn(self._summarize, conversation_id, conversation, conversation.turns[:start])
+
+    def _summarize(self, conversation_id, conversation, dropped):
+        """Folds turns that left the window into the running summary, off the request path."""
+        try:
+            transcript = "\n".join(f"{turn['role']}: {turn['content']}" for turn in dropped)
+            previous = f"Existing summary:\n{conversation.summary}\n\n" if conversation.summary else ""
+            completion = resilience.chat_completion(
+                model=self.summary_model,
+                messages=[
+                    {"role": "system", "content": "Summarize the conversation below in a few sentences, keeping "
+                                                  "names, facts and open questions the assistant needs later."},
+                    {"role": "user", "content": f"{previous}New turns:\n{transcript}"},
+                ],
+                temperature=0
+            )
+            conversation.summary = completion.choices[0].message.content
+            self.store.set_summary(conversation_id, conversation.summary, dropped[-1]["seq"])
+            # Drop exactly the turns that were summarized; newer ones may have been appended meanwhile
+            del conversation.turns[:len(dropped)]
+        except Exception as e:
+            log(f"Conversation summary failed, dropping old turns instead: {e}")
+            del conversation.turns[:len(dropped)]
+        finally:
+            conversation.summarizing = False
+
+    def clear(self, conversation_id):
+        with self._lock:
+            self._conversations.pop(conversation_id, None)
+        self.store.delete(conversation_id)
+
+    def flush(self):
+        self.store.flush()
@@ -0,0 +1,358 @@
+import atexit
+import json
+import os
+import threading
+import time
+
+from cachetools import TTLCache
+
+import config
+from xyz.llm import green
+
+log = config.log
+Memory = config.Memory
+
+
+class ConversationStore:
+    """
+    Persistent, append-only log of conversation turns. Every turn gets a per-conversation
+    sequence number; version() returns the highest one so a read-through cache can tell
+    whether another worker appended since it last loaded the conversation. Summaries are
+    stored with the sequence number they cover, and load() only returns newer turns.
+    """
+    # False for per-process backends, which need no version checks
+    shared = True
+
+    def append(self, conversation_id, turns: list[dict]):
+        """Queues turns ({"role", "content", "tokens"}) for writing."""
+        raise NotImplementedError
+
+    def load(self, conversation_id, limit: int = Memory.load_turns) -> tuple[list[dict], str, int]:
+        """Returns (newest `limit` turns after the summary, oldest first, summary, version)."""
+        raise NotImplementedError
+
+    def version(self, conversation_id) -> int:
+        raise NotImplementedError
+
+    def set_summary(self, conversation_id, summary: str, upto_seq: int):
+        raise NotImplementedError
+
+    def delete(self, conversation_id):
+        raise NotImplementedError
+
+    def flush(self):
+        """Writes queued turns. Backends without buffering write in append()."""
+
+
+class InMemoryStore(ConversationStore):
+    """
+    Per-process store: the original behaviour, lost on restart and not shared between workers.
+    Bounded like the memory cache in front of it, so evicted conversations don't linger here.
+    """
+    shared = False
+
+    def __init__(self, max_conversations: int = Memory.max_conversations, idle_ttl: int = Memory.idle_ttl):
+        self._conversations = TTLCache(maxsize=max_conversations, ttl=idle_ttl)
+
+    def append(self, conversation_id, turns):
+        conversation = self._conversations.get(conversation_id) or {"turns": [], "summary": None, "summary_seq": 0}
+        self._conversations[conversation_id] = conversation
+        for turn in turns:
+            conversation["turns"].append(dict(turn, seq=len(conversation["turns"]) + 1))
+
+    def load(self, conversation_id, limit=Memory.load_turns):
+        conversation = self._conversations.get(conversation_id)
+        if conversation is None:
+            return [], None, 0
+        turns = [turn for turn in conversation["turns"] if turn["seq"] > conversation["summary_seq"]]
+        return turns[-limit:], conversation["summary"], len(conversation["turns"])
+
+    def version(self, conversation_id):
+        conversation = self._conversations.get(conversation_id)
+        return len(conversation["turns"]) if conversation else 0
+
+    def set_summary(self, conversation_id, summary, upto_seq):
+        conversation = self._conversations.get(conversation_id)
+        if conversation is not None:
+            conversation["summary"], conversation["summary_seq"] = summary, upto_seq
+
+    def delete(self, conversation_id):
+        self._conversations.pop(conversation_id, None)
+
+
+class SQLStore(ConversationStore):
+    """
+    SQL backend through SQLAlchemy Core: SQLite (in WAL mode, so workers read while one writes)
+    or any server database such as the PostgreSQL instance at Config.postgres_uri. Appends are
+    buffered and written in one transaction once batch_size turns are pending, or by a background
+    flusher at most flush_interval seconds after they were queued (0 writes every append at
+    once); version() counts pending turns, so the writing worker never sees its own history go
+    backwards. Turns are numbered when written, after the conversation's highest stored seq; if
+    another worker wrote the same numbers first, that conversation's turns are renumbered and
+    written again on their own.
+    """
+
+    def __init__(self, uri: str, batch_size: int = Memory.store_batch_size,
+                 flush_interval: float = Memory.store_flush_interval):
+        import sqlalchemy as sa
+
+        self.sa = sa
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.engine = sa.create_engine(uri, pool_pre_ping=True)
+        if self.engine.dialect.name == 'sqlite':
+            @sa.event.listens_for(self.engine, "connect")
+            def _sqlite_pragmas(dbapi_connection, _):
+                dbapi_connection.execute("PRAGMA journal_mode=WAL")
+                dbapi_connection.execute("PRAGMA synchronous=NORMAL")
+                dbapi_connection.execute("PRAGMA busy_timeout=5000")
+
+        metadata = sa.MetaData()
+        self.turns = sa.Table(
+            'conversation_turns', metadata,
+            sa.Column('conversation_id', sa.String(255), primary_key=True),
+            sa.Column('seq', sa.Integer, primary_key=True),
+            sa.Column('role', sa.String(32), nullable=False),
+            sa.Column('content', sa.Text, nullable=False),
+            sa.Column('tokens', sa.Integer, nullable=False),
+            sa.Column('created', sa.Float, nullable=False),
+        )
+        self.conversations = sa.Table(
+            'conversations', metadata,
+            sa.Column('conversation_id', sa.String(255), primary_key=True),
+            sa.Column('summary', sa.Text),
+            sa.Column('summary_seq', sa.Integer, nullable=False, default=0),
+        )
+        metadata.create_all(self.engine)
+        # Pooled connections must not be shared with a forked child (gunicorn preload)
+        os.register_at_fork(after_in_child=lambda: self.engine.dispose(close=False))
+
+        self._pending = []  # (conversation_id, turn, queued_at)
+        self._lock = threading.Lock()
+        self._flusher = None  # pid of the process running the background flusher
+        atexit.register(self.flush)
+
+    def append(self, conversation_id, turns):
+        with self._lock:
+            now = time.time()
+            self._pending.extend((conversation_id, turn, now) for turn in turns)
+            due = len(self._pending) >= self.batch_size or now - self._pending[0][2] >= self.flush_interval
+        if due:
+            self.flush()
+        else:
+            self._start_flusher()
+
+    def _start_flusher(self):
+        # Per process: a flusher thread does not survive a fork
+        with self._lock:
+            if self._flusher == os.getpid():
+                return
+            self._flusher = os.getpid()
+        green.spawn(self._flush_loop)
+
+    def _flush_loop(self):
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except Exception as e:
+                log(f"Conversation store flusher error: {e}")
+
+    def _write(self, entries):
+        """Inserts the entries in one transaction, numbering each conversation's turns after its stored ones."""
+        with self.engine.begin() as conn:
+            next_seq = {}
+            for conversation_id, turn, queued_at in entries:
+                if conversation_id not in next_seq:
+                    next_seq[conversation_id] = self._stored_version(conn, conversation_id)
+                next_seq[conversation_id] += 1
+                conn.execute(self.turns.insert().values(
+                    conversation_id=conversation_id, seq=next_seq[conversation_id], role=turn["role"],
+                    content=turn["content"], tokens=turn["tokens"], created=queued_at
+                ))
+
+    def flush(self, attempts: int = 3):
+        with self._lock:
+            pending, self._pending = self._pending, []
+        if not pending:
+            return
+        try:
+            self._write(pending)
+            return
+        except self.sa.exc.IntegrityError:
+            pass  # another worker appended to one of these conversations since we read its seq
+        except Exception as e:
+            log(f"Conversation store flush failed, requeueing {len(pending)} turns: {e}")
+            with self._lock:
+                self._pending = pending + self._pending
+            return
+
+        # Write conversation by conversation, renumbering on conflict, so one only delays its own turns
+        by_conversation = {}
+        for entry in pending:
+            by_conversation.setdefault(entry[0], []).append(entry)
+        failed = []
+        for conversation_id, entries in by_conversation.items():
+            for attempt in range(attempts):
+                try:
+                    self._write(entries)
+                    break
+                except self.sa.exc.IntegrityError:
+                    continue
+                except Exception as e:
+                    log(f"Conversation store flush failed for {conversation_id}: {e}")
+                    failed.extend(entries)
+                    break
+            else:
+                log(f"Conversation store flush of {conversation_id} kept conflicting, requeueing")
+                failed.extend(entries)
+        if failed:
+            with self._lock:
+                self._pending = failed + self._pending
+
+    def _pending_count(self, conversation_id):
+        with self._lock:
+            return sum(1 for pending_id, _, _ in self._pending if pending_id == conversation_id)
+
+    def load(self, conversation_id, limit=Memory.load_turns):
+        sa = self.sa
+        with self.engine.connect() as conn:
+            row = conn.execute(
+                sa.select(self.conversations.c.summary, self.conversations.c.summary_seq)
+                .where(self.conversations.c.conversation_id == conversation_id)
+            ).first()
+            summary, summary_seq = (row.summary, row.summary_seq) if row else (None, 0)
+            rows = conn.execute(
+                sa.select(self.turns.c.seq, self.turns.c.role, self.turns.c.content, self.turns.c.tokens)
+                .where(self.turns.c.conversation_id == conversation_id, self.turns.c.seq > summary_seq)
+                .order_by(self.turns.c.seq.desc())
+                .limit(limit)
+            ).all()
+            stored = self._stored_version(conn, conversation_id)
+        turns = [{"seq": r.seq, "role": r.role, "content": r.content, "tokens": r.tokens} for r in reversed(rows)]
+        with self._lock:
+            for pending_id, turn, _ in self._pending:
+                if pending_id == conversation_id:
+                    stored += 1
+                    turns.append(dict(turn, seq=stored))
+        return turns[-limit:], summary, stored
+
+    def _stored_version(self, conn, conversation_id):
+        sa = self.sa
+        return conn.execute(
+            sa.select(sa.func.coalesce(sa.func.max(self.turns.c.seq), 0))
+            .where(self.turns.c.conversation_id == conversation_id)
+        ).scalar_one()
+
+    def version(self, conversation_id):
+        with self.engine.connect() as conn:
+            stored = self._stored_version(conn, conversation_id)
+        return stored + self._pending_count(conversation_id)
+
+    def set_summary(self, conversation_id, summary, upto_seq):
+        sa = self.sa
+        with self.engine.begin() as conn:
+            updated = conn.execute(
+                self.conversations.update()
+                .where(self.conversations.c.conversation_id == conversation_id)
+                .values(summary=summary, summary_seq=upto_seq)
+            ).rowcount
+            if not updated:
+                conn.execute(self.conversations.insert().values(
+                    conversation_id=conversation_id, summary=summary, summary_seq=upto_seq
+                ))
+
+    def delete(self, conversation_id):
+        with self._lock:
+            self._pending = [entry for entry in self._pending if entry[0] != conversation_id]
+        with self.engine.begin() as conn:
+            conn.execute(self.turns.delete().where(self.turns.c.conversation_id == conversation_id))
+            conn.execute(self.conversations.delete().where(self.conversations.c.conversation_id == conversation_id))
+
+
+class RedisStore(ConversationStore):
+    """
+    Redis backend: one list of JSON turns and one hash (seq, summary, summary_seq) per
+    conversation, written together in WATCH/MULTI transactions (so concurrent writers keep the
+    list in seq order) and expiring after idle_ttl. Pass a `fakeredis://` URL to run against an
+    in-process stand-in without a Redis server.
+    """
+
+    def __init__(self, url: str, idle_ttl: int = Memory.store_ttl, client=None):
+        if client is None:
+            if url.startswith('fakeredis://'):
+                import fakeredis
+                client = fakeredis.FakeRedis(decode_responses=True)
+            else:
+                import redis
+                client = redis.Redis.from_url(url, decode_responses=True)
+        self.client = client
+        self.idle_ttl = idle_ttl
+
+    @staticmethod
+    def _keys(conversation_id):
+        return f"conversation:{conversation_id}:turns", f"conversation:{conversation_id}:meta"
+
+    def append(self, conversation_id, turns):
+        turns_key, meta_key = self._keys(conversation_id)
+
+        def write(pipe):
+            seq = int(pipe.hget(meta_key, "seq") or 0)
+            pipe.multi()
+            pipe.hset(meta_key, "seq", seq + len(turns))
+            for i, turn in enumerate(turns):
+                pipe.rpush(turns_key, json.dumps(dict(turn, seq=seq + i + 1)))
+            if self.idle_ttl:
+                pipe.expire(turns_key, self.idle_ttl)
+                pipe.expire(meta_key, self.idle_ttl)
+
+        self.client.transaction(write, meta_key)
+
+    def load(self, conversation_id, limit=Memory.load_turns):
+        turns_key, meta_key = self._keys(conversation_id)
+        pipe = self.client.pipeline()
+        pipe.hgetall(meta_key)
+        pipe.lrange(turns_key, -limit, -1)
+        meta, raw_turns = pipe.execute()
+        summary_seq = int(meta.get("summary_seq", 0))
+        turns = [turn for turn in map(json.loads, raw_turns) if turn["seq"] > summary_seq]
+        return turns, meta.get("summary"), int(meta.get("seq", 0))
+
+    def version(self, conversation_id):
+        return int(self.client.hget(self._keys(conversation_id)[1], "seq") or 0)
+
+    def set_summary(self, conversation_id, summary, upto_seq):
+        turns_key, meta_key = self._keys(conversation_id)
+
+        def write(pipe):
+            seq = int(pipe.hget(meta_key, "seq") or 0)
+            pipe.multi()
+            pipe.hset(meta_key, mapping={"summary": summary, "summary_seq": upto_seq})
+            # Summarized turns are never loaded again, so drop them from the list (all of them if
+            # the summary covers every turn; ltrim with a start of -0 would keep everything)
+            if seq <= upto_seq:
+                pipe.delete(turns_key)
+            else:
+                pipe.ltrim(turns_key, -(seq - upto_seq), -1)
+
+        # Retried if an append lands meanwhile, so the trim never drops turns the summary does not cover
+        self.client.transaction(write, meta_key)
+
+    def delete(self, conversation_id):
+        self.client.delete(*self._keys(conversation_id))
+
+
+STORE_BACKENDS = ('memory', 'sqlite', 'sql', 'redis')
+
+
+def create_store(backend: str = Memory.store_backend, uri: str = Memory.store_uri) -> ConversationStore:
+    """Builds the configured conversation store backend."""
+    if backend == 'memory':
+        return InMemoryStore()
+    if backend == 'sqlite':
+        return SQLStore(uri or 'sqlite:///conversations.db')
+    if backend == 'sql':
+        return SQLStore(uri or config.Config.postgres_uri)
+    if backend == 'redis':
+        return RedisStore(uri or 'redis://localhost:6379/0')
+    raise ValueError(f"Unknown conversation store {backend!r}, expected one of {STORE_BACKENDS}")
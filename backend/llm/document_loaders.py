@@ -0,0 +1,194 @@
+import importlib.util
+import mimetypes
+import os
+import re
+
+import docx
+import markdown
+from bs4 import BeautifulSoup, Tag
+from PyPDF2 import PdfReader
+
+import config
+
+log = config.log
+Ingestion = config.Ingestion
+
+# Extension -> loader and MIME type -> loader. A loader takes a path and yields
+# (page number or None, text) pieces as it reads: PDFs page by page, other formats by
+# paragraph or section. Pieces of non-paginated documents are joined with newlines.
+_by_extension = {}
+_by_mime_type = {}
+
+_HEADING_TAGS = ('h1', 'h2', 'h3', 'h4', 'h5', 'h6')
+
+
+class Heading(str):
+    """A piece that is a heading in its document; loaders that know the structure yield these."""
+
+
+def register(extensions=(), mime_types=()):
+    """Registers the decorated loader for the given extensions and MIME types, replacing earlier ones."""
+    def decorator(loader):
+        for extension in extensions:
+            _by_extension[extension.lower()] = loader
+        for mime_type in mime_types:
+            _by_mime_type[mime_type] = loader
+        return loader
+    return decorator
+
+
+def supported_extensions() -> tuple:
+    return tuple(_by_extension)
+
+
+def loader_for(file_path: str, mime_type: str = None):
+    """The loader for a file by extension, else by (given or guessed) MIME type; None if unsupported."""
+    loader = _by_extension.get(os.path.splitext(file_path)[1].lower())
+    if loader is None:
+        loader = _by_mime_type.get(mime_type or mimetypes.guess_type(file_path)[0])
+    return loader
+
+
+def is_supported(file_path: str) -> bool:
+    return loader_for(file_path) is not None
+
+
+def iter_document_paths(directory):
+    """Yields the path of every supported document under a directory."""
+    # Check if the directory exists
+    if not os.path.exists(directory):
+        raise FileNotFoundError(f"Directory does not exist: {os.path.abspath(directory)}")
+
+    for root, dirs, files in os.walk(directory):
+        for file in files:
+            if file.startswith('~$'):  # Skip temporary files
+                continue
+            if file.lower().endswith(supported_extensions()):
+                yield os.path.join(root, file)
+
+
+def load(file_path: str, mime_type: str = None):
+    """Yields the (page, text) pieces of a document."""
+    loader = loader_for(file_path, mime_type)
+    if loader is None:
+        raise ValueError(f"Unsupported document type: {file_path}")
+    yield from loader(file_path)
+
+
+def iter_pages(file_path: str, mime_type: str = None):
+    """
+    Yields a document as (page number or None, text, headings) pages, one at a time for PDFs;
+    a non-paginated document is a single (None, text, headings) page. headings holds the
+    (start, end) offsets in text of the pieces the loader yielded as Heading, or is None when
+    it marked none (PDFs), leaving headings to the chunker's heuristic.
+    """
+    buffered, headings, length = [], [], 0
+    for page, text in load(file_path, mime_type):
+        if page is None:
+            if isinstance(text, Heading):
+                headings.append((length, length + len(text)))
+            buffered.append(text)
+            length += len(text) + 1
+            continue
+        if buffered:
+            yield None, '\n'.join(buffered), headings or None
+            buffered, headings, length = [], [], 0
+        yield page, text, None
+    if buffered:
+        yield None, '\n'.join(buffered), headings or None
+
+
+def read_document(file_path: str) -> str:
+    """Reads the text of a supported document."""
+    return '\n'.join(text for _, text in load(file_path))
+
+
+@register(extensions=('.doc', '.docx'),
+          mime_types=('application/msword',
+                      'application/vnd.openxmlformats-officedocument.wordprocessingml.document'))
+def load_word_document(file_path):
+    """Yields the paragraphs of a Word document; those in a Title or Heading style as Heading."""
+    for paragraph in docx.Document(file_path).paragraphs:
+        style = paragraph.style.name if paragraph.style is not None else ''
+        if style.startswith(('Heading', 'Title')) and paragraph.text.strip():
+            yield None, Heading(paragraph.text)
+        else:
+            yield None, paragraph.text
+
+
+def pdf_parser() -> str:
+    if Ingestion.pdf_parser == 'pdfplumber' and importlib.util.find_spec('pdfplumber') is None:
+        log("PDF_PARSER is pdfplumber but the package is not installed, using PyPDF2")
+        return 'pypdf2'
+    return Ingestion.pdf_parser
+
+
+@register(extensions=('.pdf',), mime_types=('application/pdf',))
+def load_pdf_document(file_path):
+    """Yields the text of a PDF page by page, with 1-based page numbers."""
+    if pdf_parser() == 'pdfplumber':
+        import pdfplumber
+        with pdfplumber.open(file_path) as pdf:
+            for number, page in enumerate(pdf.pages, start=1):
+                text = page.extract_text() or ''
+                page.close()  # drop the page's parsed objects before reading the next one
+                yield number, text
+        return
+    with open(file_path, 'rb') as file:
+        for number, page in enumerate(PdfReader(file).pages, start=1):
+            yield number, page.extract_text() or ''
+
+
+def html_blocks(root):
+    """
+    Yields the text of an element's children, h1-h6 as Heading. Children that contain headings
+    (wrapper divs, sections) are descended into, so headings come out as their own pieces.
+    """
+    for element in root.children:
+        if not isinstance(element, Tag):
+            text = str(element)
+        elif element.name in _HEADING_TAGS:
+            text = Heading(element.get_text().strip())
+        elif element.find(_HEADING_TAGS) is not None:
+            yield from html_blocks(element)
+            continue
+        else:
+            text = element.get_text()
+        if text.strip():
+            yield text
+
+
+_MARKDOWN_HEADING = re.compile(r'^#{1,6}\s')
+
+
+def markdown_sections(lines):
+    """Groups Markdown lines into sections that start at a heading outside code fences."""
+    section, fenced = [], False
+    for line in lines:
+        if line.lstrip().startswith(('```', '~~~')):
+            fenced = not fenced
+        if not fenced and _MARKDOWN_HEADING.match(line) and section:
+            yield ''.join(section)
+            section = []
+        section.append(line)
+    if section:
+        yield ''.join(section)
+
+
+@register(extensions=('.md', '.markdown'), mime_types=('text/markdown',))
+def load_markdown_file(file_path):
+    """Converts a Markdown file to plain text section by section, headings as Heading."""
+    with open(file_path, 'r', encoding='utf-8') as file:
+        for section in markdown_sections(file):
+            html_content = markdown.markdown(section)
+            for text in html_blocks(BeautifulSoup(html_content, 'html.parser')):
+                yield None, text
+
+
+@register(extensions=('.html', '.htm'), mime_types=('text/html',))
+def load_html_file(file_path):
+    """Extracts the text of an HTML file, one top-level element (or heading) at a time."""
+    with open(file_path, 'r', encoding='utf-8') as file:
+        soup = BeautifulSoup(file, 'html.parser')
+    for text in html_blocks(soup.body or soup):
+        yield None, text
@@ -0,0 +1,155 @@
+import hashlib
+import os
+import re
+import sqlite3
+import threading
+import time
+
+import numpy as np
+from cachetools import TTLCache
+
+import config
+
+log = config.log
+Cache = config.Cache
+
+
+def normalize_query(text: str) -> str:
+    """Case- and whitespace-insensitive form of a query, so 'Hi ' and 'hi' share an entry."""
+    return re.sub(r'\s+', ' ', text).strip().lower()
+
+
+def cache_key(text: str, model: str) -> str:
+    return hashlib.sha1(f"{model}\x00{normalize_query(text)}".encode('utf-8')).hexdigest()
+
+
+class SharedEmbeddingCache:
+    """
+    SQLite-backed tier readable by every gunicorn worker on the host. Each process opens its
+    own connection (connections must not cross a fork); WAL mode keeps readers from blocking
+    the writer. Entries expire after ttl seconds and the least recently used rows are pruned
+    once the table grows past maxsize.
+    """
+
+    def __init__(self, path, ttl: int, maxsize: int):
+        self.path = path
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._conn = None
+        self._pid = None
+        self._writes = 0
+
+    def _connection(self):
+        if self._conn is None or self._pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=1.0, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS query_embeddings ("
+                "key TEXT PRIMARY KEY, vector BLOB NOT NULL, created REAL NOT NULL, accessed REAL NOT NULL)"
+            )
+            self._conn, self._pid = conn, os.getpid()
+        return self._conn
+
+    def get(self, key):
+        conn = self._connection()
+        row = conn.execute("SELECT vector, created FROM query_embeddings WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        now = time.time()
+        if now - row[1] > self.ttl:
+            conn.execute("DELETE FROM query_embeddings WHERE key = ?", (key,))
+            return None
+        conn.execute("UPDATE query_embeddings SET accessed = ? WHERE key = ?", (now, key))
+        return np.frombuffer(row[0], dtype=np.float32)
+
+    def set(self, key, vector: np.ndarray):
+        conn = self._connection()
+        now = time.time()
+        conn.execute(
+            "INSERT OR REPLACE INTO query_embeddings (key, vector, created, accessed) VALUES (?, ?, ?, ?)",
+            (key, vector.astype(np.float32).tobytes(), now, now)
+        )
+        self._writes += 1
+        if self._writes % 100 == 0:
+            self.prune()
+
+    def prune(self):
+        conn = self._connection()
+        conn.execute("DELETE FROM query_embeddings WHERE created < ?", (time.time() - self.ttl,))
+        conn.execute(
+            "DELETE FROM query_embeddings WHERE key IN ("
+            "SELECT key FROM query_embeddings ORDER BY accessed DESC LIMIT -1 OFFSET ?)",
+            (self.maxsize,)
+        )
+
+
+class EmbeddingCache:
+    """
+    Two-tier query embedding cache: a bounded in-process LRU with TTL in front of an optional
+    shared SQLite tier. Keys combine the embedding model with the normalized query text.
+    Errors in the shared tier are logged and treated as misses, never raised to the caller.
+    """
+
+    def __init__(self, maxsize: int = Cache.query_embedding_maxsize, ttl: int = Cache.query_embedding_ttl,
+                 shared_path=Cache.query_embedding_shared_path,
+                 shared_maxsize: int = Cache.query_embedding_shared_maxsize):
+        self._local = TTLCache(maxsize=maxsize, ttl=ttl)
+        self._lock = threading.Lock()
+        self.shared = SharedEmbeddingCache(shared_path, ttl, shared_maxsize) if shared_path else None
+        self.hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+
+    def get(self, text: str, model: str):
+        key = cache_key(text, model)
+        with self._lock:
+            vector = self._local.get(key)
+        if vector is not None:
+            self.hits += 1
+            return vector
+        if self.shared is not None:
+            try:
+                vector = self.shared.get(key)
+            except sqlite3.Error as e:
+                log(f"Shared embedding cache read failed: {e}")
+            if vector is not None:
+                self.shared_hits += 1
+                with self._lock:
+                    self._local[key] = vector
+                return vector
+        self.misses += 1
+        return None
+
+    def set(self, text: str, model: str, embedding):
+        key = cache_key(text, model)
+        vector = np.asarray(embedding, dtype=np.float32)
+        with self._lock:
+            self._local[key] = vector
+        if self.shared is not None:
+            try:
+                self.shared.set(key, vector)
+            except sqlite3.Error as e:
+                log(f"Shared embedding cache write failed: {e}")
+
+    def get_or_create(self, text: str, model: str, create_fn):
+        """Returns the cached embedding or calls create_fn(text) and caches its result."""
+        vector = self.get(text, model)
+        if vector is None:
+            vector = np.asarray(create_fn(text), dtype=np.float32)
+            self.set(text, model, vector)
+        return vector
+
+    def clear(self):
+        with self._lock:
+            self._local.clear()
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.shared_hits + self.misses
+        return {
+            "hits": self.hits,
+            "shared_hits": self.shared_hits,
+            "misses": self.misses,
+            "hit_rate": (self.hits + self.shared_hits) / lookups if lookups else 0.0,
+            "size": len(self._local),
+        }
@@ -1,19 +1,19 @@
+import argparse
 import os
+import functools
+import hashlib
+import json
 from pathlib import Path
-import docx
-from PyPDF2 import PdfReader
-import re
 import pandas as pd
-from scipy import spatial
-import ast
 import tiktoken
-import markdown
-from bs4 import BeautifulSoup
-import tiktoken
-import openai
 import config
 import xyz.llm.embedding_model as flask_embeddings
-from xyz.llm.embedding_model import embedding_model, read_embedding, remove_stuff
+from xyz.llm.embedding_model import embedding_model, remove_stuff
+from xyz.llm.batch_embedding import embed_texts
+from xyz.llm import embedding_store, resilience
+from xyz.llm.chunking import Chunker
+from xyz.llm.document_loaders import iter_document_paths, iter_pages
+from xyz.llm.parallel_parsing import parse_documents
 
 
 log = config.log
@@ -27,10 +27,9 @@ def num_tokens(text):
         # Encode the text to count tokens
         encoded_text = encoding.encode(text, disallowed_special=())
         token_count = len(encoded_text)
-        print(f"Token count: {token_count}")
         return token_count
     except Exception as e:
-        print(f"Error in num_tokens: {e}")
+        log(f"Error in num_tokens: {e}")
         return None
 
 
@@ -50,67 +49,58 @@ def get_embedding(text_to_embed):
     max_token_limit = 8192  # Adjust based on your model's token limit
 
     if token_count is None or token_count > max_token_limit:
-        print(f"Text exceeds the token limit ({max_token_limit} tokens). Skipping embedding.")
+        log(f"Text exceeds the token limit ({max_token_limit} tokens). Skipping embedding.")
         return None
 
     try:
         # Embed a line of text
-        response = OAI.client.embeddings.create(
-            model=embedding_model,
-            input=[text_to_embed]
-        )
+        response = resilience.create_embeddings(embedding_model, [text_to_embed])
         # Extract the AI output embedding as a list of floats
         embedding = response.data[0].embedding
-        print(f"---\nEmbedding generated successfully for text: {text_to_embed[:100]}...")
+        config.debug("Embedding generated for text: %s", config.Preview(text_to_embed, limit=100))
         return embedding
     except Exception as e:
-        print(f"Error generating embedding: {e}")
+        log(f"Error generating embedding: {e}")
         return None
 
 
+def chunk_document_file(chunker, file_path):
+    """Streams the pages of a document into the chunker. Runs in the parsing worker processes."""
+    return chunker.chunk_document(iter_pages(file_path), filepath=file_path)
+
+
+def embed_documents(file_paths, chunker=None):
+    """
+    Reads, chunks and embeds the given documents. Returns one row per chunk with its text,
+    embedding and provenance: 'filepath', 'section', 'page', 'start', 'end' and 'token_count'.
+    """
+    chunker = chunker or Chunker()
+    # Documents are parsed and chunked in parallel; only their chunks come back, kept in input order
+    document_chunks = {}
+    for result in parse_documents(file_paths, functools.partial(chunk_document_file, chunker)):
+        file_path = result.file_path
+        if not result.ok:
+            print(f"Error processing {file_path}: {result.error}")
+        elif result.value:
+            document_chunks[result.index] = result.value
+            print(f"Processed document: {file_path} ({len(result.value)} chunks)")
+        else:
+            print(f"No text found in document: {file_path}")
+    chunks = [chunk for index in sorted(document_chunks) for chunk in document_chunks[index]]
+
+    # Embed everything in batched, concurrent requests and build the frame in one pass
+    columns = ['filepath', 'text', 'embedding', 'section', 'page', 'start', 'end', 'token_count']
+    df = pd.DataFrame(chunks, columns=columns).astype({'page': 'Int64'})
+    df['embedding'] = embed_texts(df['text'].tolist())
+    return df
+
+
 def get_document_text(directory):
     """
     Returns the text content and embeddings of all Word documents, PDFs, Markdown files,
     and HTML files in a directory, or from an Excel file if provided.
     """
-    df = pd.DataFrame(columns=['filepath', 'text', 'embedding'])
-
-    # Check if the directory exists
-    if not os.path.exists(directory):
-        raise FileNotFoundError(f"Directory does not exist: {os.path.abspath(directory)}")
-
-    # Process documents in directory
-    for root, dirs, files in os.walk(directory):
-        print(f"Scanning directory: {root}")
-        for file in files:
-            if file.startswith('~$'):  # Skip temporary files
-                continue
-
-            if file.endswith(('.doc', '.docx', '.pdf', '.md', '.html')):
-                file_path = os.path.join(root, file)
-
-                try:
-                    if file.endswith(('.doc', '.docx')):
-                        raw_text = read_word_document(file_path)
-                    elif file.endswith('.pdf'):
-                        raw_text = read_pdf_document(file_path)
-                    elif file.endswith('.md'):
-                        raw_text = read_markdown_file(file_path)
-                    elif file.endswith('.html'):
-                        raw_text = read_html_file(file_path)
-                    else:
-                        print("No Readable Documents Found (.docx, .pdf, .md, .html)")
-                        return
-
-                    if raw_text.strip():  # Check if the extracted text is not empty
-                        print(f"Processed document: {file_path}")
-                        embedding = get_embedding(raw_text)
-                        df = df._append({'filepath': file_path, 'text': raw_text, 'embedding': embedding}, ignore_index=True)
-                    else:
-                        print(f"No text found in document: {file_path}")
-                except Exception as e:
-                    print(f"Error processing {file_path}: {str(e)}")
-
+    df = embed_documents(iter_document_paths(directory))
     if df.empty:
         print("No valid documents found.")
         return df
@@ -119,45 +109,6 @@ def get_document_text(directory):
 
 
 
-def read_markdown_file(file_path):
-    """
-    Read and convert a Markdown file to plain text.
-    """
-    with open(file_path, 'r', encoding='utf-8') as file:
-        md_content = file.read()
-    html_content = markdown.markdown(md_content)
-    soup = BeautifulSoup(html_content, 'html.parser')
-    return soup.get_text()
-
-def read_html_file(file_path):
-    """
-    Read an HTML file and extract its text content.
-    """
-    with open(file_path, 'r', encoding='utf-8') as file:
-        html_content = file.read()
-    soup = BeautifulSoup(html_content, 'html.parser')
-    return soup.get_text()
-
-
-def read_word_document(file_path):
-    """Reads the text content of a Word document."""
-    doc = docx.Document(file_path)
-    full_text = []
-    for para in doc.paragraphs:
-        full_text.append(para.text)
-    return '\n'.join(full_text)
-
-
-def read_pdf_document(file_path):
-    """Reads the text content of a PDF document."""
-    with open(file_path, 'rb') as file:
-        pdf_reader = PdfReader(file)
-        full_text = []
-        for page in pdf_reader.pages:
-            full_text.append(page.extract_text())
-    return '\n'.join(full_text)
-
-
 def read_file_as_raw_text(file_path):
     """Reads a file and returns its contents as a raw string."""
     try:
@@ -209,11 +160,96 @@ def save_embeddings(directory, output_path):
 
 
 
+def ingest_manifest_path(store_path):
+    """The ingest manifest lives next to the store so atomic store swaps don't discard it."""
+    return f"{os.path.normpath(store_path)}.ingest.json"
 
 
-directory = "knowledge_sources/"
-output_path = "embeddings/example_embeddings.csv"
+def file_sha256(file_path):
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as file:
+        for block in iter(lambda: file.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
 
-save_embeddings(directory, output_path)
 
-#df = read_embedding('xyz/llm/embeddings/resume_test.csv')
+def update_embeddings(directory, store_path):
+    """
+    Incrementally updates an embedding store from a directory. A manifest of path, mtime, size
+    and content hash decides which files are new or modified; only those are parsed and embedded.
+    Rows of added, modified and deleted files are dropped and the store is rewritten with the result.
+    Files that could not be fully embedded keep their previous rows and are retried next run.
+    Returns a dict with the added, modified, deleted, unchanged and failed file paths.
+    """
+    manifest_path = ingest_manifest_path(store_path)
+    old_manifest = {}
+    if os.path.exists(manifest_path) and embedding_store.is_store(store_path):
+        with open(manifest_path, 'r', encoding='utf-8') as file:
+            old_manifest = json.load(file)
+
+    manifest, added, modified, unchanged = {}, [], [], []
+    for file_path in iter_document_paths(directory):
+        stat = os.stat(file_path)
+        entry = {'mtime': stat.st_mtime, 'size': stat.st_size}
+        previous = old_manifest.get(file_path)
+        if previous and previous['mtime'] == entry['mtime'] and previous['size'] == entry['size']:
+            manifest[file_path] = previous
+            unchanged.append(file_path)
+            continue
+        entry['sha256'] = file_sha256(file_path)
+        manifest[file_path] = entry
+        if previous is None:
+            added.append(file_path)
+        elif previous['sha256'] != entry['sha256']:
+            modified.append(file_path)
+        else:
+            unchanged.append(file_path)  # touched but identical
+    deleted = [file_path for file_path in old_manifest if file_path not in manifest]
+    changes = {'added': added, 'modified': modified, 'deleted': deleted, 'unchanged': unchanged, 'failed': []}
+    print(f"Incremental update: {len(added)} added, {len(modified)} modified, "
+          f"{len(deleted)} deleted, {len(unchanged)} unchanged")
+
+    if added or modified or deleted or not embedding_store.is_store(store_path):
+        new_rows = embed_documents(added + modified)
+        # A file is only recorded once all of its chunks are embedded; files that failed to parse,
+        # had no text or lost a batch keep their previous rows and manifest entry, so the next run retries them
+        missing = new_rows['embedding'].isna()
+        failed = ((set(added) | set(modified)) - set(new_rows.loc[~missing, 'filepath'])) \
+            | set(new_rows.loc[missing, 'filepath'])
+        changes['failed'] = sorted(failed)
+        if failed:
+            print(f"{len(failed)} files were not fully indexed and will be retried on the next run")
+            new_rows = new_rows[~new_rows['filepath'].isin(failed)]
+            for file_path in failed:
+                if file_path in old_manifest:
+                    manifest[file_path] = old_manifest[file_path]
+                else:
+                    del manifest[file_path]
+        if embedding_store.is_store(store_path):
+            existing = embedding_store.read_store_embeddings(store_path)
+            # Added files are replaced too: a store without a manifest (e.g. from convert_csv) already holds them
+            stale = (set(added) | set(modified) | set(deleted)) - failed
+            existing = existing[~existing['filepath'].isin(stale)]
+        else:
+            existing = None
+        df = pd.concat([existing, new_rows], ignore_index=True) if existing is not None else new_rows
+        if df.empty:
+            raise ValueError("No valid documents found in the directory.")
+        embedding_store.save_store(df, store_path)
+
+    with open(manifest_path, 'w', encoding='utf-8') as file:
+        json.dump(manifest, file, indent=2)
+    return changes
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Parse, chunk and embed a folder of documents.")
+    parser.add_argument("directory", nargs="?", default="xyz/llm/knowledge_sources/personal")
+    parser.add_argument("--store", default=config.Retrieval.store_path,
+                        help="embedding store to update incrementally (default EMBEDDING_STORE_PATH)")
+    parser.add_argument("--csv", help="write every document to this CSV instead of updating the store")
+    args = parser.parse_args()
+    if args.csv:
+        save_embeddings(args.directory, args.csv)
+    else:
+        update_embeddings(args.directory, args.store)
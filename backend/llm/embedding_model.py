@@ -1,10 +1,12 @@
 import re
 import pandas as pd
-from scipy import spatial
 import ast
-import tiktoken
 
 import config
+from xyz.llm import context_packing, metrics, resilience, retrieval
+from xyz.llm.embedding_cache import EmbeddingCache
+from xyz.llm.micro_batch import MicroBatcher
+from xyz.llm.single_flight import SingleFlight, flight_key
 
 log = config.log
 OAI = config.OAI
@@ -16,6 +18,11 @@ embedding_model = OAI.embedding3
 pd.set_option('display.max_columns', None)
 pd.set_option('display.max_rows', None)
 
+# Query embeddings are cached so repeated questions skip the embeddings round-trip
+query_embedding_cache = EmbeddingCache()
+# Concurrent misses for the same query share one embeddings call
+query_embedding_flight = SingleFlight()
+
 
 def read_embedding(file_path):
     """
@@ -25,7 +32,7 @@ def read_embedding(file_path):
         try:
             return ast.literal_eval(x)
         except (ValueError, SyntaxError) as e:
-            print(f"Error parsing embedding: {x}. Error: {e}")
+            log("Error parsing embedding: %s. Error: %s", config.Preview(x, limit=100), e)
             return None  # Or you can return an empty list: []
 
     return pd.read_csv(
@@ -46,30 +53,78 @@ def read_embedding_(embedding_path):
     )
 
 
+def create_query_embedding(query: str, model: str = embedding_model):
+    """Calls the embeddings API for a single query."""
+    response = resilience.create_embeddings(model, query)
+    return response.data[0].embedding
+
+
+def create_query_embeddings(queries: list[str], model: str = embedding_model) -> list:
+    """Calls the embeddings API once for several queries; vectors are returned in input order."""
+    response = resilience.create_embeddings(model, queries)
+    return [item.embedding for item in sorted(response.data, key=lambda item: item.index)]
+
+
+# One micro-batcher per embedding model, created on first use
+query_embedding_batchers = {}
+
+
+def batched_query_embedding(query: str, model: str = embedding_model):
+    """Embeds a query together with other queries arriving within Retrieval.query_batch_window."""
+    window = config.Retrieval.query_batch_window
+    if window <= 0:
+        return create_query_embedding(query, model)
+    batcher = query_embedding_batchers.get(model)
+    if batcher is None:
+        batcher = query_embedding_batchers.setdefault(model, MicroBatcher(
+            lambda queries: create_query_embeddings(queries, model),
+            window=window, max_batch=config.Retrieval.query_batch_max,
+            isolate=lambda e: isinstance(e, resilience.INPUT_ERRORS)
+        ))
+    return batcher.submit(query)
+
+
+def embed_query(query: str, model: str = embedding_model):
+    """
+    Returns the embedding of a query, served from the query embedding cache when possible.
+    Misses for the same query share one in-flight call, and misses for different queries
+    are micro-batched into one embeddings request. Empty queries are rejected up front, since
+    the API would fail the whole batch they are in.
+    """
+    if not query or not query.strip():
+        raise ValueError("Cannot embed an empty query")
+    return query_embedding_cache.get_or_create(
+        query, model,
+        lambda text: query_embedding_flight.do(flight_key(model, text), batched_query_embedding, text, model)
+    )
+
+
 # search function
 def strings_ranked_by_relatedness(
         query: str,
         df: pd.DataFrame,
-        relatedness_fn=lambda x, y: 1 - spatial.distance.cosine(x, y),
+        relatedness_fn=None,
         top_n: int = 100
 ) -> tuple[list[str], list[float]]:
-    """Returns a list of strings and relatednesses, sorted from most related to least."""
+    """
+    Returns a list of strings and relatednesses, sorted from most related to least.
+    Uses the vectorized retrieval engine unless a custom relatedness_fn is given.
+    """
     if df.empty:
         log("DataFrame is empty. Cannot compute relatedness.")
         return [], []
 
-    query_embedding_response = OAI.client.embeddings.create(
-        model=embedding_model,
-        input=query,
-    )
-    query_embedding = query_embedding_response.data[0].embedding
+    query_embedding = embed_query(query)
+    if relatedness_fn is None:
+        return retrieval.engine_for(df).search(query_embedding, top_n=top_n)
+
     strings_and_relatednesses = [
         (row["text"], relatedness_fn(query_embedding, row["embedding"]))
         for i, row in df.iterrows()
     ]
     strings_and_relatednesses.sort(key=lambda x: x[1], reverse=True)
     strings, relatednesses = zip(*strings_and_relatednesses) if strings_and_relatednesses else ([], [])
-    return strings[:top_n], relatednesses[:top_n]
+    return list(strings[:top_n]), list(relatednesses[:top_n])
 
 
 def relatedness_score(text, _df):
@@ -105,13 +160,10 @@ def remove_stuff(text: str) -> str:
 def get_embedding(text_to_embed):
     text_to_embed = remove_stuff(text_to_embed)
     # Embed a line of text
-    response = OAI.client.embeddings.create(
-        model=embedding_model,
-        input=[text_to_embed]
-    )
+    response = resilience.create_embeddings(embedding_model, [text_to_embed])
     # Extract the AI output embedding as a list of floats
     embedding = response.data[0].embedding
-    print(f"---\nEmbedding: {embedding} \nText: {text_to_embed}")
+    config.debug("Embedded %d dimensions for text: %s", len(embedding), config.Preview(text_to_embed))
 
     return embedding
 
@@ -129,7 +181,9 @@ def create_embedding_df(excel_path, embedding_path):
     # Display the DataFrame with the concatenated column
     print(_df.head())
     # _df = _df.sample(10)
-    _df["embedding"] = _df["text"].astype(str).apply(get_embedding)
+    # Imported here because batch_embedding itself imports this module
+    from xyz.llm.batch_embedding import embed_texts
+    _df["embedding"] = embed_texts(_df["text"].astype(str).tolist())
     print(_df.head())
 
     _df.to_csv(embedding_path, index=False)
@@ -137,21 +191,46 @@ def create_embedding_df(excel_path, embedding_path):
 
 def num_tokens(text: str, model: str = OAI.gpt4o) -> int:
     """Return the number of tokens in a string."""
-    encoding = tiktoken.encoding_for_model(model)
+    encoding = context_packing.encoding_for(model)
     return len(encoding.encode(text))
 
 
+def ranked_documents(query: str, df: pd.DataFrame, top_n: int = 100) -> tuple[list[str], list[float], list]:
+    """Like strings_ranked_by_relatedness, plus each document's stored token count (None when unknown)."""
+    if df.empty:
+        log("DataFrame is empty. Cannot compute relatedness.")
+        return [], [], []
+    with metrics.stage("embedding"):
+        query_embedding = embed_query(query)
+    with metrics.stage("retrieval"):
+        return retrieval.engine_for(df).search_documents(query_embedding, top_n=top_n)
+
+
+def pack_query_message(query: str, df: pd.DataFrame, introduction: str, wrapper: tuple[str, str],
+                       model: str, token_budget: int, strategy: str) -> str:
+    """Builds introduction + packed documents + task, budgeting with cached per-document token counts."""
+    strings, relatednesses, token_counts = ranked_documents(query, df)
+    question = f"\n\nTask: {query}"
+    with metrics.stage("packing"):
+        selected = context_packing.pack_context(
+            strings, relatednesses, token_counts, token_budget, model,
+            fixed_text=introduction + question, wrapper=wrapper, strategy=strategy
+        )
+    articles = ''.join(f'{wrapper[0]}{strings[i]}{wrapper[1]}' for i in selected)
+    return introduction + articles + question
+
+
 def query_message(
         query: str,
         df: pd.DataFrame,
         model: str = OAI.gpt4o,
-        token_budget: int = 3000
+        token_budget: int = 3000,
+        strategy: str = config.Retrieval.packing_strategy
 ) -> str:
     """Return a message for GPT, with relevant source texts pulled from a dataframe."""
     if df.empty:
         return "DataFrame is empty. Cannot generate message."
 
-    strings, relatednesses = strings_ranked_by_relatedness(query, df)
     introduction = ("Refer to the documents provided below to answer the user's questions as accurately and "
                     "contextually as possible. If the documents do not contain a direct answer, use the information "
                     "within them to craft a thoughtful and relevant response. For documents such as cover letters or "
@@ -160,49 +239,29 @@ def query_message(
                     "If the user's question is unrelated to the documents, respond with a professional and "
                     "knowledgeable tone, aligning with the expertise of the persona you are representing. Strive to "
                     "provide clear, concise, and high-quality answers that reflect a deep understanding of the topic.")
-    question = f"\n\nTask: {query}"
-    message = introduction
-    for string in strings:
-        next_article = f'\n\nNext Document:\n"""\n{string}\n"""'
-        if (
-                num_tokens(message + next_article + question, model=model)
-                > token_budget
-        ):
-            break
-        else:
-            message += next_article
-    return message + question
+    wrapper = ('\n\nNext Document:\n"""\n', '\n"""')
+    return pack_query_message(query, df, introduction, wrapper, model, token_budget, strategy)
 
 
 def query_message_code(
         query: str,
         df: pd.DataFrame,
         model: str = OAI.gpt4o,
-        token_budget: int = 3000
+        token_budget: int = 3000,
+        strategy: str = config.Retrieval.packing_strategy
 ) -> str:
     """Return a message for GPT, with relevant source texts pulled from a dataframe."""
     if df.empty:
         return "DataFrame is empty. Cannot generate message."
 
-    strings, relatednesses = strings_ranked_by_relatedness(query, df)
     introduction = 'Use the Original Code Files provided below to answer the users questions about the code. ' \
                    'Based on the users input, Generate one single code that ' \
                    'implements an improvement upon the original code' \
                    'take into account the users input and the original code. ' \
                    'take care to ensure that the code is compatable with the original code. ' \
                    'Respond only with the code, do not include any additional information.'
-    question = f"\n\nTask: {query}"
-    message = introduction
-    for string in strings:
-        next_article = f'\n\nOriginal Code File:\n"""\n{string}\n"""'
-        if (
-                num_tokens(message + next_article + question, model=model)
-                > token_budget
-        ):
-            break
-        else:
-            message += next_article
-    return message + question
+    wrapper = ('\n\nOriginal Code File:\n"""\n', '\n"""')
+    return pack_query_message(query, df, introduction, wrapper, model, token_budget, strategy)
 
 
 def ask(
@@ -220,7 +279,7 @@ def ask(
         {"role": "system", "content": "You are a helpful assistant."},
         {"role": "user", "content": message},
     ]
-    response = OAI.client.chat.completions.create(
+    response = resilience.chat_completion(
         model=model,
         messages=messages,
         conversation_id=conversation_id,
@@ -252,7 +311,7 @@ def ask_familiar(
                                       "too much information without being prompted to do so."},
         {"role": "user", "content": message},
     ]
-    response = OAI.client.chat.completions.create(
+    response = resilience.chat_completion(
         model=model,
         messages=messages,
         conversation_id=conversation_id,
@@ -277,7 +336,7 @@ def ask_code(
                                       "and fully Implement New Code if possible"},
         {"role": "user", "content": message},
     ]
-    response = OAI.client.chat.completions.create(
+    response = resilience.chat_completion(
         model=model,
         messages=messages,
         temperature=0
@@ -0,0 +1,180 @@
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import time
+
+import numpy as np
+import pandas as pd
+
+import config
+from xyz.llm import retrieval, vector_index
+from xyz.llm.embedding_model import embedding_model, read_embedding
+
+log = config.log
+Retrieval = config.Retrieval
+
+# A store is a directory holding three files:
+#   manifest.json  - model name, dimension, row count, dtype and a content version
+#   vectors.bin    - raw row-major, L2-normalized float32/float16 vectors, memory-mapped on load
+#   metadata.csv   - one row per vector with the text, filepath and any other non-vector columns
+#   index.npz      - search index built at ingest time (see vector_index), loaded at startup
+MANIFEST_FILE = "manifest.json"
+VECTORS_FILE = "vectors.bin"
+METADATA_FILE = "metadata.csv"
+INDEX_FILE = "index.npz"
+FORMAT_VERSION = 1
+SUPPORTED_DTYPES = ("float32", "float16")
+
+
+def is_store(path) -> bool:
+    """Returns True if the path is a store directory."""
+    return os.path.isfile(os.path.join(path, MANIFEST_FILE))
+
+
+def read_manifest(path) -> dict:
+    with open(os.path.join(path, MANIFEST_FILE), 'r', encoding='utf-8') as file:
+        return json.load(file)
+
+
+def source_version(store_path, csv_path=None):
+    """
+    Cheap version check of what load_embeddings would load: the manifest version of the
+    store, else the CSV's modification time and size; None while neither exists (e.g. in the
+    middle of a store swap).
+    """
+    try:
+        return read_manifest(store_path)["version"]
+    except (OSError, ValueError, KeyError):
+        pass
+    if os.path.exists(f"{os.path.normpath(store_path)}.old"):
+        return None  # store directory is being replaced
+    if csv_path and os.path.isfile(csv_path):
+        stat = os.stat(csv_path)
+        return f"csv-{stat.st_mtime_ns}-{stat.st_size}"
+    return None
+
+
+def save_store(df: pd.DataFrame, path, model: str = embedding_model, dtype: str = Retrieval.store_dtype,
+               index_type: str = Retrieval.index_type):
+    """
+    Writes a DataFrame with 'text' and 'embedding' columns to a store directory and builds
+    its search index. Rows without an embedding are dropped. The directory is replaced
+    atomically, so workers that already mapped the old files keep reading them until they reload.
+    """
+    if dtype not in SUPPORTED_DTYPES:
+        raise ValueError(f"Unsupported store dtype {dtype!r}, expected one of {SUPPORTED_DTYPES}")
+
+    df = df[df["embedding"].notna()].reset_index(drop=True)
+    if df.empty:
+        raise ValueError("No embeddings to store.")
+
+    matrix = vector_index.normalize_rows(np.stack(df["embedding"].to_numpy()).astype(np.float32))
+    matrix = np.ascontiguousarray(matrix, dtype=dtype)
+    metadata = df.drop(columns=["embedding"])
+
+    tmp_path = f"{os.path.normpath(path)}.tmp"
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+
+    matrix.tofile(os.path.join(tmp_path, VECTORS_FILE))
+    metadata.to_csv(os.path.join(tmp_path, METADATA_FILE), index=False)
+    index = vector_index.build_index(matrix, kind=index_type)
+    index.save(os.path.join(tmp_path, INDEX_FILE))
+
+    digest = hashlib.sha1(matrix.tobytes())
+    with open(os.path.join(tmp_path, METADATA_FILE), 'rb') as file:
+        digest.update(file.read())
+    manifest = {
+        "format_version": FORMAT_VERSION,
+        "model": model,
+        "dimension": int(matrix.shape[1]),
+        "count": int(matrix.shape[0]),
+        "dtype": dtype,
+        "normalized": True,
+        "index": index.kind,
+        "version": digest.hexdigest()[:16],
+        "created_at": time.time(),
+    }
+    with open(os.path.join(tmp_path, MANIFEST_FILE), 'w', encoding='utf-8') as file:
+        json.dump(manifest, file, indent=2)
+
+    _replace_dir(tmp_path, path)
+    log(f"Saved {manifest['count']} x {manifest['dimension']} {dtype} vectors to {path}")
+    return manifest
+
+
+def _replace_dir(src, dst):
+    old_path = f"{os.path.normpath(dst)}.old"
+    shutil.rmtree(old_path, ignore_errors=True)
+    if os.path.exists(dst):
+        os.replace(dst, old_path)
+    os.replace(src, dst)
+    shutil.rmtree(old_path, ignore_errors=True)
+
+
+def load_store(path) -> pd.DataFrame:
+    """
+    Loads a store directory as a DataFrame of metadata columns. The vectors stay memory-mapped
+    and are registered with the retrieval engine, so they are never parsed or copied per worker.
+    """
+    manifest = read_manifest(path)
+    if manifest.get("format_version") != FORMAT_VERSION:
+        raise ValueError(f"Unsupported store format version: {manifest.get('format_version')}")
+
+    vectors = np.memmap(
+        os.path.join(path, VECTORS_FILE),
+        dtype=manifest["dtype"],
+        mode='r',
+        shape=(manifest["count"], manifest["dimension"])
+    )
+    df = pd.read_csv(os.path.join(path, METADATA_FILE), dtype={"text": str, "filepath": str})
+    df["text"] = df["text"].fillna("")
+    if len(df) != manifest["count"]:
+        raise ValueError(f"Store {path} is inconsistent: {len(df)} metadata rows, {manifest['count']} vectors")
+
+    df.attrs["model"] = manifest["model"]
+    df.attrs["kb_version"] = manifest["version"]
+    index_path = os.path.join(path, INDEX_FILE)
+    index = vector_index.load_index(index_path) if os.path.isfile(index_path) else None
+    token_counts = df["token_count"] if "token_count" in df else None
+    retrieval.register(df, retrieval.RetrievalEngine(df["text"], vectors, normalized=True, index=index,
+                                                     token_counts=token_counts))
+    return df
+
+
+def read_store_embeddings(path) -> pd.DataFrame:
+    """Reads a store back into a DataFrame with an 'embedding' column, e.g. to merge in new rows."""
+    df = load_store(path)
+    vectors = retrieval.engine_for(df).matrix
+    df = df.copy()
+    df["embedding"] = list(np.asarray(vectors, dtype=np.float32))
+    return df
+
+
+def load_embeddings(store_path=Retrieval.store_path, csv_path=Retrieval.csv_path) -> pd.DataFrame:
+    """Loads the binary store if it exists, otherwise falls back to parsing the CSV."""
+    if is_store(store_path):
+        return load_store(store_path)
+    log(f"No embedding store at {store_path}, parsing {csv_path}. "
+        f"Run `python -m xyz.llm.embedding_store {csv_path} {store_path}` to convert it.")
+    return read_embedding(csv_path)
+
+
+def convert_csv(csv_path, store_path, model: str = embedding_model, dtype: str = Retrieval.store_dtype,
+                index_type: str = Retrieval.index_type):
+    """One-shot conversion of a CSV written by embedding_generator.save_embeddings into a store."""
+    df = read_embedding(csv_path)
+    return save_store(df, store_path, model=model, dtype=dtype, index_type=index_type)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Convert an embeddings CSV into a memory-mapped store.")
+    parser.add_argument("csv_path")
+    parser.add_argument("store_path")
+    parser.add_argument("--model", default=embedding_model)
+    parser.add_argument("--dtype", default=Retrieval.store_dtype, choices=SUPPORTED_DTYPES)
+    parser.add_argument("--index", default=Retrieval.index_type, choices=list(vector_index.INDEX_TYPES))
+    args = parser.parse_args()
+    convert_csv(args.csv_path, args.store_path, model=args.model, dtype=args.dtype, index_type=args.index)
@@ -0,0 +1,81 @@
+import sys
+import threading
+
+
+def eventlet_active() -> bool:
+    """True when the process runs under eventlet's monkey patching (the gunicorn/socketio workers)."""
+    if 'eventlet' not in sys.modules:
+        return False
+    from eventlet import patcher
+    return patcher.is_monkey_patched('socket')
+
+
+def spawn(fn, *args, **kwargs):
+    """
+    Runs fn in the background without blocking the caller: as an eventlet green thread inside
+    the web workers, or as a daemon thread in plain scripts.
+    """
+    if eventlet_active():
+        import eventlet
+        eventlet.spawn_n(fn, *args, **kwargs)
+    else:
+        threading.Thread(target=fn, args=args, kwargs=kwargs, daemon=True).start()
+
+
+def run_in_thread(fn, *args, **kwargs):
+    """
+    Calls fn on a real OS thread and returns its result. Under eventlet this keeps long
+    blocking work (loading files, building indexes) from stalling every other green thread
+    in the worker; in plain scripts fn is simply called.
+    """
+    if eventlet_active():
+        from eventlet import tpool
+        return tpool.execute(fn, *args, **kwargs)
+    return fn(*args, **kwargs)
+
+
+class Event:
+    """
+    One-shot event. Under eventlet only the waiting green thread is suspended (a plain
+    threading.Event would block the whole hub, since threads are not monkey patched); in
+    plain scripts it is a threading.Event.
+    """
+
+    def __init__(self):
+        if eventlet_active():
+            from eventlet.event import Event as GreenEvent
+            self._green = GreenEvent()
+            self._thread = None
+        else:
+            self._green = None
+            self._thread = threading.Event()
+
+    def is_set(self) -> bool:
+        return self._green.ready() if self._green is not None else self._thread.is_set()
+
+    def set(self):
+        if self._green is None:
+            self._thread.set()
+        elif not self._green.ready():
+            self._green.send(True)
+
+    def wait(self, timeout: float = None) -> bool:
+        """Waits until set() is called; returns False if timeout seconds passed first."""
+        if self._green is None:
+            return self._thread.wait(timeout)
+        self._green.wait(timeout)
+        return self._green.ready()
+
+
+def patch_httpcore():
+    """
+    Makes httpcore's connection pool locks green. Threads are not monkey patched in the web
+    workers, so the pool would otherwise guard its state with real locks shared by green
+    threads: one green thread waiting for a connection blocks the hub, and the one holding it
+    never runs again to release it.
+    """
+    if not eventlet_active():
+        return
+    import httpcore._synchronization
+    from eventlet.green import threading as green_threading
+    httpcore._synchronization.threading = green_threading
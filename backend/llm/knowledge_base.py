@@ -0,0 +1,198 @@
+import contextlib
+import os
+import threading
+import time
+
+import config
+from xyz.llm import embedding_store, green, retrieval
+
+log = config.log
+Retrieval = config.Retrieval
+
+
+class Version:
+    """One loaded knowledge base: its DataFrame (with retrieval engine) and the requests using it."""
+
+    def __init__(self, df, source_version: str):
+        self.df = df
+        self.source_version = source_version
+        # Approximate memory held: metadata frame plus vectors (mapped pages count once resident)
+        self.nbytes = int(df.memory_usage(deep=True).sum()) + int(retrieval.engine_for(df).matrix.nbytes)
+        self.loaded_at = time.time()
+        self.refs = 0
+        self.retired = False
+
+
+class KnowledgeBase:
+    """
+    Versioned, hot-reloadable handle on the embedding store. Requests take the current version
+    with acquire() and keep it until they finish, even if a newer one is swapped in meanwhile.
+    A reload loads the new version and builds its retrieval engine on a background OS thread,
+    then swaps it in atomically; the old version is released once its last request is done.
+
+    Workers converge without talking to each other: each polls the store's manifest version
+    (a tiny file) every `interval` seconds and reloads when it differs from what it serves,
+    so once a new store is published every worker serves it within one interval. reload()
+    (the admin route) only makes the worker that received it check right away.
+    """
+
+    def __init__(self, store_path: str = Retrieval.store_path, csv_path: str = Retrieval.csv_path,
+                 interval: float = Retrieval.reload_interval, on_swap=None):
+        self.store_path = store_path
+        self.csv_path = csv_path
+        self.interval = interval
+        self.on_swap = on_swap  # called with the new and old DataFrame after a swap
+        self._current = None
+        self._retired = []  # replaced versions still used by running requests
+        self._lock = threading.Lock()  # never held across I/O or green thread switches
+        self._reloading = False
+        self._loading = None  # set while a first load runs, for concurrent requests to wait on
+        self._watching = None  # pid of the process running the watcher
+        self.stats_counts = {"loads": 0, "reloads": 0, "failed_reloads": 0}
+
+    def _load(self) -> Version:
+        # Re-read the version after loading: a store swapped underneath is loaded again
+        for _ in range(3):
+            before = embedding_store.source_version(self.store_path, self.csv_path)
+            df = embedding_store.load_embeddings(self.store_path, self.csv_path)
+            retrieval.engine_for(df)  # build (or look up) the search index before serving it
+            if before is not None and before == embedding_store.source_version(self.store_path, self.csv_path):
+                break
+            time.sleep(0.5)
+        self.stats_counts["loads"] += 1
+        return Version(df, before)
+
+    def _version(self, in_thread: bool = True) -> Version:
+        if self._current is not None:
+            return self._current
+        # First use: one caller loads (on an OS thread unless told otherwise), the others wait for it
+        with self._lock:
+            loading = self._loading
+            first = loading is None
+            if first:
+                loading = self._loading = green.Event()
+        if not first:
+            loading.wait()
+            if self._current is None:
+                raise RuntimeError(f"Knowledge base {self.store_path} failed to load")
+            return self._current
+        try:
+            version = green.run_in_thread(self._load) if in_thread else self._load()
+            with self._lock:
+                if self._current is None:
+                    self._current = version
+            return self._current
+        finally:
+            with self._lock:
+                self._loading = None
+            loading.set()
+
+    def current(self):
+        """
+        The DataFrame of the current version, without holding it. Loads in the calling thread,
+        so it is safe in a gunicorn master before fork (OS threads would not survive it).
+        """
+        return self._version(in_thread=False).df
+
+    @property
+    def loaded(self) -> bool:
+        return self._current is not None
+
+    @property
+    def nbytes(self) -> int:
+        current = self._current
+        return current.nbytes if current else 0
+
+    def in_use(self) -> bool:
+        current = self._current
+        return bool(current and current.refs)
+
+    def unload(self):
+        """Drops the current version to free its memory; running requests keep it until they finish."""
+        with self._lock:
+            old, self._current = self._current, None
+            if old is not None and old.refs:
+                old.retired = True
+                self._retired.append(old)
+
+    @property
+    def source_version(self):
+        return self._current.source_version if self._current else None
+
+    @contextlib.contextmanager
+    def acquire(self):
+        """Holds the current version for the duration of a request; yields its DataFrame."""
+        version = self._version()
+        with self._lock:
+            version.refs += 1
+        try:
+            yield version.df
+        finally:
+            with self._lock:
+                version.refs -= 1
+                released = version.retired and version.refs == 0
+                if released:
+                    self._retired.remove(version)
+            if released:
+                log(f"Knowledge base {version.source_version} released by its last request")
+
+    def reload(self, force: bool = False) -> bool:
+        """
+        Loads and swaps in the store if its version changed (or always with force). Returns True
+        if a new version was swapped in. Concurrent calls while a reload runs return False.
+        """
+        if self._current is None and not force:
+            return False  # not loaded (or unloaded): the next request loads the latest version anyway
+        on_disk = embedding_store.source_version(self.store_path, self.csv_path)
+        if on_disk is None or (not force and on_disk == self.source_version):
+            return False
+        with self._lock:
+            if self._reloading:
+                return False
+            self._reloading = True
+        try:
+            started = time.perf_counter()
+            new = green.run_in_thread(self._load)
+            with self._lock:
+                old, self._current = self._current, new
+                if old is not None and old.refs:
+                    old.retired = True
+                    self._retired.append(old)
+            self.stats_counts["reloads"] += 1
+            log(f"Knowledge base reloaded: {old.source_version if old else None} -> {new.source_version} "
+                f"({len(new.df)} rows, {time.perf_counter() - started:.2f}s)")
+            if self.on_swap and old is not None:
+                self.on_swap(new.df, old.df)
+            return True
+        except Exception as e:
+            self.stats_counts["failed_reloads"] += 1
+            log(f"Knowledge base reload failed, still serving {self.source_version}: {e}")
+            return False
+        finally:
+            with self._lock:
+                self._reloading = False
+
+    def _watch(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.reload()
+            except Exception as e:
+                log(f"Knowledge base watcher error: {e}")
+
+    def watch(self):
+        """Starts polling the store for new versions in the background (once per process)."""
+        with self._lock:
+            if self._watching == os.getpid() or self.interval <= 0:
+                return
+            self._watching = os.getpid()
+        green.spawn(self._watch)
+
+    def stats(self) -> dict:
+        with self._lock:
+            current = self._current
+            return dict(self.stats_counts,
+                        rows=len(current.df) if current else 0,
+                        requests_on_current=current.refs if current else 0,
+                        retired_in_use=len(self._retired),
+                        requests_on_retired=sum(version.refs for version in self._retired))
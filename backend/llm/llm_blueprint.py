@@ -1,14 +1,13 @@
 import PyPDF2
 import config
 from flask import Blueprint
+from xyz.llm import resilience
 
 OAI = config.OAI
+Preview = config.Preview
 
 oai = Blueprint('oai', __name__, template_folder='templates')
 
-openai_client = OAI.client
-
-
 def init_app(app):
     app.register_blueprint(oai, url_prefix='/openai')
 
@@ -21,7 +20,7 @@ def chat_completion(user_input, system_input="you are a helpful assistant", imag
             {"role": "system", "content": system_input},
             {"role": "user", "content": user_input}
         ]
-        completion = openai_client.chat.completions.create(
+        completion = resilience.chat_completion(
             model="gpt-4o",
             messages=messages,
             stream=streaming
@@ -34,7 +33,7 @@ def chat_completion(user_input, system_input="you are a helpful assistant", imag
                 {"type": "text", "text": user_input}
             ]}
         ]
-        completion = openai_client.chat.completions.create(
+        completion = resilience.chat_completion(
             model="gpt-4o",
             messages=messages,
             tools=tools,
@@ -43,21 +42,20 @@ def chat_completion(user_input, system_input="you are a helpful assistant", imag
         )
     if not streaming:
         output = completion.choices[0].message.content
-        print(output)
+        config.debug("Chat output: %s", Preview(output))
         return output
     else:
         output = ""
         for chunk in completion:
             output += str(chunk.choices[0].delta.content)
-            print(chunk.choices[0].delta.content)
-        print(output)
+        config.debug("Chat output: %s", Preview(output))
         return output
 
 
 @oai.route('/tts', methods=['POST'])
 def text_to_speech(text, file_name="speech"):
     speech_file_path = f"static/audio/{file_name}.mp3"
-    response = openai_client.audio.speech.create(
+    response = resilience.create_speech(
         model="tts-1",
         voice="onyx",
         input=f"{text}",
@@ -0,0 +1,198 @@
+import bisect
+import contextlib
+import math
+import threading
+import time
+
+import config
+
+Metrics = config.Metrics
+
+QUANTILES = (0.5, 0.95, 0.99)
+
+
+def _label_text(labels: tuple) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in labels) + "}"
+
+
+class Histogram:
+    """Cumulative-bucket latency histogram per label set, Prometheus style."""
+
+    def __init__(self, name: str, help_text: str, buckets=Metrics.buckets):
+        self.name = name
+        self.help = help_text
+        self.buckets = tuple(buckets)
+        self._series = {}  # labels -> [bucket counts..., +Inf count], sum
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            counts, total = self._series.get(key, ([0] * (len(self.buckets) + 1), 0.0))
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            self._series[key] = (counts, total + value)
+
+    def quantile(self, q: float, **labels):
+        """Estimates a quantile by linear interpolation inside the bucket that contains it."""
+        counts, _ = self._series.get(tuple(sorted(labels.items())), (None, 0))
+        return self._quantile(counts, q) if counts else None
+
+    def _quantile(self, counts, q):
+        total = sum(counts)
+        if not total:
+            return None
+        rank = q * total
+        seen = 0
+        for i, count in enumerate(counts):
+            if seen + count >= rank and count:
+                if i == len(self.buckets):
+                    return self.buckets[-1]  # above the largest bound: report the bound
+                lower = self.buckets[i - 1] if i else 0.0
+                return lower + (self.buckets[i] - lower) * (rank - seen) / count
+            seen += count
+        return self.buckets[-1]
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        quantile_lines = []
+        with self._lock:
+            series = {key: (list(counts), total) for key, (counts, total) in self._series.items()}
+        for labels, (counts, total) in sorted(series.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), counts):
+                cumulative += count
+                le = "+Inf" if bound == math.inf else repr(float(bound))
+                lines.append(f"{self.name}_bucket{_label_text(labels + (('le', le),))} {cumulative}")
+            lines.append(f"{self.name}_sum{_label_text(labels)} {total}")
+            lines.append(f"{self.name}_count{_label_text(labels)} {cumulative}")
+            for q in QUANTILES:
+                quantile_lines.append(
+                    f"{self.name}_quantile{_label_text(labels + (('quantile', str(q)),))} {self._quantile(counts, q)}"
+                )
+        if quantile_lines:
+            lines += [f"# HELP {self.name}_quantile {self.help} (p50/p95/p99 estimated from the buckets)",
+                      f"# TYPE {self.name}_quantile gauge"] + quantile_lines
+        return lines
+
+
+class Counter:
+    def __init__(self, name: str, help_text: str):
+        self.name = name
+        self.help = help_text
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._series[key] = self._series.get(key, 0) + amount
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            series = dict(self._series)
+        lines += [f"{self.name}{_label_text(labels)} {value}" for labels, value in sorted(series.items())]
+        return lines
+
+
+stage_seconds = Histogram("chat_stage_seconds", "Time spent in each stage of answering a chat message")
+request_seconds = Histogram("http_request_seconds", "Request handling time by endpoint")
+upstream_seconds = Histogram("upstream_call_seconds", "Latency of upstream API calls by operation")
+llm_tokens = Counter("llm_tokens_total", "Tokens used by model and kind (prompt/completion)")
+llm_cost = Counter("llm_cost_usd_total", "Estimated spend in USD by model")
+
+_collectors = []  # (prefix, label name, fn returning {name: number} or {label value: {name: number}})
+
+
+def register_gauges(prefix: str, fn, label: str = None):
+    """Adds gauges read at scrape time from fn(), e.g. cache stats() dictionaries."""
+    _collectors.append((prefix, label, fn))
+
+
+def _price(model: str):
+    # Dated snapshots ('gpt-4o-2024-08-06') are priced like their base model; longest name wins
+    for name in sorted(Metrics.prices, key=len, reverse=True):
+        if model.startswith(name):
+            return Metrics.prices[name]
+    return None
+
+
+def record_usage(model: str, usage):
+    """Counts the tokens and estimated cost of one response's `usage` block."""
+    if usage is None:
+        return
+    prompt = getattr(usage, "prompt_tokens", 0) or 0
+    completion = getattr(usage, "completion_tokens", 0) or 0
+    llm_tokens.inc(prompt, model=model, kind="prompt")
+    if completion:
+        llm_tokens.inc(completion, model=model, kind="completion")
+    price = _price(model)
+    if price is not None:
+        llm_cost.inc((prompt * price[0] + completion * price[1]) / 1e6, model=model)
+
+
+def _request_timings():
+    """Per-request list of (stage, seconds) for the Server-Timing header, when inside a Flask request."""
+    try:
+        from flask import g, has_request_context
+    except ImportError:
+        return None
+    if not has_request_context():
+        return None
+    if "stage_timings" not in g:
+        g.stage_timings = []
+    return g.stage_timings
+
+
+def observe_stage(name: str, seconds: float):
+    stage_seconds.observe(seconds, stage=name)
+    timings = _request_timings()
+    if timings is not None:
+        timings.append((name, seconds))
+
+
+@contextlib.contextmanager
+def stage(name: str):
+    """Times a block as one stage of a chat request."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe_stage(name, time.perf_counter() - started)
+
+
+def server_timing_header() -> str:
+    """Server-Timing value of the current request, e.g. 'embedding;dur=41.2, completion;dur=812.0'."""
+    timings = _request_timings() or []
+    totals = {}
+    for name, seconds in timings:
+        totals[name] = totals.get(name, 0.0) + seconds
+    return ", ".join(f"{name};dur={seconds * 1000:.1f}" for name, seconds in totals.items())
+
+
+def _gauge_lines():
+    lines = []
+    for prefix, label, fn in _collectors:
+        try:
+            values = fn()
+        except Exception:
+            continue
+        for key, value in sorted(values.items()):
+            if isinstance(value, dict) and label:
+                for name, number in sorted(value.items()):
+                    if isinstance(number, (int, float)) and not isinstance(number, bool):
+                        lines.append(f'{prefix}_{name}{{{label}="{key}"}} {number}')
+            elif isinstance(value, (int, float)) and not isinstance(value, bool):
+                lines.append(f"{prefix}_{key} {value}")
+    return lines
+
+
+def render() -> str:
+    """All metrics in the Prometheus text exposition format."""
+    lines = []
+    for metric in (stage_seconds, request_seconds, upstream_seconds, llm_tokens, llm_cost):
+        lines += metric.render()
+    lines += _gauge_lines()
+    return "\n".join(lines) + "\n"
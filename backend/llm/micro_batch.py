@@ -0,0 +1,101 @@
+import threading
+
+from xyz.llm import green
+
+
+class Batch:
+    def __init__(self):
+        self.items = []
+        self.results = None
+        self.error = None
+        self.errors = None  # per-item errors when the items were retried one by one
+        self.done = green.Event()
+
+
+class MicroBatcher:
+    """
+    Collects concurrent single-item calls into one call of batch_fn(items) -> results (same
+    order). The first caller of a batch waits `window` seconds for others to join, unless
+    max_batch items arrive first, in which case the caller that filled it sends it at once.
+    Every caller then gets its own result, or the batch's exception. When isolate(exception)
+    is true for a failed batch (an error caused by some item's input), the items are retried
+    one at a time, so only the callers of the bad items fail. Waiting uses green.Event, so it
+    is safe under eventlet.
+    """
+
+    def __init__(self, batch_fn, window: float, max_batch: int, timeout: float = None, isolate=None):
+        self.batch_fn = batch_fn
+        self.window = window
+        self.max_batch = max_batch
+        self.timeout = timeout
+        self.isolate = isolate
+        self._current = None
+        self._lock = threading.Lock()
+        self.batches = 0
+        self.items = 0
+        self.isolated = 0
+
+    def submit(self, item):
+        with self._lock:
+            batch = self._current
+            leader = batch is None
+            if leader:
+                batch = self._current = Batch()
+            index = len(batch.items)
+            batch.items.append(item)
+            full = len(batch.items) >= self.max_batch
+            if full:
+                self._current = None
+
+        if full:
+            self._run(batch)
+        elif leader and not batch.done.wait(self.window):
+            # Window over and nobody filled the batch: send what there is
+            with self._lock:
+                send = self._current is batch
+                if send:
+                    self._current = None
+            if send:
+                self._run(batch)
+
+        if not batch.done.wait(self.timeout):
+            raise TimeoutError("Timed out waiting for batched call")
+        if batch.error is not None:
+            raise batch.error
+        if batch.errors is not None and batch.errors[index] is not None:
+            raise batch.errors[index]
+        return batch.results[index]
+
+    def _call(self, items):
+        results = self.batch_fn(items)
+        if len(results) != len(items):
+            raise ValueError(f"Batch call returned {len(results)} results for {len(items)} items")
+        return results
+
+    def _run(self, batch):
+        try:
+            batch.results = self._call(batch.items)
+        except Exception as e:
+            if len(batch.items) > 1 and self.isolate is not None and self.isolate(e):
+                self._run_isolated(batch)
+            else:
+                batch.error = e
+        finally:
+            self.batches += 1
+            self.items += len(batch.items)
+            batch.done.set()
+
+    def _run_isolated(self, batch):
+        self.isolated += 1
+        batch.results, batch.errors = [], []
+        for item in batch.items:
+            try:
+                batch.results.append(self._call([item])[0])
+                batch.errors.append(None)
+            except Exception as e:
+                batch.results.append(None)
+                batch.errors.append(e)
+
+    def stats(self) -> dict:
+        return {"batches": self.batches, "items": self.items, "isolated_batches": self.isolated,
+                "mean_batch_size": self.items / self.batches if self.batches else 0.0}
@@ -0,0 +1,141 @@
+import atexit
+import collections
+import random
+import threading
+import time
+
+import config
+from xyz.llm import green, metrics
+
+log = config.log
+Notifications = config.Notifications
+
+
+class NotificationQueue:
+    """
+    Bounded, in-process queue of notification texts drained by one background worker, so
+    sending never happens on the request path. Every `interval` seconds the worker joins up to
+    max_batch queued texts into one message and hands it to `send`, retrying failures with
+    jittered exponential backoff. Under backpressure interactions are sampled once the queue is
+    `sample_above` full and dropped when it is full; the next message reports how many were skipped.
+    """
+
+    def __init__(self, send, interval: float = Notifications.interval, maxsize: int = Notifications.queue_size,
+                 max_batch: int = Notifications.max_batch, max_retries: int = Notifications.max_retries,
+                 sample_above: float = Notifications.sample_above, sample_every: int = Notifications.sample_every,
+                 max_chars: int = Notifications.max_message_chars):
+        self.send = send
+        self.interval = interval
+        self.maxsize = maxsize
+        self.max_batch = max_batch
+        self.max_retries = max_retries
+        self.sample_above = sample_above
+        self.sample_every = sample_every
+        self.max_chars = max_chars
+        self._queue = collections.deque()
+        self._lock = threading.Lock()
+        self._started = False
+        self._offered = 0  # submissions seen while sampling, to keep every n-th
+        self._skipped = 0  # dropped or sampled out since the last message
+        self.stats = {"queued": 0, "sent": 0, "dropped": 0, "sampled_out": 0, "failed": 0}
+
+    def submit(self, text: str) -> bool:
+        """Queues a notification without blocking; returns False if it was dropped or sampled out."""
+        with self._lock:
+            if len(self._queue) >= self.maxsize:
+                self._skipped += 1
+                self.stats["dropped"] += 1
+                return False
+            if len(self._queue) >= self.maxsize * self.sample_above:
+                self._offered += 1
+                if self._offered % self.sample_every:
+                    self._skipped += 1
+                    self.stats["sampled_out"] += 1
+                    return False
+            self._queue.append(text)
+            self.stats["queued"] += 1
+            if not self._started:
+                self._started = True
+                green.spawn(self._run)
+        return True
+
+    def _take_batch(self):
+        with self._lock:
+            batch = [self._queue.popleft() for _ in range(min(self.max_batch, len(self._queue)))]
+            skipped, self._skipped = self._skipped, 0
+            if len(self._queue) < self.maxsize * self.sample_above:
+                self._offered = 0
+        return batch, skipped
+
+    def _format(self, batch, skipped):
+        message = "\n\n".join(batch)
+        if skipped:
+            message += f"\n\n({skipped} more interactions skipped under load)"
+        if len(message) > self.max_chars:
+            message = message[:self.max_chars - 3] + "..."
+        return message
+
+    def _send_with_retry(self, message):
+        for attempt in range(self.max_retries + 1):
+            started = time.perf_counter()
+            try:
+                self.send(message)
+                metrics.upstream_seconds.observe(time.perf_counter() - started, operation="telegram")
+                return True
+            except Exception as e:
+                if attempt == self.max_retries:
+                    log(f"Notification failed after {attempt + 1} attempts, dropping it: {e}")
+                    return False
+                time.sleep(min(30.0, 2 ** attempt) * (0.5 + random.random() / 2))
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.flush()
+            except Exception as e:
+                log(f"Notification worker error: {e}")
+
+    def flush(self):
+        """Sends everything queued now, one message per max_batch interactions."""
+        while True:
+            batch, skipped = self._take_batch()
+            if not batch and not skipped:
+                return
+            ok = self._send_with_retry(self._format(batch, skipped))
+            self.stats["sent" if ok else "failed"] += len(batch)
+
+
+def format_interaction(conversation_id: str, user_input: str, output: str) -> str:
+    """Formats one chat exchange for the Telegram interaction log."""
+    truncated_output = output[:150]  # Limit the output to the first 150 characters
+    return (
+        f"🤖 Chatbot Interaction Log\n\n"
+        f"Conversation ID: `{conversation_id}`\n\n"
+        f"User Input:\n{user_input}\n\n"
+        f"Bot Output :\n{truncated_output}..."
+    )
+
+
+_telegram_queue = None
+
+
+def telegram_queue() -> NotificationQueue:
+    """The process-wide queue in front of send_telegram_message, created on first use."""
+    global _telegram_queue
+    if _telegram_queue is None:
+        from xyz.llm.tools.telegram_update import send_telegram_message
+        _telegram_queue = NotificationQueue(send_telegram_message)
+        atexit.register(_telegram_queue.flush)
+    return _telegram_queue
+
+
+def queue_stats() -> dict:
+    return dict(_telegram_queue.stats, queued_now=len(_telegram_queue._queue)) if _telegram_queue else {}
+
+
+def notify_interaction(conversation_id: str, user_input: str, output: str) -> bool:
+    """Queues a finished exchange for the Telegram log. Never blocks on Telegram."""
+    if not Notifications.enabled:
+        return False
+    return telegram_queue().submit(format_interaction(conversation_id, user_input, output))
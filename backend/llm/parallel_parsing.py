@@ -0,0 +1,144 @@
+import os
+import time
+import traceback
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+
+import config
+
+log = config.log
+Ingestion = config.Ingestion
+
+
+class ParseResult:
+    def __init__(self, index: int, file_path: str, value=None, error: str = None):
+        self.index = index  # position of the file in the input
+        self.file_path = file_path
+        self.value = value
+        self.error = error
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+
+def _parse(reader, file_path):
+    # Runs in a worker process. Errors come back as text: exceptions of parser libraries
+    # are not always picklable, and one bad file must not fail the others
+    try:
+        return reader(file_path), None
+    except Exception as e:
+        return None, f"{type(e).__name__}: {e}"
+
+
+def default_workers() -> int:
+    return Ingestion.parse_workers or os.cpu_count() or 1
+
+
+class ParsePool:
+    """
+    Parses documents with `reader(file_path)` in a pool of worker processes, yielding a
+    ParseResult per file as soon as it is done (not in input order). At most one file per
+    worker is in flight, and paths are pulled from the input lazily, so memory stays bounded
+    for any number of files. A file that takes longer than `timeout` seconds gets a timeout
+    error and the pool is restarted, since a stuck parser cannot be interrupted; the other
+    in-flight files are resubmitted. When a worker crashes, the files that were in flight are
+    retried one at a time to find the one that caused it.
+    """
+
+    def __init__(self, reader, workers: int = None, timeout: float = Ingestion.parse_timeout):
+        self.reader = reader
+        self.workers = workers or default_workers()
+        self.timeout = timeout
+        self._executor = None
+
+    def _start(self):
+        self._executor = ProcessPoolExecutor(max_workers=self.workers)
+
+    def _stop(self):
+        # ProcessPoolExecutor cannot cancel a running task, so stop its workers directly
+        for process in list((self._executor._processes or {}).values()):
+            process.terminate()
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def _restart(self):
+        self._stop()
+        self._start()
+
+    def _submit(self, pending, index, file_path, isolated=False):
+        future = self._executor.submit(_parse, self.reader, file_path)
+        pending[future] = (index, file_path, isolated, time.monotonic() + self.timeout)
+
+    def imap(self, file_paths):
+        if self.workers <= 1:
+            # In-process, for debugging and tiny inputs: no isolation and no timeouts
+            for index, file_path in enumerate(file_paths):
+                value, error = _parse(self.reader, file_path)
+                yield ParseResult(index, file_path, value, error)
+            return
+
+        paths = enumerate(file_paths)
+        pending = {}
+        suspects = []  # files in flight when a worker crashed, retried one at a time
+        self._start()
+        try:
+            exhausted = False
+            while True:
+                if suspects:
+                    if not pending:
+                        self._submit(pending, *suspects.pop(0), isolated=True)
+                else:
+                    while not exhausted and len(pending) < self.workers:
+                        item = next(paths, None)
+                        if item is None:
+                            exhausted = True
+                        else:
+                            self._submit(pending, *item)
+                if not pending:
+                    return
+
+                next_deadline = min(deadline for *_, deadline in pending.values())
+                done, _ = wait(pending, timeout=max(0.0, next_deadline - time.monotonic()),
+                               return_when=FIRST_COMPLETED)
+                crashed = False
+                for future in done:
+                    index, file_path, isolated, _ = pending.pop(future)
+                    try:
+                        value, error = future.result()
+                    except BrokenProcessPool:
+                        crashed = True
+                        if not isolated:
+                            suspects.append((index, file_path))
+                            continue
+                        log(f"Worker process crashed while parsing {file_path}")
+                        value, error = None, "Worker process crashed"
+                    except Exception:
+                        value, error = None, traceback.format_exc(limit=1)
+                    yield ParseResult(index, file_path, value, error)
+
+                now = time.monotonic()
+                expired = [future for future, (*_, deadline) in pending.items() if deadline <= now]
+                if not expired and not crashed:
+                    continue
+
+                for future in expired:
+                    index, file_path, _, _ = pending.pop(future)
+                    log(f"Parsing {file_path} timed out after {self.timeout:.0f}s")
+                    yield ParseResult(index, file_path, error=f"Timed out after {self.timeout:.0f}s")
+                # Everything still in flight is lost with the pool: after a crash any of it may be
+                # the culprit, after a timeout it is simply resubmitted
+                lost = [(index, file_path) for index, file_path, _, _ in pending.values()]
+                pending.clear()
+                self._restart()
+                if crashed:
+                    suspects.extend(lost)
+                else:
+                    for index, file_path in lost:
+                        self._submit(pending, index, file_path)
+        finally:
+            self._stop()
+
+
+def parse_documents(file_paths, reader, workers: int = None, timeout: float = Ingestion.parse_timeout):
+    """Yields a ParseResult per file, as they complete, parsing in parallel across processes."""
+    return ParsePool(reader, workers, timeout).imap(file_paths)
@@ -0,0 +1,297 @@
+import collections
+import random
+import threading
+import time
+
+import httpx
+import numpy as np
+import openai
+
+import config
+from xyz.llm import clients, green, metrics
+
+log = config.log
+Resilience = config.Resilience
+
+# Failures worth another attempt; anything else (bad request, auth) is raised at once
+RETRYABLE_ERRORS = (openai.APIConnectionError, openai.APITimeoutError, openai.RateLimitError,
+                    openai.InternalServerError, httpx.TimeoutException, httpx.TransportError, TimeoutError)
+
+
+# Failures caused by the input of a request: in a batched call only the offending input is at fault
+INPUT_ERRORS = (openai.BadRequestError, openai.UnprocessableEntityError)
+
+
+class CircuitOpenError(Exception):
+    """Raised without calling upstream while a circuit breaker is open."""
+
+
+class DeadlineExceeded(TimeoutError):
+    pass
+
+
+class LatencyTracker:
+    """Latencies of the most recent successful calls, for the hedging delay."""
+
+    def __init__(self, size: int = 500):
+        self._samples = collections.deque(maxlen=size)
+
+    def record(self, seconds: float):
+        self._samples.append(seconds)
+
+    def percentile(self, q: float = Resilience.hedge_percentile):
+        if len(self._samples) < Resilience.hedge_min_samples:
+            return None
+        return float(np.percentile(self._samples, q))
+
+
+class RetryBudget:
+    """
+    Token bucket limiting retries and hedges to a fraction of the traffic, so a struggling
+    upstream does not get a multiple of the normal load. Each call deposits `ratio` tokens.
+    """
+
+    def __init__(self, ratio: float = Resilience.retry_ratio, max_tokens: float = Resilience.retry_budget_max):
+        self.ratio = ratio
+        self.max_tokens = max_tokens
+        self.tokens = max_tokens
+        self._lock = threading.Lock()
+
+    def deposit(self):
+        with self._lock:
+            self.tokens = min(self.max_tokens, self.tokens + self.ratio)
+
+    def withdraw(self) -> bool:
+        with self._lock:
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+            return True
+
+
+class CircuitBreaker:
+    """
+    Opens after `failures` consecutive retryable failures and fails fast for reset_timeout
+    seconds; then one probe call is let through (half-open) and its outcome closes or
+    re-opens the circuit. A probe that ends without an upstream verdict (e.g. cancelled)
+    releases the half-open slot with release(), so the next call probes instead.
+    """
+
+    def __init__(self, failures: int = Resilience.breaker_failures, reset_timeout: float = Resilience.breaker_reset):
+        self.failures = failures
+        self.reset_timeout = reset_timeout
+        self.state = "closed"
+        self._consecutive = 0
+        self._opened_at = 0.0
+        self._lock = threading.Lock()
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self.state == "open" and time.monotonic() - self._opened_at >= self.reset_timeout:
+                self.state = "half_open"
+                return True
+            return self.state == "closed"
+
+    def record_success(self):
+        with self._lock:
+            self._consecutive = 0
+            self.state = "closed"
+
+    def record_failure(self):
+        with self._lock:
+            self._consecutive += 1
+            if self.state == "half_open" or self._consecutive >= self.failures:
+                if self.state != "open":
+                    log(f"Circuit breaker opened after {self._consecutive} consecutive failures")
+                self.state = "open"
+                self._opened_at = time.monotonic()
+
+    def release(self):
+        """Ends a half-open probe without a verdict: back to open with the timeout already passed."""
+        with self._lock:
+            if self.state == "half_open":
+                self.state = "open"
+
+
+class UpstreamPolicy:
+    """
+    Runs one kind of upstream call under a deadline: retryable failures are retried with
+    full-jitter exponential backoff while the retry budget and the deadline allow; a duplicate
+    (hedged) attempt is started when the first one outlives the recent p95 latency and the
+    first result wins; and a circuit breaker fails fast after repeated failures. fn is called
+    with a `timeout` keyword bounded by the time left, as accepted by the OpenAI client methods;
+    bounded=False leaves the client's own timeout in place (streams) and disables hedging.
+    """
+
+    def __init__(self, name: str, deadline: float, max_attempts: int = Resilience.max_attempts,
+                 hedge: bool = Resilience.hedge_enabled):
+        self.name = name
+        self.deadline = deadline
+        self.max_attempts = max_attempts
+        self.hedge = hedge
+        self.latency = LatencyTracker()
+        self.budget = RetryBudget()
+        self.breaker = CircuitBreaker()
+        self.counts = collections.Counter()
+
+    def call(self, fn, *args, deadline: float = None, hedge: bool = None, bounded: bool = True, **kwargs):
+        if not self.breaker.allow():
+            self.counts["rejected"] += 1
+            raise CircuitOpenError(f"Circuit open for {self.name}")
+        self.budget.deposit()
+        hedge = bounded and (self.hedge if hedge is None else hedge)
+        deadline_at = time.monotonic() + (deadline or self.deadline)
+        attempt = 0
+        while True:
+            attempt += 1
+            remaining = deadline_at - time.monotonic()
+            if remaining <= 0:
+                self.counts["deadline_exceeded"] += 1
+                raise DeadlineExceeded(f"{self.name} exceeded its {deadline or self.deadline:.1f}s deadline")
+            started = time.monotonic()
+            try:
+                if hedge:
+                    result = self._hedged(fn, args, kwargs, remaining)
+                elif bounded:
+                    result = fn(*args, timeout=clients.timeout(read=remaining), **kwargs)
+                else:
+                    result = fn(*args, **kwargs)
+            except RETRYABLE_ERRORS as e:
+                self.breaker.record_failure()
+                self.counts["failures"] += 1
+                backoff = random.uniform(0, Resilience.backoff_base * 2 ** (attempt - 1))
+                if (attempt >= self.max_attempts or not self.breaker.allow()
+                        or time.monotonic() + backoff >= deadline_at or not self.budget.withdraw()):
+                    raise
+                log(f"{self.name} attempt {attempt} failed ({type(e).__name__}), retrying in {backoff:.2f}s")
+                self.counts["retries"] += 1
+                time.sleep(backoff)
+                continue
+            except openai.APIStatusError:
+                # Upstream answered, just with an error about this request (bad input, auth): it is up
+                self.breaker.record_success()
+                raise
+            except BaseException:
+                # No verdict on upstream (a local error, a cancelled green thread), but a half-open
+                # probe must not keep the circuit half-open for good
+                self.breaker.release()
+                raise
+            self.breaker.record_success()
+            self.latency.record(time.monotonic() - started)
+            metrics.upstream_seconds.observe(time.monotonic() - started, operation=self.name)
+            self.counts["successes"] += 1
+            return result
+
+    def _hedged(self, fn, args, kwargs, remaining):
+        delay = self.latency.percentile()
+        if delay is None or max(delay, Resilience.hedge_min_delay) >= remaining:
+            return fn(*args, timeout=clients.timeout(read=remaining), **kwargs)
+        delay = max(delay, Resilience.hedge_min_delay)
+
+        started = time.monotonic()
+        done = green.Event()
+        outcomes = []  # (ok, result or exception) in completion order
+        launched = [1]
+
+        def attempt(timeout):
+            try:
+                outcomes.append((True, fn(*args, timeout=clients.timeout(read=timeout), **kwargs)))
+            except Exception as e:
+                outcomes.append((False, e))
+            # The first success wins; a failure only ends the wait once every attempt has failed
+            if outcomes[-1][0] or len(outcomes) == launched[0]:
+                done.set()
+
+        green.spawn(attempt, remaining)
+        if not done.wait(delay) and self.budget.withdraw():
+            launched[0] += 1
+            self.counts["hedges"] += 1
+            green.spawn(attempt, remaining - (time.monotonic() - started))
+        if not done.wait(remaining - (time.monotonic() - started)):
+            raise DeadlineExceeded(f"{self.name} got no response within its deadline")
+        for ok, value in outcomes:
+            if ok:
+                return value
+        raise outcomes[0][1]
+
+    def stats(self) -> dict:
+        return dict(self.counts, breaker=self.breaker.state, p95=self.latency.percentile(95))
+
+
+_policies = {}
+_policies_lock = threading.Lock()
+
+
+def policy(name: str, deadline: float) -> UpstreamPolicy:
+    """The process-wide policy (latencies, budget, breaker) of one upstream operation."""
+    with _policies_lock:
+        if name not in _policies:
+            _policies[name] = UpstreamPolicy(name, deadline)
+        return _policies[name]
+
+
+def chat_completion(model: str, messages: list, fallback_model: str = Resilience.fallback_model,
+                    stream: bool = False, **kwargs):
+    """
+    chat.completions.create under the chat policy of `model`. When the model's circuit is
+    open or its attempts are exhausted, the request is answered by fallback_model instead,
+    within what is left of the same deadline. Streams are not hedged and keep the per-chunk
+    stream timeout; only opening them is retried.
+    """
+    client = clients.get_streaming_client() if stream else clients.get_client()
+    deadline_at = time.monotonic() + Resilience.chat_deadline
+    try:
+        response = policy(f"chat:{model}", Resilience.chat_deadline).call(
+            client.chat.completions.create, model=model, messages=messages, stream=stream,
+            bounded=not stream, **kwargs
+        )
+    except (CircuitOpenError, *RETRYABLE_ERRORS) as e:
+        if not fallback_model or fallback_model == model:
+            raise
+        remaining = deadline_at - time.monotonic()
+        if remaining <= 0:
+            raise DeadlineExceeded(f"chat:{model} exceeded its {Resilience.chat_deadline:.1f}s deadline "
+                                   f"before falling back to {fallback_model}") from e
+        log(f"Chat model {model} unavailable ({type(e).__name__}), falling back to {fallback_model}")
+        policy(f"chat:{model}", Resilience.chat_deadline).counts["fallbacks"] += 1
+        response = policy(f"chat:{fallback_model}", Resilience.chat_deadline).call(
+            client.chat.completions.create, model=fallback_model, messages=messages, stream=stream,
+            deadline=remaining, bounded=not stream, **kwargs
+        )
+    if not stream:
+        metrics.record_usage(getattr(response, "model", model), getattr(response, "usage", None))
+    return response
+
+
+def served_by_fallback(served_model: str, fallback_model: str = Resilience.fallback_model,
+                       requested_model: str = None) -> bool:
+    """
+    True when the model reported by a response (e.g. 'gpt-4o-mini-2024-07-18') is the fallback
+    model, unless that is the model that was requested.
+    """
+    if requested_model and fallback_model and requested_model.startswith(fallback_model):
+        return False
+    return bool(served_model and fallback_model) and served_model.startswith(fallback_model)
+
+
+def create_embeddings(model: str, inputs, **kwargs):
+    """
+    embeddings.create under the embeddings policy. There is no fallback model, since vectors
+    of another model would not match the index.
+    """
+    response = policy(f"embeddings:{model}", Resilience.embedding_deadline).call(
+        clients.get_client().embeddings.create, model=model, input=inputs, **kwargs
+    )
+    metrics.record_usage(model, getattr(response, "usage", None))
+    return response
+
+
+def create_speech(model: str, **kwargs):
+    """audio.speech.create under the TTS policy; audio is streamed to a file, so it is not hedged."""
+    return policy(f"tts:{model}", Resilience.tts_deadline).call(
+        clients.get_streaming_client().audio.speech.create, model=model, bounded=False, **kwargs
+    )
+
+
+def stats() -> dict:
+    return {name: upstream.stats() for name, upstream in _policies.items()}
@@ -0,0 +1,148 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+import config
+from xyz.llm import retrieval
+from xyz.llm.embedding_cache import normalize_query
+
+log = config.log
+Cache = config.Cache
+
+
+def kb_version(df) -> str:
+    """
+    Version of the knowledge base behind df: the store manifest version, or for a DataFrame
+    parsed from CSV a hash of its texts, computed once and kept in df.attrs.
+    """
+    if "kb_version" not in df.attrs:
+        digest = hashlib.sha1()
+        for text in df["text"]:
+            digest.update(str(text).encode('utf-8'))
+            digest.update(b"\x00")
+        df.attrs["kb_version"] = digest.hexdigest()[:16]
+    return df.attrs["kb_version"]
+
+
+def scope_key(kb: str, system_input: str, model: str, tenant: str = None) -> tuple:
+    """Answers are only reused for the same knowledge base, system prompt and model of one tenant."""
+    return kb, hashlib.sha1(system_input.encode('utf-8')).hexdigest(), model, tenant
+
+
+class CachedAnswer:
+    def __init__(self, question: str, answer: str, vector: np.ndarray):
+        self.question = question
+        self.answer = answer
+        self.vector = vector
+        self.created = time.time()
+        self.hits = 0
+
+
+class Scope:
+    """Answers of one scope, least recently used first, plus a lazily rebuilt matrix of their query vectors."""
+
+    def __init__(self):
+        self.entries = OrderedDict()  # normalized question -> CachedAnswer
+        self._matrix = None
+        self._keys = None
+
+    def matrix(self):
+        if self._matrix is None:
+            self._keys = list(self.entries)
+            self._matrix = np.stack([self.entries[key].vector for key in self._keys])
+        return self._keys, self._matrix
+
+    def changed(self):
+        self._matrix = self._keys = None
+
+
+class ResponseCache:
+    """
+    Semantic cache of final answers. A question is answered from the cache when its query
+    embedding has cosine similarity >= threshold with a previously answered question in the
+    same scope (knowledge-base version, system prompt hash, model, tenant). Only first turns
+    are cached by the caller, since follow-ups depend on the conversation. Entries expire after
+    ttl seconds, each scope keeps the maxsize most recently used answers, and scopes of a
+    tenant's older knowledge-base versions are dropped as soon as a newer version is seen.
+    """
+
+    def __init__(self, threshold: float = Cache.response_threshold, maxsize: int = Cache.response_maxsize,
+                 ttl: int = Cache.response_ttl):
+        self.threshold = threshold
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._scopes = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _scope(self, key, create=False):
+        scope = self._scopes.get(key)
+        if scope is None and create:
+            # A new knowledge-base version invalidates everything the tenant answered from older ones
+            stale = [other for other in self._scopes if other[3] == key[3] and other[0] != key[0]]
+            for other in stale:
+                del self._scopes[other]
+            if stale:
+                log(f"Response cache: dropped {len(stale)} scopes after knowledge base changed to {key[0]}")
+            scope = self._scopes[key] = Scope()
+        return scope
+
+    def lookup(self, scope_key: tuple, query_vector):
+        """Returns the cached answer closest to the query, or None below the threshold."""
+        query = retrieval.unit_vector(query_vector)
+        with self._lock:
+            scope = self._scope(scope_key)
+            if scope is not None and scope.entries:
+                self._expire(scope)
+            if scope is None or not scope.entries:
+                self.misses += 1
+                return None
+            keys, matrix = scope.matrix()
+            similarities = matrix @ query
+            best = int(np.argmax(similarities))
+            if similarities[best] < self.threshold:
+                self.misses += 1
+                return None
+            entry = scope.entries[keys[best]]
+            scope.entries.move_to_end(keys[best])
+            entry.hits += 1
+            self.hits += 1
+            return entry.answer
+
+    def store(self, scope_key: tuple, question: str, query_vector, answer: str):
+        vector = retrieval.unit_vector(query_vector)
+        key = normalize_query(question)
+        with self._lock:
+            scope = self._scope(scope_key, create=True)
+            scope.entries[key] = CachedAnswer(question, answer, vector)
+            scope.entries.move_to_end(key)
+            while len(scope.entries) > self.maxsize:
+                scope.entries.popitem(last=False)
+            scope.changed()
+
+    def _expire(self, scope):
+        cutoff = time.time() - self.ttl
+        expired = [key for key, entry in scope.entries.items() if entry.created < cutoff]
+        for key in expired:
+            del scope.entries[key]
+        if expired:
+            scope.changed()
+
+    def invalidate(self, kb: str = None):
+        """Drops every answer, or only those of one knowledge-base version."""
+        with self._lock:
+            for key in [key for key in self._scopes if kb is None or key[0] == kb]:
+                del self._scopes[key]
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "size": sum(len(scope.entries) for scope in self._scopes.values()),
+        }
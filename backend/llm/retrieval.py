@@ -0,0 +1,99 @@
+import weakref
+
+import numpy as np
+import pandas as pd
+
+import config
+from xyz.llm.vector_index import FlatIndex, normalize_rows, score_rows
+
+log = config.log
+
+
+class RetrievalEngine:
+    """
+    Holds every document vector in one contiguous, L2-normalized float32 matrix so a query
+    is scored with a single matrix-vector product instead of a Python loop over rows.
+
+    Already-normalized float32 or float16 arrays (e.g. memory-mapped store files) are used
+    as-is without copying, so every worker shares the same page-cache-backed vectors.
+    Searches go through a pluggable index (exact FlatIndex unless one is given).
+    Token counts computed at ingest can be kept alongside the texts for prompt packing.
+    """
+
+    def __init__(self, texts, embeddings, normalized=False, index=None, token_counts=None):
+        self.texts = list(texts)
+        if token_counts is None:
+            self.token_counts = [None] * len(self.texts)
+        else:
+            self.token_counts = [None if pd.isna(count) else int(count) for count in token_counts]
+        if normalized and getattr(embeddings, "dtype", None) in (np.float32, np.float16):
+            matrix = embeddings
+        else:
+            matrix = np.ascontiguousarray(embeddings, dtype=np.float32)
+            if not normalized:
+                matrix = normalize_rows(matrix)
+        if matrix.ndim != 2 or matrix.shape[0] != len(self.texts):
+            raise ValueError(f"Expected {len(self.texts)} embeddings, got array of shape {matrix.shape}")
+        self.matrix = matrix
+        self.index = index or FlatIndex()
+
+    @classmethod
+    def from_dataframe(cls, df: pd.DataFrame):
+        """Builds an engine from a DataFrame with 'text' and 'embedding' columns, skipping rows without a vector."""
+        valid = df[df["embedding"].notna()]
+        if len(valid) < len(df):
+            log(f"Skipping {len(df) - len(valid)} rows without an embedding.")
+        if valid.empty:
+            return cls([], np.empty((0, 0), dtype=np.float32), normalized=True)
+        token_counts = valid["token_count"] if "token_count" in valid else None
+        return cls(valid["text"].tolist(), np.stack(valid["embedding"].to_numpy()), token_counts=token_counts)
+
+    def __len__(self):
+        return len(self.texts)
+
+    def scores(self, query_embedding) -> np.ndarray:
+        """Returns the cosine similarity of the query against every document."""
+        return score_rows(self.matrix, unit_vector(query_embedding))
+
+    def search(self, query_embedding, top_n: int = 100) -> tuple[list[str], list[float]]:
+        """Returns the top_n strings and relatednesses, sorted from most related to least."""
+        if not self.texts:
+            return [], []
+        ids, scores = self.index.search(self.matrix, unit_vector(query_embedding), top_n)
+        return [self.texts[i] for i in ids], scores.tolist()
+
+    def search_documents(self, query_embedding, top_n: int = 100) -> tuple[list[str], list[float], list]:
+        """Like search, plus the stored token count of each result (None when unknown)."""
+        if not self.texts:
+            return [], [], []
+        ids, scores = self.index.search(self.matrix, unit_vector(query_embedding), top_n)
+        return [self.texts[i] for i in ids], scores.tolist(), [self.token_counts[i] for i in ids]
+
+
+def unit_vector(embedding) -> np.ndarray:
+    """Returns the embedding as a unit-length float32 vector (all zeros stay zero)."""
+    query = np.asarray(embedding, dtype=np.float32)
+    norm = np.linalg.norm(query)
+    return query / norm if norm else query
+
+
+# Engines are cached per DataFrame so the matrix is only built once per loaded knowledge base.
+_engines = {}
+
+
+def engine_for(df: pd.DataFrame) -> RetrievalEngine:
+    """Returns the cached engine for a DataFrame, building it on first use or when the frame changed size."""
+    entry = _engines.get(id(df))
+    if entry is not None:
+        ref, size, engine = entry
+        if ref() is df and size == len(df):
+            return engine
+    engine = RetrievalEngine.from_dataframe(df)
+    register(df, engine)
+    return engine
+
+
+def register(df: pd.DataFrame, engine: RetrievalEngine):
+    """Associates a prebuilt engine with a DataFrame."""
+    key = id(df)
+    _engines[key] = (weakref.ref(df, lambda _: _engines.pop(key, None)), len(df), engine)
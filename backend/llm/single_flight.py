@@ -0,0 +1,66 @@
+import hashlib
+import json
+import threading
+
+from xyz.llm import green
+from xyz.llm.embedding_cache import normalize_query
+
+
+def flight_key(model: str, text: str, context=None) -> str:
+    """Key of a call: model, normalized input and a hash of any other context (JSON-serializable)."""
+    context_hash = hashlib.sha1(json.dumps(context, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+    return f"{model}\x00{normalize_query(text)}\x00{context_hash}"
+
+
+class Call:
+    def __init__(self):
+        self.done = green.Event()
+        self.result = None
+        self.error = None
+        self.waiters = 0
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent identical calls: the first caller for a key runs fn, callers arriving
+    while it is in flight wait for and share its result (or its exception). Nothing is cached
+    once the call returns. Waiting uses green.Event, so it is safe under eventlet.
+    """
+
+    def __init__(self, timeout: float = None):
+        self.timeout = timeout
+        self._calls = {}
+        self._lock = threading.Lock()
+        self.leaders = 0
+        self.shared = 0
+
+    def do(self, key, fn, *args, **kwargs):
+        with self._lock:
+            call = self._calls.get(key)
+            if call is None:
+                call = self._calls[key] = Call()
+                leader = True
+                self.leaders += 1
+            else:
+                call.waiters += 1
+                leader = False
+                self.shared += 1
+        if not leader:
+            if not call.done.wait(self.timeout):
+                raise TimeoutError(f"Timed out waiting for in-flight call {key!r}")
+            if call.error is not None:
+                raise call.error
+            return call.result
+        try:
+            call.result = fn(*args, **kwargs)
+            return call.result
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+            call.done.set()
+
+    def stats(self) -> dict:
+        return {"calls": self.leaders, "shared": self.shared, "in_flight": len(self._calls)}
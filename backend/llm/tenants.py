@@ -0,0 +1,248 @@
+import contextlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import config
+from xyz.llm import green
+from xyz.llm.knowledge_base import KnowledgeBase
+
+log = config.log
+OAI = config.OAI
+Retrieval = config.Retrieval
+Tenants = config.Tenants
+
+default_system_prompt_path = 'xyz/llm/embeddings/system_input.txt'
+
+
+def valid_conversation_id(conversation_id) -> bool:
+    return isinstance(conversation_id, str) and 0 < len(conversation_id) <= 200 and ':' not in conversation_id
+
+
+class TokenBudget:
+    """
+    Tokens a tenant may spend per window, counted from the usage reported by completions.
+    A limit of 0 means unlimited. Counted per worker process, like the other metrics.
+    """
+
+    def __init__(self, limit: int = 0, window: float = Tenants.budget_window):
+        self.limit = limit
+        self.window = window
+        self.used = 0
+        self._window_start = time.time()
+        self._lock = threading.Lock()
+
+    def _roll(self):
+        elapsed = time.time() - self._window_start
+        if elapsed >= self.window:
+            self._window_start += elapsed - elapsed % self.window
+            self.used = 0
+
+    def exhausted(self) -> bool:
+        if not self.limit:
+            return False
+        with self._lock:
+            self._roll()
+            return self.used >= self.limit
+
+    def charge(self, usage):
+        """Adds the tokens of one response's `usage` block."""
+        if usage is None:
+            return
+        tokens = getattr(usage, "total_tokens", None) or \
+            (getattr(usage, "prompt_tokens", 0) or 0) + (getattr(usage, "completion_tokens", 0) or 0)
+        with self._lock:
+            self._roll()
+            self.used += tokens
+
+
+class Tenant:
+    """One widget or product: its persona, knowledge base, model settings and token budget."""
+
+    def __init__(self, tenant_id: str, system_prompt: str, store_path: str, csv_path: str = None,
+                 model: str = OAI.gpt4o, temperature: float = 0, context_tokens: int = 3000,
+                 max_output_tokens: int = None, token_budget: int = 0, widget_ids=(), api_keys=(),
+                 on_swap=None):
+        if ':' in tenant_id:
+            raise ValueError(f"Tenant id {tenant_id!r} must not contain ':'")
+        self.id = tenant_id
+        self.system_prompt = system_prompt
+        self.model = model
+        self.temperature = temperature
+        self.context_tokens = context_tokens  # retrieved documents packed into each prompt
+        self.max_output_tokens = max_output_tokens
+        self.widget_ids = tuple(widget_ids) or (tenant_id,)
+        self.api_keys = tuple(api_keys)
+        self.budget = TokenBudget(token_budget)
+        # Polled by the registry while loaded, so unloaded tenants cost nothing
+        self.knowledge_base = KnowledgeBase(store_path, csv_path, interval=0, on_swap=on_swap)
+
+    @classmethod
+    def from_dict(cls, spec: dict, on_swap=None):
+        """
+        Builds a tenant from a registry entry: 'id', 'store_path' (and/or 'csv_path'), either
+        'system_prompt' or 'system_prompt_path', and optionally 'model', 'temperature',
+        'context_tokens', 'max_output_tokens', 'token_budget', 'widget_ids' and 'api_keys'.
+        """
+        tenant_id = spec.get('id')
+        if not tenant_id or not (spec.get('store_path') or spec.get('csv_path')):
+            raise ValueError(f"Tenant {tenant_id or spec!r} needs an 'id' and a 'store_path' or 'csv_path'")
+        system_prompt = spec.get('system_prompt')
+        if system_prompt is None:
+            if not spec.get('system_prompt_path'):
+                raise ValueError(f"Tenant {tenant_id} needs a 'system_prompt' or 'system_prompt_path'")
+            with open(spec['system_prompt_path'], 'r', encoding='utf-8') as file:
+                system_prompt = file.read()
+        store_path = spec.get('store_path') or os.path.splitext(spec['csv_path'])[0]
+        return cls(tenant_id, system_prompt, store_path, spec.get('csv_path'),
+                   model=spec.get('model', OAI.gpt4o),
+                   temperature=spec.get('temperature', 0),
+                   context_tokens=spec.get('context_tokens', 3000),
+                   max_output_tokens=spec.get('max_output_tokens'),
+                   token_budget=spec.get('token_budget', 0),
+                   widget_ids=spec.get('widget_ids', ()),
+                   api_keys=spec.get('api_keys', ()),
+                   on_swap=on_swap)
+
+    def completion_options(self) -> dict:
+        """Sampling options passed to every completion of this tenant."""
+        options = {"temperature": self.temperature}
+        if self.max_output_tokens:
+            options["max_tokens"] = self.max_output_tokens
+        return options
+
+    def conversation_key(self, conversation_id: str) -> str:
+        """
+        Conversation IDs come from the browser, so every tenant's are namespaced as
+        '<tenant>:<id>'. Client IDs must not contain ':', or one tenant's request could name
+        another tenant's key; invalid IDs raise ValueError.
+        """
+        if not valid_conversation_id(conversation_id):
+            raise ValueError("Conversation IDs must be 1-200 characters without ':'")
+        return f"{self.id}:{conversation_id}"
+
+
+class TenantRegistry:
+    """
+    Tenants by widget ID and API key. Widget IDs are public (they are in the page that embeds
+    the widget); API keys are for server-side callers. Knowledge bases are loaded on a tenant's
+    first request, and once the loaded ones together exceed `memory_ceiling` bytes the least
+    recently used idle ones are unloaded, so a worker only holds the corpora it is serving.
+    Requests still running on an unloaded knowledge base keep it until they finish.
+    """
+
+    def __init__(self, tenants, default_tenant: str = Tenants.default_tenant,
+                 memory_ceiling: int = Tenants.memory_ceiling, interval: float = Retrieval.reload_interval):
+        self.tenants = {tenant.id: tenant for tenant in tenants}
+        self.default = self.tenants.get(default_tenant)
+        self.memory_ceiling = memory_ceiling
+        self.interval = interval
+        self._by_widget_id = {}
+        self._by_api_key = {}
+        for tenant in tenants:
+            for index, names in ((self._by_widget_id, tenant.widget_ids), (self._by_api_key, tenant.api_keys)):
+                for name in names:
+                    if index.setdefault(name, tenant) is not tenant:
+                        raise ValueError(f"Tenants {index[name].id} and {tenant.id} share a widget ID or API key")
+        self._loaded = OrderedDict()  # tenant id -> Tenant with a loaded knowledge base, least recently used first
+        self._lock = threading.Lock()
+        self._watching = None  # pid of the process running the watcher
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.tenants)
+
+    def get(self, tenant_id: str):
+        return self.tenants.get(tenant_id)
+
+    def resolve(self, widget_id: str = None, api_key: str = None):
+        """
+        The tenant of an API key, else of a widget ID; the default tenant when neither is
+        given. None when the key or ID is unknown.
+        """
+        if api_key:
+            return self._by_api_key.get(api_key)
+        if widget_id:
+            return self._by_widget_id.get(widget_id)
+        return self.default
+
+    @contextlib.contextmanager
+    def acquire(self, tenant: Tenant):
+        """Holds the tenant's current knowledge base for a request, loading it if needed; yields its DataFrame."""
+        with tenant.knowledge_base.acquire() as df:
+            self._touch(tenant)
+            yield df
+
+    def _touch(self, tenant: Tenant):
+        with self._lock:
+            self._loaded[tenant.id] = tenant
+            self._loaded.move_to_end(tenant.id)
+            self._evict(keep=tenant.id)
+
+    def _evict(self, keep: str):
+        # Called with the lock held; unload() only swaps references, it does no I/O
+        total = sum(tenant.knowledge_base.nbytes for tenant in self._loaded.values())
+        for tenant_id, tenant in list(self._loaded.items()):
+            if total <= self.memory_ceiling:
+                break
+            knowledge_base = tenant.knowledge_base
+            if tenant_id == keep or knowledge_base.in_use():
+                continue
+            total -= knowledge_base.nbytes
+            knowledge_base.unload()
+            del self._loaded[tenant_id]
+            self.evictions += 1
+            log(f"Unloaded knowledge base of tenant {tenant_id} ({total / 2 ** 20:.0f} MB still loaded)")
+
+    def _watch(self):
+        while True:
+            time.sleep(self.interval)
+            for tenant in list(self._loaded.values()):
+                try:
+                    tenant.knowledge_base.reload()
+                except Exception as e:
+                    log(f"Knowledge base watcher error for tenant {tenant.id}: {e}")
+
+    def watch(self):
+        """Starts polling the loaded knowledge bases for new versions (once per process)."""
+        with self._lock:
+            if self._watching == os.getpid() or self.interval <= 0:
+                return
+            self._watching = os.getpid()
+        green.spawn(self._watch)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"tenants": len(self.tenants),
+                    "loaded": len(self._loaded),
+                    "loaded_bytes": sum(tenant.knowledge_base.nbytes for tenant in self._loaded.values()),
+                    "memory_ceiling_bytes": self.memory_ceiling,
+                    "evictions": self.evictions}
+
+    def tenant_stats(self) -> dict:
+        """Per-tenant gauges, for the tenants loaded or with tokens spent in this process."""
+        return {tenant.id: {"loaded": int(tenant.knowledge_base.loaded),
+                            "knowledge_base_bytes": tenant.knowledge_base.nbytes,
+                            "tokens_used": tenant.budget.used,
+                            "token_budget": tenant.budget.limit}
+                for tenant in self.tenants.values() if tenant.knowledge_base.loaded or tenant.budget.used}
+
+
+def load_tenants(path: str = Tenants.registry_path, on_swap=None, **kwargs) -> TenantRegistry:
+    """
+    Reads the tenant registry, a JSON list of Tenant.from_dict entries. Without the file a
+    single default tenant serves system_input.txt and the Retrieval knowledge base.
+    """
+    if os.path.exists(path):
+        with open(path, 'r', encoding='utf-8') as file:
+            specs = json.load(file)
+        tenants = [Tenant.from_dict(spec, on_swap=on_swap) for spec in specs]
+        log(f"Loaded {len(tenants)} tenants from {path}")
+    else:
+        with open(default_system_prompt_path, 'r', encoding='utf-8') as file:
+            system_prompt = file.read()
+        tenants = [Tenant(Tenants.default_tenant, system_prompt, Retrieval.store_path, Retrieval.csv_path,
+                          on_swap=on_swap)]
+    return TenantRegistry(tenants, **kwargs)
@@ -0,0 +1,172 @@
+import numpy as np
+
+import config
+
+log = config.log
+Retrieval = config.Retrieval
+
+# Rows scored per block, which bounds the float32 temporary for float16 or very large matrices.
+_SCORE_BLOCK_ROWS = 8192
+
+
+def normalize_rows(matrix: np.ndarray) -> np.ndarray:
+    """Scales each row to unit length, leaving all-zero rows untouched."""
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+
+def top_k(scores: np.ndarray, k: int) -> np.ndarray:
+    """Returns the indices of the k highest scores in descending order without a full sort."""
+    k = min(k, len(scores))
+    if k <= 0:
+        return np.empty(0, dtype=np.intp)
+    if k < len(scores):
+        candidates = np.argpartition(scores, -k)[-k:]
+    else:
+        candidates = np.arange(len(scores))
+    return candidates[np.argsort(scores[candidates])[::-1]]
+
+
+def score_rows(matrix: np.ndarray, query: np.ndarray) -> np.ndarray:
+    """Dot product of a unit-length float32 query with every row of a float32 or float16 matrix."""
+    if matrix.dtype == np.float32:
+        return matrix @ query
+    scores = np.empty(len(matrix), dtype=np.float32)
+    for start in range(0, len(matrix), _SCORE_BLOCK_ROWS):
+        block = matrix[start:start + _SCORE_BLOCK_ROWS]
+        scores[start:start + len(block)] = block.astype(np.float32) @ query
+    return scores
+
+
+class VectorIndex:
+    """
+    Base class for search backends over a normalized embedding matrix. Indexes only hold
+    their search structure; the vectors themselves stay in the (memory-mapped) store.
+    """
+    kind = None
+
+    @classmethod
+    def build(cls, matrix: np.ndarray, **params):
+        raise NotImplementedError
+
+    def search(self, matrix: np.ndarray, query: np.ndarray, top_n: int) -> tuple[np.ndarray, np.ndarray]:
+        """Returns (row ids, scores) of the top_n rows for a unit-length query, best first."""
+        raise NotImplementedError
+
+    def arrays(self) -> dict:
+        """Arrays persisted in the index file."""
+        return {}
+
+    def save(self, path):
+        np.savez(path, kind=np.array(self.kind), **self.arrays())
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        return cls()
+
+
+class FlatIndex(VectorIndex):
+    """Exact brute-force search: one matrix-vector product and a partial top-k selection."""
+    kind = "flat"
+
+    @classmethod
+    def build(cls, matrix: np.ndarray, **params):
+        return cls()
+
+    def search(self, matrix, query, top_n):
+        scores = score_rows(matrix, query)
+        ids = top_k(scores, top_n)
+        return ids, scores[ids]
+
+
+class IVFIndex(VectorIndex):
+    """
+    Inverted-file index. A spherical k-means coarse quantizer splits the rows into nlist
+    cells; a query only scores the rows of its nprobe closest cells. Raising nprobe trades
+    latency for recall, nprobe == nlist is exact.
+    """
+    kind = "ivf"
+
+    def __init__(self, centroids: np.ndarray, order: np.ndarray, offsets: np.ndarray):
+        self.centroids = centroids
+        self.order = order
+        self.offsets = offsets
+
+    @property
+    def nlist(self):
+        return len(self.centroids)
+
+    @classmethod
+    def build(cls, matrix: np.ndarray, nlist: int = Retrieval.ivf_nlist,
+              iterations: int = Retrieval.ivf_train_iterations, seed: int = 0, **params):
+        rows = len(matrix)
+        if nlist <= 0:
+            nlist = max(1, int(np.sqrt(rows)))
+        nlist = min(nlist, rows)
+        rng = np.random.default_rng(seed)
+
+        # Train on a sample; a few hundred points per cell is plenty for a coarse quantizer.
+        sample_ids = np.sort(rng.choice(rows, size=min(rows, nlist * 256), replace=False))
+        sample = np.asarray(matrix[sample_ids], dtype=np.float32)
+        centroids = sample[rng.choice(len(sample), size=nlist, replace=False)].copy()
+        for _ in range(iterations):
+            assignments = np.argmax(sample @ centroids.T, axis=1)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assignments, sample)
+            counts = np.bincount(assignments, minlength=nlist)
+            empty = counts == 0
+            # Re-seed empty cells from random sample points so every cell stays in use
+            sums[empty] = sample[rng.choice(len(sample), size=int(empty.sum()))]
+            centroids = normalize_rows(sums).astype(np.float32)
+
+        assignments = np.empty(rows, dtype=np.int32)
+        for start in range(0, rows, _SCORE_BLOCK_ROWS):
+            block = np.asarray(matrix[start:start + _SCORE_BLOCK_ROWS], dtype=np.float32)
+            assignments[start:start + len(block)] = np.argmax(block @ centroids.T, axis=1)
+        order = np.argsort(assignments, kind='stable').astype(np.int64)
+        offsets = np.concatenate(([0], np.cumsum(np.bincount(assignments, minlength=nlist)))).astype(np.int64)
+        log(f"Built IVF index with {nlist} cells over {rows} rows")
+        return cls(centroids, order, offsets)
+
+    def search(self, matrix, query, top_n, nprobe: int = None):
+        nprobe = min(nprobe or Retrieval.ivf_nprobe, self.nlist)
+        cells = top_k(self.centroids @ query, nprobe)
+        ids = np.concatenate([self.order[self.offsets[c]:self.offsets[c + 1]] for c in cells])
+        if len(ids) == 0:
+            return ids, np.empty(0, dtype=np.float32)
+        ids.sort()  # sequential access into the memory-mapped matrix
+        scores = score_rows(np.asarray(matrix[ids]), query)
+        best = top_k(scores, top_n)
+        return ids[best], scores[best]
+
+    def arrays(self):
+        return {"centroids": self.centroids, "order": self.order, "offsets": self.offsets}
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        return cls(arrays["centroids"], arrays["order"], arrays["offsets"])
+
+
+INDEX_TYPES = {
+    FlatIndex.kind: FlatIndex,
+    IVFIndex.kind: IVFIndex,
+}
+
+
+def build_index(matrix: np.ndarray, kind: str = Retrieval.index_type, **params) -> VectorIndex:
+    """
+    Builds an index of the given kind. Approximate indexes are only worth it on large
+    corpora, so below Retrieval.ivf_min_rows an exact flat index is built instead.
+    """
+    if kind not in INDEX_TYPES:
+        raise ValueError(f"Unknown index type {kind!r}, expected one of {list(INDEX_TYPES)}")
+    if kind != FlatIndex.kind and len(matrix) < Retrieval.ivf_min_rows:
+        kind = FlatIndex.kind
+    return INDEX_TYPES[kind].build(matrix, **params)
+
+
+def load_index(path) -> VectorIndex:
+    with np.load(path) as arrays:
+        kind = str(arrays["kind"])
+        return INDEX_TYPES[kind].from_arrays({name: arrays[name] for name in arrays.files})
@@ -0,0 +1,180 @@
+"""
+Local stand-in for the OpenAI API, so benchmarks are repeatable and free.
+
+Serves /v1/embeddings (deterministic vectors: the same text always gets the same unit
+vector), /v1/chat/completions (JSON or SSE streaming with a fixed chunk cadence) and
+/v1/audio/speech, each after a configurable latency. Point the app at it with
+OPENAI_BASE_URL=http://127.0.0.1:8765/v1 and any OPENAI_API_KEY.
+
+    python -m benchmarks.fake_openai --port 8765 --latency 0.3 --chunk-delay 0.02
+"""
+import argparse
+import hashlib
+import json
+import random
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+
+class FakeSettings:
+    def __init__(self, latency: float = 0.0, jitter: float = 0.0, embedding_latency: float = None,
+                 chunk_delay: float = 0.0, chunks: int = 40, dimensions: int = 3072, error_rate: float = 0.0,
+                 seed: int = 0):
+        self.latency = latency  # seconds before a completion (or its first chunk) is returned
+        self.jitter = jitter  # extra uniform random delay in [0, jitter]
+        self.embedding_latency = latency if embedding_latency is None else embedding_latency
+        self.chunk_delay = chunk_delay  # seconds between streamed chunks
+        self.chunks = chunks  # words per answer
+        self.dimensions = dimensions
+        self.error_rate = error_rate  # fraction of requests answered with HTTP 500
+        self.random = random.Random(seed)
+
+
+def fake_embedding(text: str, dimensions: int) -> list[float]:
+    """Deterministic unit vector for a text."""
+    rng = np.random.default_rng(zlib.crc32(text.encode('utf-8')))
+    vector = rng.standard_normal(dimensions).astype(np.float32)
+    return (vector / np.linalg.norm(vector)).tolist()
+
+
+def fake_answer(messages: list, words: int) -> list[str]:
+    """Deterministic answer of `words` words for a conversation."""
+    digest = hashlib.sha1(json.dumps(messages, sort_keys=True).encode('utf-8')).hexdigest()
+    return [f"word{int(digest[i % 40], 16)}{i} " for i in range(words)]
+
+
+def count_tokens(text: str) -> int:
+    return max(1, len(text) // 4)
+
+
+class FakeOpenAIHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    settings = FakeSettings()
+
+    def log_message(self, format, *args):
+        pass
+
+    def _delay(self, base):
+        time.sleep(base + self.settings.random.uniform(0, self.settings.jitter))
+
+    def _json(self, status, payload):
+        body = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        request = json.loads(self.rfile.read(length) or b"{}")
+        if self.settings.random.random() < self.settings.error_rate:
+            self._delay(self.settings.latency)
+            return self._json(500, {"error": {"message": "injected failure", "type": "server_error"}})
+        if self.path.endswith("/embeddings"):
+            return self._embeddings(request)
+        if self.path.endswith("/chat/completions"):
+            return self._chat(request)
+        if self.path.endswith("/audio/speech"):
+            return self._speech(request)
+        self._json(404, {"error": {"message": f"Unknown path {self.path}"}})
+
+    def _embeddings(self, request):
+        self._delay(self.settings.embedding_latency)
+        inputs = request["input"] if isinstance(request["input"], list) else [request["input"]]
+        dimensions = request.get("dimensions", self.settings.dimensions)
+        tokens = sum(count_tokens(text) for text in inputs)
+        self._json(200, {
+            "object": "list",
+            "model": request.get("model"),
+            "data": [{"object": "embedding", "index": i, "embedding": fake_embedding(text, dimensions)}
+                     for i, text in enumerate(inputs)],
+            "usage": {"prompt_tokens": tokens, "total_tokens": tokens},
+        })
+
+    def _chat(self, request):
+        model = request.get("model", "gpt-4o")
+        words = fake_answer(request.get("messages", []), self.settings.chunks)
+        prompt_tokens = sum(count_tokens(str(message.get("content", ""))) for message in request.get("messages", []))
+        usage = {"prompt_tokens": prompt_tokens, "completion_tokens": len(words),
+                 "total_tokens": prompt_tokens + len(words)}
+        created = int(time.time())
+        self._delay(self.settings.latency)
+        if not request.get("stream"):
+            return self._json(200, {
+                "id": "chatcmpl-fake", "object": "chat.completion", "created": created, "model": model,
+                "choices": [{"index": 0, "finish_reason": "stop",
+                             "message": {"role": "assistant", "content": "".join(words)}}],
+                "usage": usage,
+            })
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+        def event(payload):
+            data = f"data: {payload}\n\n".encode('utf-8')
+            self.wfile.write(f"{len(data):X}\r\n".encode() + data + b"\r\n")
+            self.wfile.flush()
+
+        base = {"id": "chatcmpl-fake", "object": "chat.completion.chunk", "created": created, "model": model}
+        try:
+            for i, word in enumerate(words):
+                if i:
+                    time.sleep(self.settings.chunk_delay)
+                event(json.dumps(dict(base, choices=[{"index": 0, "delta": {"content": word}, "finish_reason": None}])))
+            event(json.dumps(dict(base, choices=[{"index": 0, "delta": {}, "finish_reason": "stop"}])))
+            if (request.get("stream_options") or {}).get("include_usage"):
+                event(json.dumps(dict(base, choices=[], usage=usage)))
+            event("[DONE]")
+            self.wfile.write(b"0\r\n\r\n")
+        except (BrokenPipeError, ConnectionResetError):
+            pass  # client stopped reading (cancelled stream)
+
+    def _speech(self, request):
+        self._delay(self.settings.latency)
+        body = b"\xff\xfb" + hashlib.sha256(request.get("input", "").encode('utf-8')).digest() * 64
+        self.send_response(200)
+        self.send_header("Content-Type", "audio/mpeg")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def start_server(settings: FakeSettings = None, host: str = "127.0.0.1", port: int = 0):
+    """Starts the server on a daemon thread; returns (server, base_url). Port 0 picks a free port."""
+    handler = type("Handler", (FakeOpenAIHandler,), {"settings": settings or FakeSettings()})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://{host}:{server.server_address[1]}/v1"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--latency', type=float, default=0.3, help="seconds before a completion starts")
+    parser.add_argument('--jitter', type=float, default=0.05, help="extra random delay, up to this many seconds")
+    parser.add_argument('--embedding-latency', type=float, default=0.05)
+    parser.add_argument('--chunk-delay', type=float, default=0.02, help="seconds between streamed chunks")
+    parser.add_argument('--chunks', type=int, default=40, help="words per answer")
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    args = parser.parse_args()
+    settings = FakeSettings(latency=args.latency, jitter=args.jitter, embedding_latency=args.embedding_latency,
+                            chunk_delay=args.chunk_delay, chunks=args.chunks, error_rate=args.error_rate)
+    server, base_url = start_server(settings, args.host, args.port)
+    print(f"Fake OpenAI API listening on {base_url}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,168 @@
+"""
+Load generator for the chat endpoints of a running app.
+
+Start the fake API and the app pointed at it, then run the load:
+
+    python -m benchmarks.fake_openai --port 8765 &
+    OPENAI_BASE_URL=http://127.0.0.1:8765/v1 OPENAI_API_KEY=fake gunicorn -c gunicorn_config.py app:app &
+    python -m benchmarks.load --url http://127.0.0.1:5000 --concurrency 32 --duration 60
+
+Each request opens a new conversation. --repeat-ratio of the messages are drawn from a small
+set of common questions (exercising caches and request coalescing), the rest are unique.
+With --stream the SSE endpoint is used and time to first delta is reported as well.
+Throughput, latency percentiles, errors and the per-stage Server-Timing breakdown are
+printed and written as JSON to benchmarks/results/.
+"""
+import argparse
+import collections
+import random
+import sys
+import threading
+import time
+import uuid
+
+import requests
+
+from benchmarks import results
+
+COMMON_QUESTIONS = [
+    "What programming languages do you know?",
+    "Are you open to remote work?",
+    "Tell me about your experience with machine learning.",
+    "What cloud platforms have you used?",
+    "What are your strongest skills?",
+]
+
+
+def comparable(output: dict) -> dict:
+    """Overall latency and per-stage stats of a run as one {name: stats} mapping."""
+    return {"latency": output.get("latency", {}),
+            **{f"stage:{stage}": stats for stage, stats in output.get("stages", {}).items()}}
+
+
+def parse_server_timing(header: str) -> dict:
+    stages = {}
+    for part in (header or "").split(","):
+        name, _, params = part.strip().partition(";")
+        for param in params.split(";"):
+            key, _, value = param.strip().partition("=")
+            if key == "dur" and name:
+                stages[name] = float(value) / 1000
+    return stages
+
+
+class LoadRun:
+    def __init__(self, url: str, stream: bool, repeat_ratio: float, timeout: float, seed: int = 0):
+        self.endpoint = url.rstrip('/') + ('/api/chat/stream' if stream else '/api/chat')
+        self.stream = stream
+        self.repeat_ratio = repeat_ratio
+        self.timeout = timeout
+        self.random = random.Random(seed)
+        self.latencies = []
+        self.first_deltas = []
+        self.stages = collections.defaultdict(list)
+        self.statuses = collections.Counter()
+        self.errors = collections.Counter()
+        self._lock = threading.Lock()
+
+    def message(self) -> str:
+        with self._lock:
+            if self.random.random() < self.repeat_ratio:
+                return self.random.choice(COMMON_QUESTIONS)
+        return f"Question {uuid.uuid4().hex[:8]}: what projects show your data skills?"
+
+    def one(self, session: requests.Session):
+        payload = {"message": self.message(), "conversationId": uuid.uuid4().hex}
+        started = time.perf_counter()
+        first_delta = None
+        try:
+            response = session.post(self.endpoint, json=payload, timeout=self.timeout, stream=self.stream)
+            if self.stream:
+                for line in response.iter_lines():
+                    if first_delta is None and line.startswith(b"data:"):
+                        first_delta = time.perf_counter() - started
+            else:
+                response.content
+            elapsed = time.perf_counter() - started
+        except requests.RequestException as e:
+            with self._lock:
+                self.errors[type(e).__name__] += 1
+            return
+        with self._lock:
+            self.statuses[response.status_code] += 1
+            if response.status_code != 200:
+                return
+            self.latencies.append(elapsed)
+            if first_delta is not None:
+                self.first_deltas.append(first_delta)
+            for stage, seconds in parse_server_timing(response.headers.get("Server-Timing")).items():
+                self.stages[stage].append(seconds)
+
+    def worker(self, deadline: float, remaining: list):
+        session = requests.Session()
+        while time.perf_counter() < deadline:
+            with self._lock:
+                if remaining[0] is not None:
+                    if remaining[0] <= 0:
+                        return
+                    remaining[0] -= 1
+            self.one(session)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--url', default='http://127.0.0.1:5000')
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--duration', type=float, default=30, help="seconds to run")
+    parser.add_argument('--requests', type=int, help="stop after this many requests instead")
+    parser.add_argument('--repeat-ratio', type=float, default=0.5, help="fraction of common questions")
+    parser.add_argument('--stream', action='store_true', help="use the SSE endpoint")
+    parser.add_argument('--timeout', type=float, default=120)
+    parser.add_argument('--output')
+    parser.add_argument('--compare', help="earlier load results JSON")
+    parser.add_argument('--threshold', type=float, default=0.10)
+    args = parser.parse_args()
+
+    run = LoadRun(args.url, args.stream, args.repeat_ratio, args.timeout)
+    remaining = [args.requests]
+    deadline = time.perf_counter() + (args.duration if args.requests is None else float('inf'))
+    started = time.perf_counter()
+    threads = [threading.Thread(target=run.worker, args=(deadline, remaining), daemon=True)
+               for _ in range(args.concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    wall = time.perf_counter() - started
+
+    output = {
+        "latency": results.summarize(run.latencies),
+        "throughput_rps": round(len(run.latencies) / wall, 3) if wall else 0.0,
+        "statuses": {str(status): count for status, count in run.statuses.items()},
+        "errors": dict(run.errors),
+        "stages": {stage: results.summarize(samples) for stage, samples in sorted(run.stages.items())},
+        "_parameters": {"url": args.url, "concurrency": args.concurrency, "stream": args.stream,
+                        "repeat_ratio": args.repeat_ratio, "wall_seconds": round(wall, 3)},
+    }
+    if run.first_deltas:
+        output["first_delta"] = results.summarize(run.first_deltas)
+
+    latency = output["latency"]
+    print(f"{len(run.latencies)} ok in {wall:.1f}s: {output['throughput_rps']} req/s, statuses {output['statuses']}, "
+          f"errors {output['errors']}")
+    if latency["n"]:
+        print(f"latency p50 {latency['p50_ms']} ms  p95 {latency['p95_ms']} ms  p99 {latency['p99_ms']} ms")
+    if run.first_deltas:
+        first = output["first_delta"]
+        print(f"first delta p50 {first['p50_ms']} ms  p95 {first['p95_ms']} ms")
+    for stage, stats in output["stages"].items():
+        print(f"  {stage:20s} p50 {stats['p50_ms']:10.3f} ms  p95 {stats['p95_ms']:10.3f} ms")
+    path = results.save("load", output, args.output)
+    print(f"Results written to {path}")
+    if args.compare and results.compare(comparable(results.load(args.compare)), comparable(output),
+                                        threshold=args.threshold):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
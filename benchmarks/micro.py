@@ -0,0 +1,122 @@
+"""
+Micro-benchmarks of the retrieval and ingestion hot paths against the local fake OpenAI server.
+
+    python -m benchmarks.micro --rows 5000 --repeat 50
+    python -m benchmarks.micro --compare benchmarks/results/micro-20241001-120000.json
+
+Run from the directory containing the xyz package. Results are written as JSON to
+benchmarks/results/ (or --output); --compare prints the change against an earlier run and
+exits non-zero when a benchmark's median got more than --threshold slower.
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+from benchmarks import results
+from benchmarks.fake_openai import FakeSettings, start_server
+
+WORDS = ("python data model service api latency cache index query vector retrieval token prompt "
+         "project experience skills resume deploy cloud analysis pipeline design team").split()
+
+
+def synthetic_corpus(rows: int, dimensions: int, seed: int = 0) -> pd.DataFrame:
+    rng = np.random.default_rng(seed)
+    texts = [" ".join(rng.choice(WORDS, size=int(rng.integers(40, 200)))) for _ in range(rows)]
+    vectors = rng.standard_normal((rows, dimensions)).astype(np.float32)
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    return pd.DataFrame({"filepath": [f"doc{i // 10}.md" for i in range(rows)], "text": texts,
+                         "embedding": list(vectors)})
+
+
+def write_documents(directory: str, count: int, seed: int = 0):
+    rng = np.random.default_rng(seed)
+    os.makedirs(directory, exist_ok=True)
+    for i in range(count):
+        sections = "\n\n".join(
+            f"## Section {j}\n\n" + " ".join(rng.choice(WORDS, size=int(rng.integers(50, 300))))
+            for j in range(5)
+        )
+        with open(os.path.join(directory, f"document{i}.md"), 'w', encoding='utf-8') as file:
+            file.write(f"# Document {i}\n\n{sections}\n")
+
+
+def measure(fn, repeat: int, warmup: int = 1, setup=None) -> dict:
+    for _ in range(warmup):
+        if setup:
+            setup()
+        fn()
+    samples = []
+    for _ in range(repeat):
+        if setup:
+            setup()
+        started = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - started)
+    return results.summarize(samples)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=2000, help="chunks in the synthetic knowledge base")
+    parser.add_argument('--dimensions', type=int, default=3072)
+    parser.add_argument('--csv-rows', type=int, default=200, help="rows in the CSV parsed by read_embedding")
+    parser.add_argument('--docs', type=int, default=20, help="documents for get_document_text")
+    parser.add_argument('--repeat', type=int, default=30)
+    parser.add_argument('--latency', type=float, default=0.0, help="fake API latency in seconds")
+    parser.add_argument('--output')
+    parser.add_argument('--compare', help="earlier micro results JSON")
+    parser.add_argument('--threshold', type=float, default=0.10)
+    args = parser.parse_args()
+
+    _, base_url = start_server(FakeSettings(latency=args.latency, dimensions=args.dimensions))
+    # Must be set before config is imported
+    os.environ['OPENAI_BASE_URL'] = base_url
+    os.environ.setdefault('OPENAI_API_KEY', 'benchmark')
+
+    workdir = tempfile.mkdtemp(prefix='chat-widget-bench-')
+    documents = os.path.join(workdir, 'knowledge_sources')
+    write_documents(documents, args.docs)
+    sys.path.insert(0, os.getcwd())
+
+    from xyz.llm import embedding_generator, embedding_model
+
+    df = synthetic_corpus(args.rows, args.dimensions)
+    csv_path = os.path.join(workdir, 'corpus.csv')
+    csv_df = df.head(args.csv_rows)
+    csv_df.assign(embedding=[vector.tolist() for vector in csv_df['embedding']]).to_csv(csv_path, index=False)
+    query = "Which cloud projects used python and vector retrieval?"
+    cold_queries = iter(f"{query} #{i}" for i in range(10 ** 9))
+
+    benchmarks = {
+        # Query embedding served from the cache: ranking and retrieval only
+        "strings_ranked_by_relatedness": lambda: embedding_model.strings_ranked_by_relatedness(query, df),
+        # New query every time: includes the embeddings round-trip to the fake server
+        "strings_ranked_by_relatedness_cold": lambda: embedding_model.strings_ranked_by_relatedness(
+            next(cold_queries), df),
+        "query_message": lambda: embedding_model.query_message(query, df),
+        "read_embedding": lambda: embedding_model.read_embedding(csv_path),
+        "get_document_text": lambda: embedding_generator.get_document_text(documents),
+    }
+    repeats = {"read_embedding": max(3, args.repeat // 10), "get_document_text": max(3, args.repeat // 10)}
+
+    output = {}
+    for name, fn in benchmarks.items():
+        stats = measure(fn, repeats.get(name, args.repeat))
+        output[name] = stats
+        print(f"{name:40s} p50 {stats['p50_ms']:10.3f} ms   p95 {stats['p95_ms']:10.3f} ms   n={stats['n']}")
+    output["_parameters"] = {"rows": args.rows, "dimensions": args.dimensions, "csv_rows": args.csv_rows,
+                             "docs": args.docs, "latency": args.latency}
+
+    path = results.save("micro", output, args.output)
+    print(f"Results written to {path}")
+    if args.compare and results.compare(results.load(args.compare), output, threshold=args.threshold):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
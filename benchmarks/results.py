@@ -0,0 +1,72 @@
+"""Timing statistics and JSON result files shared by the benchmark scripts."""
+import json
+import os
+import platform
+import subprocess
+import time
+
+import numpy as np
+
+RESULTS_DIR = os.path.join(os.path.dirname(__file__), 'results')
+
+
+def summarize(samples) -> dict:
+    """Latency statistics in milliseconds for a list of durations in seconds."""
+    ms = np.asarray(samples, dtype=float) * 1000
+    if not len(ms):
+        return {"n": 0}
+    return {
+        "n": int(len(ms)),
+        "mean_ms": round(float(ms.mean()), 3),
+        "min_ms": round(float(ms.min()), 3),
+        "p50_ms": round(float(np.percentile(ms, 50)), 3),
+        "p95_ms": round(float(np.percentile(ms, 95)), 3),
+        "p99_ms": round(float(np.percentile(ms, 99)), 3),
+        "max_ms": round(float(ms.max()), 3),
+    }
+
+
+def environment() -> dict:
+    try:
+        revision = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                                  cwd=os.path.dirname(os.path.abspath(__file__)), timeout=5).stdout.strip()
+    except (OSError, subprocess.SubprocessError):
+        revision = None
+    return {"git": revision, "python": platform.python_version(), "numpy": np.__version__,
+            "machine": platform.machine(), "cpus": os.cpu_count()}
+
+
+def save(kind: str, results: dict, output: str = None) -> str:
+    """Writes results with run metadata to benchmarks/results/<kind>-<timestamp>.json (or `output`)."""
+    path = output or os.path.join(RESULTS_DIR, f"{kind}-{time.strftime('%Y%m%d-%H%M%S')}.json")
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    with open(path, 'w', encoding='utf-8') as file:
+        json.dump({"kind": kind, "created": time.strftime('%Y-%m-%dT%H:%M:%S'), "environment": environment(),
+                   "results": results}, file, indent=2)
+    return path
+
+
+def load(path: str) -> dict:
+    """The results of an earlier run."""
+    with open(path, encoding='utf-8') as file:
+        return json.load(file)["results"]
+
+
+def compare(previous: dict, results: dict, metric: str = "p50_ms", threshold: float = 0.10) -> list[str]:
+    """
+    Compares {name: stats} results with an earlier run and returns the names whose `metric`
+    got more than `threshold` slower, printing a line per benchmark.
+    """
+    regressions = []
+    for name, stats in results.items():
+        before = previous.get(name, {}).get(metric)
+        after = stats.get(metric)
+        if not before or after is None:
+            continue
+        change = after / before - 1
+        flag = ""
+        if change > threshold:
+            flag = "  REGRESSION"
+            regressions.append(name)
+        print(f"{name:40s} {before:10.3f} -> {after:10.3f} {metric} ({change:+.1%}){flag}")
+    return regressions
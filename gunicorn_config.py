@@ -1,5 +1,6 @@
 # gunicorn_config.py
 import multiprocessing
+import os
 
 bind = '0.0.0.0:5000'
 workers = multiprocessing.cpu_count() * 2 + 1
@@ -10,4 +11,14 @@ keepalive = 5
 errorlog = '-'
 loglevel = 'info'
 accesslog = '-'
-access_log_format = '%(h)s %(l)s %(u)s %(t)s "%(r)s" %(s)s %(b)s "%(f)s" "%(a)s"'
\ No newline at end of file
+access_log_format = '%(h)s %(l)s %(u)s %(t)s "%(r)s" %(s)s %(b)s "%(f)s" "%(a)s"'
+# GUNICORN_PRELOAD=true imports the app once in the master and loads the knowledge base,
+# index and encoders there before forking, so workers start instantly and share that memory
+# copy-on-write. Connection pools and log listeners are recreated in each worker.
+preload_app = os.getenv('GUNICORN_PRELOAD', 'false').lower() == 'true'
+
+
+def when_ready(server):
+    if server.cfg.preload_app:
+        from app import warm
+        warm()
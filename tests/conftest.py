@@ -0,0 +1,12 @@
+import os
+import sys
+
+# The backend package is deployed as `xyz`; alias it so modules import as they do in production
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.environ.setdefault('LOG_FILE', '')
+os.environ.setdefault('TELEGRAM_NOTIFICATIONS', 'false')
+
+import backend  # noqa: E402
+
+sys.modules.setdefault('xyz', backend)
@@ -0,0 +1,133 @@
+import time
+
+import fakeredis
+import pytest
+
+from xyz.llm.conversation_store import RedisStore, SQLStore
+
+
+def turn(content, role="user"):
+    return {"role": role, "content": content, "tokens": 1}
+
+
+@pytest.fixture
+def sqlite_uri(tmp_path):
+    return f"sqlite:///{tmp_path / 'conversations.db'}"
+
+
+def contents(turns):
+    return [t["content"] for t in turns]
+
+
+def test_sql_batches_until_batch_size(sqlite_uri):
+    writer = SQLStore(sqlite_uri, batch_size=3, flush_interval=60)
+    reader = SQLStore(sqlite_uri, batch_size=3, flush_interval=60)
+    writer.append("c", [turn("a"), turn("b")])
+    assert writer.version("c") == 2  # pending turns count for the writer
+    assert reader.version("c") == 0
+    writer.append("c", [turn("c")])
+    turns, summary, version = reader.load("c")
+    assert contents(turns) == ["a", "b", "c"]
+    assert [t["seq"] for t in turns] == [1, 2, 3]
+    assert (summary, version) == (None, 3)
+
+
+def test_sql_background_flusher_writes_idle_turns(sqlite_uri):
+    writer = SQLStore(sqlite_uri, batch_size=100, flush_interval=0.1)
+    reader = SQLStore(sqlite_uri)
+    writer.append("c", [turn("a")])
+    deadline = time.time() + 2
+    while reader.version("c") == 0 and time.time() < deadline:
+        time.sleep(0.05)
+    assert contents(reader.load("c")[0]) == ["a"]
+
+
+def test_sql_zero_interval_writes_every_append(sqlite_uri):
+    writer = SQLStore(sqlite_uri, batch_size=100, flush_interval=0)
+    writer.append("c", [turn("a")])
+    assert SQLStore(sqlite_uri).version("c") == 1
+
+
+def test_sql_seq_conflict_renumbers_only_that_conversation(sqlite_uri):
+    first = SQLStore(sqlite_uri, batch_size=100, flush_interval=60)
+    second = SQLStore(sqlite_uri, batch_size=100, flush_interval=60)
+    first.append("shared", [turn("from first")])
+    first.append("own", [turn("own")])
+    second.append("shared", [turn("from second")])
+    second.flush()
+    # The batch numbers "shared" from a stale seq, as if `second` wrote between the read and the insert
+    stored_version, stale = first._stored_version, []
+
+    def stale_once(conn, conversation_id):
+        if not stale:
+            stale.append(conversation_id)
+            return 0
+        return stored_version(conn, conversation_id)
+
+    first._stored_version = stale_once
+    first.flush()
+    assert stale == ["shared"]
+    assert first._pending == []
+    turns, _, version = second.load("shared")
+    assert contents(turns) == ["from second", "from first"]
+    assert version == 2
+    assert contents(second.load("own")[0]) == ["own"]
+
+
+def test_sql_summary_hides_covered_turns(sqlite_uri):
+    store = SQLStore(sqlite_uri, flush_interval=0)
+    store.append("c", [turn("a"), turn("b"), turn("c")])
+    store.set_summary("c", "a and b", 2)
+    store.set_summary("c", "a, b and c", 3)
+    turns, summary, version = store.load("c")
+    assert (turns, summary, version) == ([], "a, b and c", 3)
+    store.append("c", [turn("d")])
+    assert contents(store.load("c")[0]) == ["d"]
+
+
+@pytest.fixture
+def redis_store():
+    return RedisStore("fakeredis://", client=fakeredis.FakeRedis(decode_responses=True))
+
+
+def test_redis_seq_and_version(redis_store):
+    redis_store.append("c", [turn("a"), turn("b")])
+    redis_store.append("c", [turn("c")])
+    turns, summary, version = redis_store.load("c")
+    assert [t["seq"] for t in turns] == [1, 2, 3]
+    assert (summary, version, redis_store.version("c")) == (None, 3, 3)
+
+
+def test_redis_summary_trims_covered_turns(redis_store):
+    redis_store.append("c", [turn("a"), turn("b"), turn("c")])
+    redis_store.set_summary("c", "a and b", 2)
+    assert redis_store.client.llen("conversation:c:turns") == 1
+    redis_store.set_summary("c", "everything", 3)
+    assert redis_store.client.llen("conversation:c:turns") == 0
+    turns, summary, version = redis_store.load("c")
+    assert (turns, summary, version) == ([], "everything", 3)
+    redis_store.append("c", [turn("d")])
+    assert [t["seq"] for t in redis_store.load("c")[0]] == [4]
+
+
+def test_redis_summary_retries_when_an_append_lands(redis_store):
+    redis_store.append("c", [turn("a"), turn("b")])
+    client = redis_store.client
+    original = client.transaction
+    raced = []
+
+    def transaction(fn, *keys, **kwargs):
+        # Another worker appends right after the summary transaction read seq, before it executes
+        def racing(pipe):
+            fn(pipe)
+            if not raced:
+                raced.append(True)
+                client.transaction = original
+                redis_store.append("c", [turn("c")])
+        return original(racing, *keys, **kwargs)
+
+    client.transaction = transaction
+    redis_store.set_summary("c", "a and b", 2)
+    assert raced
+    assert contents(redis_store.load("c")[0]) == ["c"]
+    assert redis_store.client.llen("conversation:c:turns") == 1
@@ -0,0 +1,112 @@
+import json
+import os
+
+import pandas as pd
+import pytest
+
+from xyz.llm import embedding_generator, embedding_store
+from xyz.llm.embedding_generator import ingest_manifest_path, update_embeddings
+
+COLUMNS = ['filepath', 'text', 'embedding', 'section', 'page', 'start', 'end', 'token_count']
+
+
+@pytest.fixture
+def docs(tmp_path):
+    directory = tmp_path / "docs"
+    directory.mkdir()
+
+    def write(name, text):
+        path = directory / name
+        path.write_text(text, encoding="utf-8")
+        return str(path)
+
+    write.directory = str(directory)
+    return write
+
+
+@pytest.fixture
+def embedded(monkeypatch):
+    """Stubs embedding with two chunks per file; files listed in `embedded.failing` get no embedding."""
+    calls = []
+
+    def embed_documents(file_paths):
+        file_paths = list(file_paths)
+        calls.append(sorted(file_paths))
+        rows = []
+        for file_path in file_paths:
+            with open(file_path, encoding="utf-8") as file:
+                text = file.read()
+            embedding = None if file_path in embed_documents.failing else [float(len(text)), 1.0, 0.5]
+            rows += [[file_path, f"{text} #{i}", embedding, None, None, 0, len(text), 3] for i in range(2)]
+        return pd.DataFrame(rows, columns=COLUMNS).astype({'page': 'Int64'})
+
+    embed_documents.failing = set()
+    embed_documents.calls = calls
+    monkeypatch.setattr(embedding_generator, "embed_documents", embed_documents)
+    return embed_documents
+
+
+def stored(store_path):
+    df = embedding_store.read_store_embeddings(store_path)
+    return sorted(zip(df['filepath'].map(os.path.basename), df['text']))
+
+
+def test_classifies_changes_and_round_trips_the_manifest(tmp_path, docs, embedded):
+    store = str(tmp_path / "store")
+    a, b, c = docs("a.md", "alpha"), docs("b.md", "beta"), docs("c.md", "gamma")
+    changes = update_embeddings(docs.directory, store)
+    assert sorted(changes['added']) == [a, b, c]
+    assert len(stored(store)) == 6
+
+    docs("b.md", "beta, revised")
+    os.remove(c)
+    d = docs("d.md", "delta")
+    changes = update_embeddings(docs.directory, store)
+    assert (changes['added'], changes['modified'], changes['deleted'], changes['unchanged']) == ([d], [b], [c], [a])
+    assert embedded.calls[-1] == sorted([b, d])
+    assert stored(store) == [("a.md", "alpha #0"), ("a.md", "alpha #1"),
+                             ("b.md", "beta, revised #0"), ("b.md", "beta, revised #1"),
+                             ("d.md", "delta #0"), ("d.md", "delta #1")]
+    with open(ingest_manifest_path(store), encoding="utf-8") as file:
+        assert sorted(json.load(file)) == [a, b, d]
+
+
+def test_rerun_without_changes_is_a_no_op(tmp_path, docs, embedded):
+    store = str(tmp_path / "store")
+    docs("a.md", "alpha")
+    update_embeddings(docs.directory, store)
+    version = embedding_store.read_manifest(store)["version"]
+    changes = update_embeddings(docs.directory, store)
+    assert changes['unchanged'] and not (changes['added'] or changes['modified'] or changes['deleted'])
+    assert len(embedded.calls) == 1
+    assert embedding_store.read_manifest(store)["version"] == version
+
+
+def test_store_without_ingest_manifest_is_not_duplicated(tmp_path, docs, embedded):
+    store = str(tmp_path / "store")
+    a, b = docs("a.md", "alpha"), docs("b.md", "beta")
+    update_embeddings(docs.directory, store)
+    os.remove(ingest_manifest_path(store))  # as left by embedding_store.convert_csv
+    update_embeddings(docs.directory, store)
+    assert len(stored(store)) == 4
+    assert stored(store).count(("a.md", "alpha #0")) == 1
+    assert embedded.calls[-1] == [a, b]
+
+
+def test_failed_reembed_keeps_previous_rows_and_retries(tmp_path, docs, embedded):
+    store = str(tmp_path / "store")
+    a = docs("a.md", "alpha")
+    docs("b.md", "beta")
+    update_embeddings(docs.directory, store)
+
+    docs("a.md", "alpha, revised")
+    embedded.failing = {a}
+    changes = update_embeddings(docs.directory, store)
+    assert changes['failed'] == [a]
+    assert ("a.md", "alpha #0") in stored(store)
+
+    embedded.failing = set()
+    changes = update_embeddings(docs.directory, store)
+    assert changes['modified'] == [a]
+    assert [row for row in stored(store) if row[0] == "a.md"] == [("a.md", "alpha, revised #0"),
+                                                                  ("a.md", "alpha, revised #1")]
@@ -0,0 +1,104 @@
+import threading
+
+import httpx
+import openai
+import pytest
+
+from xyz.llm.micro_batch import MicroBatcher
+from xyz.llm.resilience import INPUT_ERRORS
+
+
+def bad_request(message="Invalid input"):
+    request = httpx.Request("POST", "https://api.openai.com/v1/embeddings")
+    return openai.BadRequestError(message, response=httpx.Response(400, request=request), body=None)
+
+
+def submit_concurrently(batcher, items):
+    results = [None] * len(items)
+
+    def caller(i):
+        try:
+            results[i] = batcher.submit(items[i])
+        except Exception as e:
+            results[i] = e
+
+    threads = [threading.Thread(target=caller, args=(i,)) for i in range(len(items))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(5)
+    return results
+
+
+def test_concurrent_items_share_one_call():
+    calls = []
+
+    def batch_fn(items):
+        calls.append(list(items))
+        return [item * 2 for item in items]
+
+    batcher = MicroBatcher(batch_fn, window=0.2, max_batch=100)
+    assert submit_concurrently(batcher, [1, 2, 3]) == [2, 4, 6]
+    assert len(calls) == 1 and sorted(calls[0]) == [1, 2, 3]
+
+
+def test_full_batch_is_sent_without_waiting():
+    calls = []
+
+    def batch_fn(items):
+        calls.append(list(items))
+        return list(items)
+
+    batcher = MicroBatcher(batch_fn, window=60, max_batch=2)
+    assert submit_concurrently(batcher, ["a", "b"]) == ["a", "b"]
+    assert len(calls) == 1
+
+
+def test_batch_error_fails_every_caller_without_isolation():
+    def batch_fn(items):
+        raise bad_request()
+
+    results = submit_concurrently(MicroBatcher(batch_fn, window=0.2, max_batch=100), ["a", "", "c"])
+    assert all(isinstance(result, openai.BadRequestError) for result in results)
+
+
+def test_input_error_is_isolated_to_the_bad_item():
+    calls = []
+
+    def batch_fn(items):
+        calls.append(list(items))
+        if "" in items:
+            raise bad_request("'$.input' is invalid")
+        return [item.upper() for item in items]
+
+    batcher = MicroBatcher(batch_fn, window=0.2, max_batch=100, isolate=lambda e: isinstance(e, INPUT_ERRORS))
+    results = submit_concurrently(batcher, ["a", "", "c"])
+    assert results[0] == "A" and results[2] == "C"
+    assert isinstance(results[1], openai.BadRequestError)
+    assert len(calls) == 4  # the batch, then each item alone
+    assert batcher.stats()["isolated_batches"] == 1
+
+
+def test_other_errors_are_not_retried_per_item():
+    calls = []
+
+    def batch_fn(items):
+        calls.append(list(items))
+        raise TimeoutError("upstream timed out")
+
+    batcher = MicroBatcher(batch_fn, window=0.2, max_batch=100, isolate=lambda e: isinstance(e, INPUT_ERRORS))
+    results = submit_concurrently(batcher, ["a", "b"])
+    assert all(isinstance(result, TimeoutError) for result in results)
+    assert len(calls) == 1
+
+
+def test_result_count_mismatch_is_an_error():
+    batcher = MicroBatcher(lambda items: [], window=0, max_batch=100)
+    with pytest.raises(ValueError):
+        batcher.submit("a")
+
+
+def test_empty_query_is_rejected_before_batching():
+    from xyz.llm import embedding_model
+    with pytest.raises(ValueError):
+        embedding_model.embed_query("   ")
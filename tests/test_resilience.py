@@ -0,0 +1,188 @@
+import time
+from types import SimpleNamespace
+
+import httpx
+import openai
+import pytest
+
+from xyz.llm import resilience
+from xyz.llm.resilience import CircuitBreaker, CircuitOpenError, RetryBudget, UpstreamPolicy
+
+REQUEST = httpx.Request("POST", "https://api.openai.com/v1/chat/completions")
+
+
+def connection_error():
+    return openai.APIConnectionError(request=REQUEST)
+
+
+def bad_request():
+    return openai.BadRequestError("Invalid input", response=httpx.Response(400, request=REQUEST), body=None)
+
+
+def failing(*errors):
+    """A call that raises the given errors in turn, then returns 'ok'."""
+    errors = list(errors)
+    calls = []
+
+    def fn(**kwargs):
+        calls.append(kwargs)
+        if errors:
+            raise errors.pop(0)
+        return "ok"
+    fn.calls = calls
+    return fn
+
+
+@pytest.fixture(autouse=True)
+def no_backoff(monkeypatch):
+    monkeypatch.setattr(resilience.random, "uniform", lambda low, high: 0.0)
+
+
+def open_breaker(reset_timeout=0.05):
+    breaker = CircuitBreaker(failures=2, reset_timeout=reset_timeout)
+    breaker.record_failure()
+    assert breaker.state == "closed" and breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == "open" and not breaker.allow()
+    return breaker
+
+
+def half_open_breaker():
+    breaker = open_breaker()
+    time.sleep(0.06)
+    assert breaker.allow()
+    assert breaker.state == "half_open"
+    assert not breaker.allow()  # one probe at a time
+    return breaker
+
+
+def test_breaker_opens_after_consecutive_failures():
+    breaker = CircuitBreaker(failures=2, reset_timeout=60)
+    breaker.record_failure()
+    breaker.record_success()
+    breaker.record_failure()
+    assert breaker.state == "closed"
+    open_breaker(reset_timeout=60)
+
+
+def test_half_open_probe_success_closes():
+    breaker = half_open_breaker()
+    breaker.record_success()
+    assert breaker.state == "closed" and breaker.allow()
+
+
+def test_half_open_probe_failure_reopens():
+    breaker = half_open_breaker()
+    breaker.record_failure()
+    assert breaker.state == "open" and not breaker.allow()
+
+
+def test_released_probe_lets_the_next_call_probe():
+    breaker = half_open_breaker()
+    breaker.release()
+    assert breaker.state == "open"
+    assert breaker.allow() and breaker.state == "half_open"
+
+
+def policy_with(breaker, max_attempts=3):
+    policy = UpstreamPolicy("test", deadline=5, max_attempts=max_attempts, hedge=False)
+    policy.breaker = breaker
+    return policy
+
+
+def test_probe_with_upstream_client_error_closes_circuit():
+    policy = policy_with(open_breaker())
+    time.sleep(0.06)
+    with pytest.raises(openai.BadRequestError):
+        policy.call(failing(bad_request()), bounded=False)
+    assert policy.breaker.state == "closed"
+    assert policy.call(failing(), bounded=False) == "ok"
+
+
+def test_probe_with_local_error_does_not_wedge_half_open():
+    policy = policy_with(open_breaker())
+    time.sleep(0.06)
+    with pytest.raises(ValueError):
+        policy.call(failing(ValueError("bad argument")), bounded=False)
+    assert policy.breaker.state == "open"
+    assert policy.call(failing(), bounded=False) == "ok"  # the next call probes and closes it
+    assert policy.breaker.state == "closed"
+
+
+def test_probe_with_retryable_error_reopens():
+    policy = policy_with(open_breaker())
+    time.sleep(0.06)
+    fn = failing(connection_error(), connection_error())
+    with pytest.raises(openai.APIConnectionError):
+        policy.call(fn, bounded=False)
+    assert len(fn.calls) == 1  # no retry through an open circuit
+    assert policy.breaker.state == "open"
+    with pytest.raises(CircuitOpenError):
+        policy.call(fn, bounded=False)
+
+
+def test_retryable_errors_are_retried_and_others_are_not():
+    policy = policy_with(CircuitBreaker(failures=10, reset_timeout=60))
+    fn = failing(connection_error(), connection_error())
+    assert policy.call(fn, bounded=False) == "ok"
+    assert len(fn.calls) == 3
+    fn = failing(bad_request())
+    with pytest.raises(openai.BadRequestError):
+        policy.call(fn, bounded=False)
+    assert len(fn.calls) == 1
+
+
+def test_retry_budget_limits_retries():
+    budget = RetryBudget(ratio=0.5, max_tokens=1)
+    assert budget.withdraw()
+    assert not budget.withdraw()
+    budget.deposit()
+    assert not budget.withdraw()
+    budget.deposit()
+    assert budget.withdraw()
+
+    policy = policy_with(CircuitBreaker(failures=10, reset_timeout=60))
+    policy.budget = RetryBudget(ratio=0, max_tokens=0)
+    fn = failing(connection_error())
+    with pytest.raises(openai.APIConnectionError):
+        policy.call(fn, bounded=False)
+    assert len(fn.calls) == 1
+
+
+@pytest.fixture
+def chat_upstream(monkeypatch):
+    """A chat client whose primary model takes `primary_seconds` to time out; records the fallback calls."""
+    fallback_calls = []
+
+    def create(model, timeout, **kwargs):
+        if model == "primary":
+            time.sleep(min(create.primary_seconds, timeout.read))
+            raise openai.APITimeoutError(request=REQUEST)
+        fallback_calls.append(timeout.read)
+        return "ok"
+
+    create.fallback_calls = fallback_calls
+    client = SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(create=create)))
+    monkeypatch.setattr(resilience.clients, "get_client", lambda: client)
+    monkeypatch.setattr(resilience.Resilience, "chat_deadline", 0.5)
+    monkeypatch.setattr(resilience, "_policies", {
+        "chat:primary": UpstreamPolicy("chat:primary", 0.5, max_attempts=1, hedge=False),
+        "chat:fallback": UpstreamPolicy("chat:fallback", 0.5, hedge=False),
+    })
+    return create
+
+
+def test_fallback_gets_only_the_rest_of_the_deadline(chat_upstream):
+    chat_upstream.primary_seconds = 0.3
+    assert resilience.chat_completion("primary", [], fallback_model="fallback") == "ok"
+    assert len(chat_upstream.fallback_calls) == 1
+    assert 0 < chat_upstream.fallback_calls[0] <= 0.2
+
+
+def test_no_fallback_once_the_deadline_is_spent(chat_upstream):
+    chat_upstream.primary_seconds = 1
+    started = time.monotonic()
+    with pytest.raises(resilience.DeadlineExceeded):
+        resilience.chat_completion("primary", [], fallback_model="fallback")
+    assert time.monotonic() - started < 0.7
+    assert chat_upstream.fallback_calls == []
@@ -0,0 +1,83 @@
+import threading
+
+import pytest
+
+from xyz.llm.single_flight import SingleFlight, flight_key
+
+
+def run_concurrently(flight, fn, callers=5):
+    """Starts `callers` identical calls while fn is blocked, then releases it; returns results or errors."""
+    release = threading.Event()
+    started = threading.Event()
+    results = [None] * callers
+
+    def blocked():
+        started.set()
+        release.wait(5)
+        return fn()
+
+    def caller(i):
+        try:
+            results[i] = flight.do("key", blocked)
+        except Exception as e:
+            results[i] = e
+
+    threads = [threading.Thread(target=caller, args=(0,))]
+    threads[0].start()
+    started.wait(5)
+    for i in range(1, callers):
+        threads.append(threading.Thread(target=caller, args=(i,)))
+        threads[-1].start()
+    while flight._calls["key"].waiters < callers - 1:
+        threading.Event().wait(0.01)
+    release.set()
+    for thread in threads:
+        thread.join(5)
+    return results
+
+
+def test_concurrent_calls_share_one_result():
+    flight, calls = SingleFlight(), []
+
+    def fn():
+        calls.append(1)
+        return object()
+
+    results = run_concurrently(flight, fn)
+    assert len(calls) == 1
+    assert all(result is results[0] for result in results)
+    assert flight.stats() == {"calls": 1, "shared": 4, "in_flight": 0}
+
+
+def test_concurrent_calls_share_the_error():
+    def fn():
+        raise ValueError("upstream said no")
+
+    results = run_concurrently(SingleFlight(), fn)
+    assert all(isinstance(result, ValueError) for result in results)
+
+
+def test_nothing_is_cached_after_the_call():
+    flight, calls = SingleFlight(), []
+    flight.do("key", calls.append, 1)
+    flight.do("key", calls.append, 2)
+    assert calls == [1, 2]
+
+
+def test_waiter_times_out():
+    flight = SingleFlight(timeout=0.05)
+    release = threading.Event()
+    leader = threading.Thread(target=flight.do, args=("key", release.wait, 5))
+    leader.start()
+    while "key" not in flight._calls:
+        threading.Event().wait(0.01)
+    with pytest.raises(TimeoutError):
+        flight.do("key", lambda: None)
+    release.set()
+    leader.join(5)
+
+
+def test_flight_key_normalizes_input_and_hashes_context():
+    assert flight_key("gpt-4o", "Hello  World", ["kb1"]) == flight_key("gpt-4o", "hello world", ["kb1"])
+    assert flight_key("gpt-4o", "hello", ["kb1"]) != flight_key("gpt-4o", "hello", ["kb2"])
+    assert flight_key("gpt-4o", "hello") != flight_key("gpt-4o-mini", "hello")
@@ -0,0 +1,39 @@
+import pytest
+
+from xyz.llm.tenants import Tenant, TenantRegistry
+
+
+def tenant(tenant_id, **kwargs):
+    return Tenant(tenant_id, f"You are {tenant_id}.", f"/nonexistent/{tenant_id}", **kwargs)
+
+
+def test_conversation_keys_are_namespaced_for_every_tenant():
+    default, acme = tenant("default"), tenant("acme")
+    assert default.conversation_key("abc") == "default:abc"
+    assert acme.conversation_key("abc") == "acme:abc"
+    # A client cannot name another tenant's conversation
+    with pytest.raises(ValueError):
+        default.conversation_key("acme:abc")
+    with pytest.raises(ValueError):
+        acme.conversation_key("")
+
+
+def test_tenant_ids_cannot_contain_the_separator():
+    with pytest.raises(ValueError):
+        tenant("a:b")
+
+
+def test_resolve_by_api_key_then_widget_id():
+    default = tenant("default")
+    acme = tenant("acme", widget_ids=["acme-site"], api_keys=["secret"])
+    registry = TenantRegistry([default, acme], default_tenant="default")
+    assert registry.resolve() is default
+    assert registry.resolve(widget_id="acme-site") is acme
+    assert registry.resolve(api_key="secret", widget_id="unknown") is acme
+    assert registry.resolve(widget_id="unknown") is None
+    assert registry.resolve(api_key="wrong") is None
+
+
+def test_shared_widget_ids_are_rejected():
+    with pytest.raises(ValueError):
+        TenantRegistry([tenant("a", widget_ids=["site"]), tenant("b", widget_ids=["site"])])